@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import argparse
+from PIL import Image
+
+
+FORMATS = [('png', 'PNG'), ('jpg', 'JPEG'), ('webp', 'WEBP'), ('bmp', 'BMP'), ('gif', 'GIF')]
+WORDS = ['a', 'photo', 'portrait', 'of', 'woman', 'man', 'dog', 'wearing', 'floral', 'crown', 'holding', 'bouquet',
+         'flowers', 'black', 'and', 'white', 'forest', 'castle', 'in', 'the', 'style', 'golden', 'hour', 'close', 'up']
+
+
+def make_dataset(output_directory, num_images, depth=2, fanout=4, image_size=(64, 64), with_captions=True, seed=1234):
+    """
+    Create a synthetic dataset tree of `num_images` small images in mixed formats, each with a caption text file
+    (same filename as the image), spread over nested directories `depth` levels deep with `fanout` folders per
+    level, plus a `global.yaml` tag file and a few non-image files. Filenames also work as captions
+    (`<caption>_<number>.<ext>`).
+
+    Example:
+
+    $ make_dataset('bench_input', 10000)
+    """
+    rng = random.Random(seed)
+    directories = ['']
+    for _ in range(depth):
+        directories = [os.path.join(directory, f'concept-{i}') for directory in directories for i in range(fanout)]
+    images = {}
+    for extension, image_format in FORMATS:
+        color = tuple(rng.randrange(256) for _ in range(3))
+        image = Image.new('RGB', image_size, color)
+        path = os.path.join(output_directory, f'.template.{extension}')
+        os.makedirs(output_directory, exist_ok=True)
+        image.save(path, image_format)
+        with open(path, 'rb') as f:
+            images[extension] = f.read()
+        os.remove(path)
+
+    for i in range(num_images):
+        directory = os.path.join(output_directory, directories[i % len(directories)])
+        os.makedirs(directory, exist_ok=True)
+        caption = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 12)))
+        extension = FORMATS[i % len(FORMATS)][0]
+        name = f'{caption}_{i:06d}'
+        with open(os.path.join(directory, f'{name}.{extension}'), 'wb') as f:
+            f.write(images[extension])
+        if with_captions:
+            with open(os.path.join(directory, f'{name}.txt'), 'w') as f:
+                f.write(caption + '\n')
+
+    with open(os.path.join(output_directory, 'global.yaml'), 'w') as f:
+        f.write('tags:\n  - tag: "in the style of a synthetic photographer"\n')
+    for directory in directories[:3]:
+        with open(os.path.join(output_directory, directory, 'notes.md'), 'w') as f:
+            f.write('not an image\n')
+    return output_directory
+
+
+if __name__ == '__main__':
+    # Parse args
+    parser = argparse.ArgumentParser(description='Generate a synthetic image/caption dataset tree.')
+    parser.add_argument('-o', '--output_directory', type=str, default='bench_input', help="Output folder (default: 'bench_input')")
+    parser.add_argument('-n', '--num_images', type=int, default=1000, help='Number of images (default: 1000)')
+    parser.add_argument('-d', '--depth', type=int, default=2, help='Depth of nested directories (default: 2)')
+    parser.add_argument('-f', '--fanout', type=int, default=4, help='Subdirectories per directory (default: 4)')
+    parser.add_argument('-s', '--size', type=int, default=64, help='Width and height of the images (default: 64)')
+    parser.add_argument('--no_captions', action='store_true', default=False, help='Do not write caption text files (default: False)')
+    args = parser.parse_args()
+
+    make_dataset(args.output_directory, args.num_images, args.depth, args.fanout, (args.size, args.size), not args.no_captions)
+    print(f'Created {args.num_images} images in `{args.output_directory}`')
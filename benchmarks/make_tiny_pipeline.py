@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import string
+import argparse
+import tempfile
+
+import torch
+from diffusers import StableDiffusionPipeline, AutoencoderKL, UNet2DConditionModel, DDIMScheduler
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+
+def make_tokenizer(directory):
+    """
+    Write a character-level CLIP tokenizer (no BPE merges), so no tokenizer has to be downloaded.
+    """
+    os.makedirs(directory, exist_ok=True)
+    tokens = ['<|startoftext|>', '<|endoftext|>'] + [char + suffix for suffix in ['', '</w>'] for char in string.printable.strip()]
+    vocab_file = os.path.join(directory, 'vocab.json')
+    merges_file = os.path.join(directory, 'merges.txt')
+    with open(vocab_file, 'w') as f:
+        json.dump({token: i for i, token in enumerate(tokens)}, f)
+    with open(merges_file, 'w') as f:
+        f.write('#version: 0.2\n')
+    return CLIPTokenizer(vocab_file, merges_file, model_max_length=77), len(tokens)
+
+def make_tiny_pipeline(output_directory, seed=1234):
+    """
+    Save a randomly initialized Stable Diffusion pipeline with tiny models (a few MB, 64x64 images render in well
+    under a second on CPU), to run `generate_xyz_grids.py --local` and `model_cache.py` without a GPU or downloads.
+    The images are noise, only shapes and plumbing are exercised.
+
+    Example:
+
+    $ make_tiny_pipeline('tiny-sd')
+    $ python utils/generate_xyz_grids.py --local tiny-sd --device cpu -W 64 -H 64
+    """
+    torch.manual_seed(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        tokenizer, vocab_size = make_tokenizer(directory)
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=1,
+        pad_token_id=1,
+        hidden_size=32,
+        intermediate_size=37,
+        layer_norm_eps=1e-05,
+        num_attention_heads=4,
+        num_hidden_layers=5,
+        vocab_size=vocab_size,
+    ))
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=('DownBlock2D', 'CrossAttnDownBlock2D'),
+        up_block_types=('CrossAttnUpBlock2D', 'UpBlock2D'),
+        cross_attention_dim=32,
+    )
+    vae = AutoencoderKL(
+        block_out_channels=[32, 64],
+        in_channels=3,
+        out_channels=3,
+        down_block_types=['DownEncoderBlock2D', 'DownEncoderBlock2D'],
+        up_block_types=['UpDecoderBlock2D', 'UpDecoderBlock2D'],
+        latent_channels=4,
+    )
+    scheduler = DDIMScheduler(beta_start=0.00085, beta_end=0.012, beta_schedule='scaled_linear', clip_sample=False, set_alpha_to_one=False)
+    pipe = StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=scheduler,
+        safety_checker=None,
+        requires_safety_checker=False,
+        feature_extractor=None,
+    )
+    pipe.save_pretrained(output_directory)
+    return output_directory
+
+
+if __name__ == '__main__':
+    # Parse args
+    parser = argparse.ArgumentParser(description='Save a tiny random Stable Diffusion pipeline for CPU tests.')
+    parser.add_argument('-o', '--output_directory', type=str, default='tiny-sd', help="Output folder (default: 'tiny-sd')")
+    parser.add_argument('-s', '--seed', type=int, default=1234, help='Seed of the random weights (default: 1234)')
+    args = parser.parse_args()
+
+    make_tiny_pipeline(args.output_directory, args.seed)
+    print(f'Saved a tiny pipeline to `{args.output_directory}`')
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import glob
+import argparse
+import tempfile
+import datetime
+import statistics
+import subprocess
+import contextlib
+import importlib.util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utils'))
+
+import caption2prompt
+import prompt2test
+import generate_xyz_grids
+from manifest import Manifest
+from make_dataset import make_dataset
+from PIL import Image
+from stub_webui import StubWebUI, seed_color
+
+
+SUITES = ['scanning', 'prompt_io', 'grids', 'seed_batching', 'local']
+# The local suite needs PyTorch and diffusers, it only runs by default where they are installed
+DEFAULT_SUITES = [suite for suite in SUITES if suite != 'local' or importlib.util.find_spec('diffusers') is not None]
+# Grids of the local suite, rendered on CPU
+LOCAL_GRIDS = 4
+
+
+def measure(fn, repeat):
+    """
+    Run `fn` `repeat` times and return timing statistics in seconds along with the last return value.
+    """
+    times = []
+    value = None
+    for _ in range(repeat):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            value = fn()
+            times.append(time.perf_counter() - start)
+    return {
+        'repeat': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'max': max(times),
+    }, value
+
+def bench_scanning(workdir, num_images, repeat):
+    dataset = make_dataset(os.path.join(workdir, 'dataset'), num_images)
+    results = {}
+    benchmarks = {
+        'count_images_in_folder': lambda: caption2prompt.count_images_in_folder(dataset),
+        'count_images_in_folder_trust_extensions': lambda: caption2prompt.count_images_in_folder(dataset, trust_extensions=True),
+        'get_captions': lambda: len(caption2prompt.get_captions(dataset)),
+        'get_captions_from_filename': lambda: len(caption2prompt.get_captions_from_filename(dataset)),
+        'scan_captions': lambda: caption2prompt.scan_captions(dataset, False)[0],
+    }
+    for name, fn in benchmarks.items():
+        results[name], _ = measure(fn, repeat)
+
+    def manifest_refresh(full):
+        with Manifest(dataset) as manifest:
+            manifest.refresh(full=full)
+            return manifest.count_images()
+
+    results['manifest_cold'], _ = measure(lambda: manifest_refresh(True), repeat)
+    results['manifest_warm'], _ = measure(lambda: manifest_refresh(False), repeat)
+    for name in results:
+        results[name]['items_per_second'] = num_images / results[name]['median']
+    return results
+
+def bench_prompt_io(workdir, num_prompts, repeat):
+    results = {}
+    output_file = os.path.join(workdir, 'xyz_prompts.jsonl')
+
+    def append_prompts():
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        for i in range(num_prompts):
+            prompt2test.main(output_file, f'a photo of a synthetic subject number {i}', '', -1, 'CFG Scale', '4,7,11')
+
+    results['prompt2test_append'], _ = measure(append_prompts, repeat)
+    results['prompt2test_append']['items_per_second'] = num_prompts / results['prompt2test_append']['median']
+    return results
+
+def bench_grids(workdir, num_prompts, repeat, latency, image_size):
+    prompts_file = os.path.join(workdir, 'xyz_grid_prompts.json')
+    with open(prompts_file, 'w') as f:
+        json.dump([{
+            'prompt': f'a photo of a synthetic subject number {i}',
+            'negative_prompt': '',
+            'x_axis_type': 'Steps',
+            'x_axis_values': '20,30',
+            'y_axis_type': 'CFG Scale',
+            'y_axis_values': '4,7',
+            'z_axis_type': 'Nothing',
+            'z_axis_values': '',
+        } for i in range(num_prompts)], f)
+
+    servers = [StubWebUI.start(port=0, latency=latency, image_size=image_size) for _ in range(2)]
+    endpoints = [f'127.0.0.1:{server.server_address[1]}' for server in servers]
+    configurations = {
+        'generate_xyz_grids_sync_1_backend': dict(backends=endpoints[:1]),
+        'generate_xyz_grids_sync_2_backends': dict(backends=endpoints),
+        'generate_xyz_grids_async_1_backend': dict(backends=endpoints[:1], use_async=True, max_in_flight=2),
+        'generate_xyz_grids_async_2_backends': dict(backends=endpoints, use_async=True, max_in_flight=2),
+    }
+    results = {}
+    try:
+        for name, kwargs in configurations.items():
+            output_folder = os.path.join(workdir, 'output', name)
+
+            def run():
+                generate_xyz_grids.main(prompts_file, output_folder, 'Euler a', 20, 555, 7.0, 512, 512, **kwargs)
+
+            results[name], _ = measure(run, repeat)
+            results[name]['items_per_second'] = num_prompts / results[name]['median']
+            shutil.rmtree(output_folder, ignore_errors=True)
+    finally:
+        for server in servers:
+            server.stop()
+    return results
+
+def check_seed_grid(path, seeds, cell_width):
+    """
+    Check that every cell of a client-side grid with a single "Seed" (or "Var. seed") axis holds the image of its
+    seed.
+    """
+    image = Image.open(path).convert('RGB')
+    left = image.width - len(seeds) * cell_width
+    for i, seed in enumerate(seeds):
+        # Legends are only drawn above and left of the cells, so the bottom right pixels belong to the cells
+        if image.getpixel((left + i * cell_width + cell_width // 2, image.height - 1)) != seed_color(seed):
+            raise AssertionError(f'Cell {i + 1} of `{path}` is not the image of seed {seed}')
+
+def bench_seed_batching(workdir, num_prompts, repeat, latency):
+    seeds = list(range(1000, 1008))
+    prompts_files = {}
+    for axis_type, name in [('Seed', 'seed'), ('Var. seed', 'variation_seed')]:
+        prompts_files[name] = os.path.join(workdir, f'xyz_{name}_prompts.jsonl')
+        with open(prompts_files[name], 'w') as f:
+            for i in range(num_prompts):
+                p = {'prompt': f'a photo of a synthetic subject number {i}', 'x_axis_type': axis_type, 'x_axis_values': f'{seeds[0]}-{seeds[-1]}'}
+                if axis_type == 'Var. seed':
+                    p.update(y_axis_type='Var. strength', y_axis_values='0.5')
+                f.write(json.dumps(p) + '\n')
+
+    cell_size = 64
+    # The stub colors images by seed and puts a grid in front of batches, like the WebUI
+    server = StubWebUI.start(port=0, latency=latency, latency_per_image=latency / 4, image_size=(cell_size, cell_size), seed_images=True, return_grid=True)
+    endpoint = f'127.0.0.1:{server.server_address[1]}'
+    results = {}
+    try:
+        for name, prompts_file, max_batch_size in [
+            ('generate_xyz_grids_seed_cells', prompts_files['seed'], 1),
+            ('generate_xyz_grids_seed_batches', prompts_files['seed'], 8),
+            ('generate_xyz_grids_variation_seed_cells', prompts_files['variation_seed'], 1),
+            ('generate_xyz_grids_variation_seed_batches', prompts_files['variation_seed'], 8),
+        ]:
+            output_folder = os.path.join(workdir, 'output', name)
+
+            def run():
+                shutil.rmtree(output_folder, ignore_errors=True)
+                server.requests.clear()
+                generate_xyz_grids.main(prompts_file, output_folder, 'Euler a', 20, 555, 7.0, cell_size, cell_size, backends=[endpoint], client_grid=True, max_batch_size=max_batch_size)
+
+            results[name], _ = measure(run, repeat)
+            results[name]['items_per_second'] = num_prompts * len(seeds) / results[name]['median']
+            results[name]['requests'] = len(server.requests)
+            results[name]['max_batch_size'] = max(int(request.get('batch_size', 1)) for request in server.requests)
+            for path in glob.glob(os.path.join(output_folder, '*', '*.png')):
+                check_seed_grid(path, seeds, cell_size)
+    finally:
+        server.stop()
+    return results
+
+def bench_local(workdir, num_prompts, repeat):
+    from make_tiny_pipeline import make_tiny_pipeline
+
+    checkpoint = make_tiny_pipeline(os.path.join(workdir, 'tiny-sd'))
+    prompts_file = os.path.join(workdir, 'xyz_local_prompts.jsonl')
+    with open(prompts_file, 'w') as f:
+        for i in range(num_prompts):
+            f.write(json.dumps({
+                'prompt': f'a photo of a synthetic subject number {i}',
+                'x_axis_type': 'Seed',
+                'x_axis_values': '1,2',
+                'y_axis_type': 'Sampler',
+                'y_axis_values': 'Euler a,DDIM',
+                'z_axis_type': 'CFG Scale',
+                'z_axis_values': '1,7',
+            }) + '\n')
+
+    cell_size = 64
+    cells = 2 * 2 * 2
+    results = {}
+    for name, max_batch_size in [('generate_xyz_grids_local_cells', 1), ('generate_xyz_grids_local_batches', 4)]:
+        output_folder = os.path.join(workdir, 'output', name)
+
+        def run():
+            shutil.rmtree(output_folder, ignore_errors=True)
+            generate_xyz_grids.main(prompts_file, output_folder, 'Euler a', 2, 555, 7.0, cell_size, cell_size, max_batch_size=max_batch_size, local=checkpoint, device='cpu')
+
+        results[name], _ = measure(run, repeat)
+        results[name]['items_per_second'] = num_prompts * cells / results[name]['median']
+        paths = glob.glob(os.path.join(output_folder, '*', '*.png'))
+        if len(paths) != num_prompts:
+            raise AssertionError(f'Expected {num_prompts} local grids in `{output_folder}`, found {len(paths)}')
+        for path in paths:
+            width, height = Image.open(path).size
+            # Two CFG Scale sub-grids of 2x2 cells, plus legends
+            if width < 4 * cell_size or height < 2 * cell_size:
+                raise AssertionError(f'Local grid `{path}` is {width}x{height}, too small for {cells} cells')
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def main(output_file, num_images, num_prompts, num_grids, repeat, latency, image_size, suites, baseline_file=None):
+    """
+    Run the benchmark suites without a GPU or network and save the results as JSON.
+
+    Suites:
+    - scanning: caption scanning helpers of `caption2prompt.py` and the scan manifest on a synthetic dataset
+    - prompt_io: building a prompt file with `prompt2test.py` one prompt at a time
+    - grids: end-to-end `generate_xyz_grids.main` throughput against local stub WebUI servers
+    - seed_batching: client-side "Seed" and "Var. seed" axis grids with and without seed batching, checking that the
+      stub server received batches and that every batched image landed in the cell of its seed (items are cells)
+    - local: Seed/Sampler/CFG Scale grids rendered on CPU by `generate_xyz_grids.py --local` with the tiny random
+      pipeline of `make_tiny_pipeline.py`, with and without batching, checking that every grid was saved (items are
+      cells). Needs PyTorch and diffusers, and only runs by default where they are installed
+
+    Every benchmark reports min/median/max seconds over `repeat` runs and items (images, prompts or grids) per
+    second, so results of different commits can be compared. With `baseline_file` (an earlier results file) the
+    change of every median is printed next to it.
+
+    Examples:
+    $ python benchmarks/run_benchmarks.py
+    $ python benchmarks/run_benchmarks.py -n 20000 -s scanning -o bench_results.json
+    $ python benchmarks/run_benchmarks.py --baseline bench_results/20230601-120000-a64296b.json
+    $ python benchmarks/run_benchmarks.py -s local -r 1
+    """
+    revision = git_revision()
+    results = {
+        'revision': revision,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'num_images': num_images,
+            'num_prompts': num_prompts,
+            'num_grids': num_grids,
+            'repeat': repeat,
+            'latency': latency,
+            'image_size': image_size,
+        },
+        'benchmarks': {},
+    }
+    workdir = tempfile.mkdtemp(prefix='l2t-bench-')
+    try:
+        if 'scanning' in suites:
+            results['benchmarks'].update(bench_scanning(workdir, num_images, repeat))
+        if 'prompt_io' in suites:
+            results['benchmarks'].update(bench_prompt_io(workdir, num_prompts, repeat))
+        if 'grids' in suites:
+            results['benchmarks'].update(bench_grids(workdir, num_grids, repeat, latency, image_size))
+        if 'seed_batching' in suites:
+            results['benchmarks'].update(bench_seed_batching(workdir, num_grids, repeat, latency))
+        if 'local' in suites:
+            results['benchmarks'].update(bench_local(workdir, min(num_grids, LOCAL_GRIDS), repeat))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if output_file is None:
+        os.makedirs('bench_results', exist_ok=True)
+        output_file = os.path.join('bench_results', f'{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}-{revision or "unknown"}.json')
+    with open(output_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    baseline = {}
+    if baseline_file:
+        with open(baseline_file, 'r') as f:
+            baseline = json.load(f)['benchmarks']
+    for name, stats in results['benchmarks'].items():
+        change = ''
+        if name in baseline:
+            change = f'  {100 * (stats["median"] / baseline[name]["median"] - 1):+.1f}% vs baseline'
+        print(f'{name:<45} median {stats["median"]:.4f}s  {stats["items_per_second"]:.1f}/s{change}')
+    print(f'Saved benchmark results to `{output_file}`')
+    return results
+
+
+if __name__ == '__main__':
+    # Parse args
+    parser = argparse.ArgumentParser(description='Run the benchmark suites and save the results as JSON.')
+    parser.add_argument('-o', '--output_file', type=str, default=None, help='Results JSON file (default: bench_results/<datetime>-<revision>.json)')
+    parser.add_argument('-n', '--num_images', type=int, default=2000, help='Number of images of the synthetic dataset (default: 2000)')
+    parser.add_argument('-p', '--num_prompts', type=int, default=200, help='Number of prompts appended with prompt2test (default: 200)')
+    parser.add_argument('-g', '--num_grids', type=int, default=20, help='Number of grids generated against the stub servers (default: 20)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Number of runs of each benchmark (default: 3)')
+    parser.add_argument('-l', '--latency', type=float, default=0.05, help='Latency of the stub txt2img endpoint in seconds (default: 0.05)')
+    parser.add_argument('-S', '--image_size', type=int, default=1024, help='Width and height of the stub images (default: 1024)')
+    parser.add_argument('-b', '--baseline', type=str, default=None, help='Earlier results JSON file to compare with (default: None)')
+    parser.add_argument('-s', '--suite', action='append', default=None, choices=SUITES, help='Suite to run, repeat for several suites (default: all, without local if diffusers is not installed)')
+    args = parser.parse_args()
+
+    main(args.output_file, args.num_images, args.num_prompts, args.num_grids, args.repeat, args.latency, (args.image_size, args.image_size), args.suite or DEFAULT_SUITES, args.baseline)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import time
+import base64
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+
+def make_png(width, height, color=(128, 128, 128)):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'PNG')
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+def seed_color(seed):
+    """
+    Color of the stub images of a seed, so callers can check which seed an image was generated with.
+    """
+    value = (int(seed) * 2654435761) % 2 ** 24
+    return (value >> 16, (value >> 8) & 255, value & 255)
+
+
+class StubWebUI(ThreadingHTTPServer):
+    """
+    Local stub of the AUTOMATIC1111 WebUI API for benchmarks, without a GPU.
+
+    `/sdapi/v1/txt2img` sleeps `latency` seconds (plus `latency_per_image` for every image of a batch) and returns
+    `batch_size * n_iter` grey PNG images of `image_size` pixels, along with an `X-Process-Time` header like the
+    real server. `/sdapi/v1/progress` and `/sdapi/v1/options` answer health checks and checkpoint queries.
+    Every txt2img payload is kept in `requests` so callers can check what was sent.
+
+    With `seed_images` every image is filled with the `seed_color` of its seed, or of its variation seed when the
+    variation seed strength is not zero (consecutive seeds or variation seeds along a batch, like the WebUI), and
+    with `return_grid` batches start with an extra grid image (with `index_of_first_image` set in the info), so
+    callers can check that batched results are split back correctly.
+
+    Example:
+
+    $ server = StubWebUI.start(port=7899, latency=0.05)
+    $ ...
+    $ server.stop()
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port=7860, latency=0.0, latency_per_image=0.0, image_size=(512, 512), checkpoint='stub.safetensors', seed_images=False, return_grid=False):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.latency = latency
+        self.latency_per_image = latency_per_image
+        self.image_size = image_size
+        self.image = make_png(*image_size)
+        self.seed_images = seed_images
+        self.return_grid = return_grid
+        self.options = {'sd_model_checkpoint': checkpoint}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def start(cls, **kwargs):
+        server = cls(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, process_time=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if process_time is not None:
+            self.send_header('X-Process-Time', f'{process_time:.4f}')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/sdapi/v1/progress'):
+            self.send_json({'progress': 0.0, 'eta_relative': 0.0, 'state': {}})
+        elif self.path.startswith('/sdapi/v1/options'):
+            self.send_json(self.server.options)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.startswith('/sdapi/v1/txt2img'):
+            self.send_error(404)
+            return
+        with self.server.lock:
+            self.server.requests.append(payload)
+        start = time.perf_counter()
+        images = int(payload.get('batch_size', 1)) * int(payload.get('n_iter', 1))
+        time.sleep(self.server.latency + self.server.latency_per_image * images)
+        seed = int(payload.get('seed', -1))
+        subseed = int(payload.get('subseed', -1))
+        variation = bool(payload.get('subseed_strength'))
+        seeds = [seed + (0 if variation else i) for i in range(images)]
+        subseeds = [subseed + i for i in range(images)]
+        if self.server.seed_images:
+            encoded = [make_png(*self.server.image_size, seed_color(image_seed)) for image_seed in (subseeds if variation else seeds)]
+        else:
+            encoded = [self.server.image] * images
+        first = 0
+        if self.server.return_grid and images > 1:
+            encoded = [self.server.image] + encoded
+            first = 1
+        info = {'seed': seed, 'all_seeds': seeds, 'subseed': subseed, 'all_subseeds': subseeds, 'index_of_first_image': first}
+        self.send_json({
+            'images': encoded,
+            'parameters': payload,
+            'info': json.dumps(info),
+        }, process_time=time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    # Parse args
+    parser = argparse.ArgumentParser(description='Run a stub WebUI API server.')
+    parser.add_argument('-p', '--port', type=int, default=7860, help='Port (default: 7860)')
+    parser.add_argument('-l', '--latency', type=float, default=0.5, help='Latency of a txt2img request in seconds (default: 0.5)')
+    parser.add_argument('-L', '--latency_per_image', type=float, default=0.0, help='Extra latency per generated image in seconds (default: 0.0)')
+    parser.add_argument('-W', '--width', type=int, default=512, help='Width of the returned images (default: 512)')
+    parser.add_argument('-H', '--height', type=int, default=512, help='Height of the returned images (default: 512)')
+    args = parser.parse_args()
+
+    server = StubWebUI(port=args.port, latency=args.latency, latency_per_image=args.latency_per_image, image_size=(args.width, args.height))
+    print(f'Stub WebUI listening on http://127.0.0.1:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+from local_options import MODEL_INDEX_FILENAME, resolve_checkpoint, unsupported_axes
+
+
+def make_checkpoint(path):
+    os.makedirs(path)
+    with open(os.path.join(path, MODEL_INDEX_FILENAME), 'w') as f:
+        f.write('{}')
+    return str(path)
+
+
+def test_resolve_checkpoint_by_path_and_by_name(tmp_path):
+    base = make_checkpoint(tmp_path / 'base')
+    other = make_checkpoint(tmp_path / 'other')
+    assert resolve_checkpoint(other, str(tmp_path)) == other
+    assert resolve_checkpoint('other', str(tmp_path)) == os.path.join(str(tmp_path), 'other')
+    # WebUI checkpoint titles, with an extension and a short hash
+    assert resolve_checkpoint('other.safetensors [0123abcd]', str(tmp_path)) == os.path.join(str(tmp_path), 'other')
+    assert resolve_checkpoint(base, str(tmp_path)) == base
+
+def test_resolve_checkpoint_rejects_other_folders(tmp_path):
+    os.makedirs(tmp_path / 'not-diffusers')
+    for checkpoint in ['missing', 'not-diffusers']:
+        with pytest.raises(ValueError):
+            resolve_checkpoint(checkpoint, str(tmp_path))
+
+
+def test_supported_axes():
+    p = {'x_axis_type': 'Seed', 'x_axis_values': '1-4', 'y_axis_type': 'Sampler', 'y_axis_values': 'Euler a, DDIM', 'z_axis_type': 'CFG Scale', 'z_axis_values': '4,7'}
+    assert unsupported_axes(p) == []
+    assert unsupported_axes({'prompt': 'no axes'}) == []
+
+def test_unsupported_axis_types_and_samplers():
+    p = {'x_axis_type': 'Var. seed', 'x_axis_values': '1', 'y_axis_type': 'Sampler', 'y_axis_values': 'Euler a,DPM++ 3M SDE'}
+    assert unsupported_axes(p) == ["axis type 'Var. seed'", "sampler 'DPM++ 3M SDE'"]
+
+def test_checkpoint_axis_values(tmp_path):
+    base = make_checkpoint(tmp_path / 'base')
+    make_checkpoint(tmp_path / 'other')
+    p = {'x_axis_type': 'Checkpoint name', 'x_axis_values': 'other [0123abcd],missing'}
+    assert unsupported_axes(p, base) == ["checkpoint 'missing'"]
+    # Without the default checkpoint the names cannot be resolved, they are left to the backend
+    assert unsupported_axes(p) == []
+
+def test_invalid_axis_values_raise():
+    with pytest.raises(ValueError):
+        unsupported_axes({'x_axis_type': 'Sampler', 'x_axis_values': ''})
@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from xyz_plot import batch_images, batch_seed_cells
+
+
+def cell(key, seed, **fields):
+    return key, dict({'prompt': 'a photo of kotak', 'steps': 20, 'seed': seed}, **fields)
+
+def batches(cells, max_batch_size):
+    return [(keys, request.get('batch_size', 1), request['seed'], request.get('subseed')) for keys, request in batch_seed_cells(cells, max_batch_size)]
+
+
+def test_consecutive_seeds_are_batched():
+    cells = [cell(i, 100 + i) for i in range(4)]
+    assert batches(cells, 8) == [([0, 1, 2, 3], 4, 100, None)]
+
+def test_non_consecutive_seeds_split_runs():
+    cells = [cell('a', 1), cell('b', 2), cell('c', 3), cell('d', 5), cell('e', 6)]
+    assert batches(cells, 8) == [(['a', 'b', 'c'], 3, 1, None), (['d', 'e'], 2, 5, None)]
+
+def test_runs_are_sorted_by_seed_and_capped():
+    cells = [cell('c', 3), cell('a', 1), cell('b', 2)]
+    assert batches(cells, 2) == [(['a', 'b'], 2, 1, None), (['c'], 1, 3, None)]
+
+def test_cells_differing_in_other_fields_are_not_batched():
+    cells = [cell('a', 1), cell('b', 2, steps=30)]
+    assert batches(cells, 8) == [(['a'], 1, 1, None), (['b'], 1, 2, None)]
+
+def test_random_seeds_break_runs():
+    cells = [cell('a', -1), cell('b', -1), cell('c', 0), cell('d', 1)]
+    assert batches(cells, 8) == [(['a'], 1, -1, None), (['b'], 1, -1, None), (['c', 'd'], 2, 0, None)]
+
+def test_variation_seeds_are_batched_with_a_fixed_seed():
+    cells = [cell(i, 555, subseed=10 + i, subseed_strength=0.5) for i in range(3)]
+    assert batches(cells, 8) == [([0, 1, 2], 3, 555, 10)]
+
+def test_variation_seeds_need_the_same_seed():
+    cells = [cell('a', 1, subseed=10, subseed_strength=0.5), cell('b', 2, subseed=11, subseed_strength=0.5)]
+    assert batches(cells, 8) == [(['a'], 1, 1, 10), (['b'], 1, 2, 11)]
+
+def test_random_variation_seeds_break_runs():
+    cells = [cell('a', 1, subseed=-1, subseed_strength=0.5), cell('b', 1, subseed=-1, subseed_strength=0.5)]
+    assert batches(cells, 8) == [(['a'], 1, 1, -1), (['b'], 1, 1, -1)]
+
+def test_batched_requests_skip_the_grid():
+    (keys, request), = batch_seed_cells([cell('a', 1), cell('b', 2)], 8)
+    assert request['n_iter'] == 1 and request['do_not_save_grid']
+
+def test_single_cells_are_left_untouched():
+    (keys, request), = batch_seed_cells([cell('a', 1)], 8)
+    assert keys == ['a'] and 'batch_size' not in request
+
+
+def test_batch_images_skip_the_prepended_grid():
+    images = ['grid', 'first', 'second']
+    assert batch_images(images, json.dumps({'index_of_first_image': 1}), 2) == ['first', 'second']
+    assert batch_images(images, {'index_of_first_image': 1}, 2) == ['first', 'second']
+
+def test_batch_images_without_info_take_the_last_images():
+    assert batch_images(['grid', 'first', 'second'], 'not json', 2) == ['first', 'second']
+    assert batch_images(['first', 'second'], None, 2) == ['first', 'second']
+
+def test_batch_images_check_the_count():
+    with pytest.raises(RuntimeError):
+        batch_images(['grid', 'first'], {'index_of_first_image': 1}, 2)
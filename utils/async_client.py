@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import io
+import time
+import base64
+import random
+import asyncio
+import aiohttp
+from PIL import Image
+from backends import parse_endpoint
+
+
+TXT2IMG_ENDPOINT = '/sdapi/v1/txt2img'
+HANDOFF_DELAY = 5
+
+
+def decode_images(response):
+    return [Image.open(io.BytesIO(image)) for image in decode_image_bytes(response)]
+
+def decode_image_bytes(response):
+    return [base64.b64decode(image) for image in response.get('images', [])]
+
+
+class AsyncWebUIClient:
+    """
+    Asyncio client for one WebUI backend sharing a keep-alive connection pool.
+
+    Requests time out after `timeout` seconds and are retried up to `retries` times with exponential backoff and
+    full jitter.
+    """
+
+    def __init__(self, session, host, port, timeout=600, retries=3, backoff=1.0):
+        self.session = session
+        self.url = f'http://{host}:{port}{TXT2IMG_ENDPOINT}'
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+    def __repr__(self):
+        return self.url
+
+    async def txt2img(self, payload):
+        """
+        Return the response JSON and the server-side processing time (`X-Process-Time` header, if sent).
+        """
+        attempt = 0
+        while True:
+            try:
+                async with self.session.post(self.url, json=payload, timeout=self.timeout) as response:
+                    if response.status != 200:
+                        raise RuntimeError(response.status, await response.text())
+                    process_time = response.headers.get('X-Process-Time')
+                    return await response.json(), float(process_time) if process_time else None
+            except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+                if attempt >= self.retries:
+                    raise
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                attempt += 1
+                print(f'Request to {self} failed ({e!r}), retry {attempt}/{self.retries} in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+
+async def run_pipeline(endpoints, payloads, on_result, in_flight=2, queue_size=4, timeout=600, retries=3, decode=decode_images, telemetry=None):
+    """
+    Run txt2img `payloads` through a request -> decode -> write pipeline and call `on_result(index, images, response)`
+    for every result, where `images` is what `decode(response)` returns (PIL images by default).
+
+    Each backend keeps `in_flight` requests open on a keep-alive connection pool (scaled by its `*weight`) and pulls
+    work from a shared queue, so faster backends take more of it. Decoding and writing run in worker threads behind
+    bounded queues of `queue_size` items: when the disk falls behind, requests stop being sent instead of piling up
+    decoded images in memory. A request that runs out of retries on one backend is handed to another once per
+    remaining backend before the run fails. Request, sampling and decode times are recorded to `telemetry` if given.
+
+    `payloads` is advanced in a worker thread, so a lazy iterable may block (on disk or on the writer) without
+    stalling the requests and decodes in flight.
+    """
+    endpoints = [parse_endpoint(endpoint) for endpoint in endpoints]
+    connections = sum(max(1, round(in_flight * weight)) for _, _, weight in endpoints)
+    # `payloads` may be a lazy iterable, it is only read a few jobs ahead of the request workers
+    jobs = asyncio.Queue(maxsize=connections)
+    decode_queue = asyncio.Queue(maxsize=queue_size)
+    write_queue = asyncio.Queue(maxsize=queue_size)
+    fed = {'total': 0, 'done': False}
+    done = asyncio.Event()
+
+    connector = aiohttp.TCPConnector(limit=connections, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def request_worker(client):
+            while not done.is_set():
+                try:
+                    index, payload, handoffs = await asyncio.wait_for(jobs.get(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+                start = time.perf_counter()
+                try:
+                    response, process_time = await client.txt2img(payload)
+                except Exception:
+                    if handoffs + 1 >= len(endpoints):
+                        raise
+                    await jobs.put((index, payload, handoffs + 1))
+                    # Leave the job to the other backends for a while
+                    await asyncio.sleep(HANDOFF_DELAY)
+                    continue
+                if telemetry is not None:
+                    telemetry.record('request', time.perf_counter() - start, backend=str(client), request=index)
+                    telemetry.record('sampling', process_time, backend=str(client), request=index)
+                await decode_queue.put((index, response))
+
+        async def decode_worker():
+            while True:
+                index, response = await decode_queue.get()
+                start = time.perf_counter()
+                images = await asyncio.to_thread(decode, response)
+                if telemetry is not None:
+                    telemetry.record('decode', time.perf_counter() - start, request=index)
+                await write_queue.put((index, images, response))
+
+        async def feed_worker():
+            # Producing a payload may read files or wait on the writer, so it runs off the event loop
+            source = enumerate(payloads)
+            while True:
+                item = await asyncio.to_thread(next, source, None)
+                if item is None:
+                    break
+                index, payload = item
+                await jobs.put((index, payload, 0))
+                fed['total'] += 1
+            fed['done'] = True
+
+        async def write_worker():
+            written = 0
+            while not (fed['done'] and written == fed['total']):
+                try:
+                    index, images, response = await asyncio.wait_for(write_queue.get(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+                await asyncio.to_thread(on_result, index, images, response)
+                written += 1
+            done.set()
+
+        tasks = [asyncio.create_task(feed_worker())]
+        for host, port, weight in endpoints:
+            client = AsyncWebUIClient(session, host, port, timeout=timeout, retries=retries)
+            for _ in range(max(1, round(in_flight * weight))):
+                tasks.append(asyncio.create_task(request_worker(client)))
+        tasks.append(asyncio.create_task(decode_worker()))
+        writer = asyncio.create_task(write_worker())
+        tasks.append(writer)
+        try:
+            # Fail fast if any stage raises, otherwise wait for the writer to drain everything
+            while not writer.done():
+                finished, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    if not task.cancelled() and task.exception() is not None:
+                        raise task.exception()
+                tasks = [task for task in tasks if not task.done()]
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+def run(endpoints, payloads, on_result, **kwargs):
+    asyncio.run(run_pipeline(endpoints, payloads, on_result, **kwargs))
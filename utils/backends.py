@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import queue
+import threading
+import urllib.request
+import webuiapi
+
+
+HEALTH_ENDPOINT = '/sdapi/v1/progress?skip_current_image=true'
+OPTIONS_ENDPOINT = '/sdapi/v1/options'
+
+
+def parse_endpoint(endpoint):
+    """
+    Parse a `host:port[*weight]` backend endpoint.
+
+    Example:
+
+    $ parse_endpoint('10.0.0.2:7861*2')
+    $ ('10.0.0.2', 7861, 2.0)
+    """
+    address, _, weight = endpoint.partition('*')
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port), float(weight or 1)
+
+def fetch_options(endpoint, timeout=30):
+    """
+    Return the WebUI options of a backend, which include the active checkpoint as `sd_model_checkpoint`.
+    """
+    host, port, _ = parse_endpoint(endpoint)
+    with urllib.request.urlopen(f'http://{host}:{port}{OPTIONS_ENDPOINT}', timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+class Backend:
+    """
+    One AUTOMATIC1111 WebUI instance, its webuiapi client and its scheduling state.
+
+    The backend runs up to `max_in_flight` requests at once scaled by its `weight` (at least one), like the
+    connections of `async_client.run_pipeline`.
+    """
+
+    def __init__(self, host, port, weight=1.0, max_in_flight=1, **api_kwargs):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.max_in_flight = max(1, round(max_in_flight * weight))
+        self.api = webuiapi.WebUIApi(host=host, port=port, **api_kwargs)
+        # Server-side processing time of the last request of each thread, from the WebUI `X-Process-Time` header
+        self.local = threading.local()
+        self.api.session.hooks['response'].append(self._capture_process_time)
+        self.outstanding = 0
+        self.completed = 0
+        self.failures = 0
+        self.healthy = True
+
+    def __repr__(self):
+        return f'{self.host}:{self.port}'
+
+    def _capture_process_time(self, response, *args, **kwargs):
+        self.local.process_time = response.headers.get('X-Process-Time')
+
+    def last_process_time(self):
+        process_time = getattr(self.local, 'process_time', None)
+        return float(process_time) if process_time else None
+
+    def check_health(self, timeout=5):
+        try:
+            with urllib.request.urlopen(f'http://{self.host}:{self.port}{HEALTH_ENDPOINT}', timeout=timeout) as response:
+                json.loads(response.read())
+            self.healthy = True
+        except Exception:
+            self.healthy = False
+        return self.healthy
+
+    def score(self):
+        # Weighted least outstanding requests
+        return (self.outstanding + 1) / self.weight
+
+
+class BackendPool:
+    """
+    Fan txt2img requests out across several WebUI backends concurrently.
+
+    Each request goes to the healthy backend with the fewest outstanding requests relative to its weight, with at
+    most `max_in_flight * weight` requests per backend. A request that fails marks its backend unhealthy and is
+    requeued on another backend, up to `max_retries` times, unless it raised a `ValueError` (an invalid request,
+    such as an unknown sampler of a local backend), which fails the run right away and leaves the backend healthy.
+    Unhealthy backends are re-checked every `health_interval` seconds, and right away when no healthy backend is left.
+
+    Example:
+
+    $ pool = BackendPool([Backend('127.0.0.1', 7860), Backend('127.0.0.1', 7861, weight=2)])
+    $ for index, result in pool.map(requests):
+    $     result.image.save(f'{index}.png')
+    """
+
+    def __init__(self, backends, max_retries=3, health_interval=30):
+        self.backends = backends
+        self.max_retries = max_retries
+        self.health_interval = health_interval
+        self.lock = threading.Condition()
+        self.closed = threading.Event()
+
+    @classmethod
+    def from_endpoints(cls, endpoints, max_in_flight=1, max_retries=3, **api_kwargs):
+        backends = []
+        for endpoint in endpoints:
+            host, port, weight = parse_endpoint(endpoint)
+            backends.append(Backend(host, port, weight, max_in_flight, **api_kwargs))
+        return cls(backends, max_retries=max_retries)
+
+    def check_health(self):
+        for backend in self.backends:
+            backend.check_health()
+        with self.lock:
+            self.lock.notify_all()
+        return [backend for backend in self.backends if backend.healthy]
+
+    def _health_loop(self):
+        while not self.closed.wait(self.health_interval):
+            for backend in self.backends:
+                if not backend.healthy and backend.check_health():
+                    print(f'Backend {backend} is healthy again')
+                    with self.lock:
+                        self.lock.notify_all()
+
+    def acquire(self):
+        rechecked = False
+        waited_unhealthy = False
+        with self.lock:
+            while True:
+                available = [b for b in self.backends if b.healthy and b.outstanding < b.max_in_flight]
+                if available:
+                    backend = min(available, key=Backend.score)
+                    backend.outstanding += 1
+                    return backend
+                if self.closed.is_set():
+                    raise RuntimeError('Backend pool is closed')
+                if not any(b.healthy for b in self.backends):
+                    # A transient failure must not stall the run for a whole health interval
+                    if not rechecked:
+                        rechecked = True
+                        if [b for b in self.backends if b.check_health()]:
+                            continue
+                    # Give the health checks one interval to bring a backend back
+                    if waited_unhealthy:
+                        raise RuntimeError(f'No healthy backend among {self.backends}')
+                    waited_unhealthy = True
+                self.lock.wait(self.health_interval)
+
+    def release(self, backend, failed=False):
+        with self.lock:
+            backend.outstanding -= 1
+            if failed:
+                backend.failures += 1
+                backend.healthy = False
+            else:
+                backend.completed += 1
+            self.lock.notify_all()
+
+    def map(self, requests, fn=None, telemetry=None):
+        """
+        Run `fn(backend, request)` (by default `backend.api.txt2img(**request)`) for every request and yield
+        `(index, result)` pairs in completion order. Raises the last error of a request that ran out of retries.
+        Request latency and server-side processing time are recorded to `telemetry` if given.
+
+        `requests` may be a lazy iterable: it is only advanced when a worker is free, so a large prompt file is
+        never held in memory at once.
+        """
+        fn = fn or (lambda backend, request: backend.api.txt2img(**request))
+        if not self.check_health():
+            raise RuntimeError(f'No healthy backend among {self.backends}')
+
+        source = enumerate(requests)
+        source_lock = threading.Lock()
+        retries = queue.Queue()
+        results = queue.Queue()
+        state = {'exhausted': False, 'running': 0}
+        finished = object()
+
+        def next_job():
+            # Requeued requests go first, then the next request from the source
+            try:
+                return retries.get_nowait()
+            except queue.Empty:
+                pass
+            with source_lock:
+                if state['exhausted']:
+                    return None
+                try:
+                    index, request = next(source)
+                except StopIteration:
+                    state['exhausted'] = True
+                    return None
+                state['running'] += 1
+            return index, request, 0
+
+        def worker():
+            try:
+                while not self.closed.is_set():
+                    job = next_job()
+                    if job is None:
+                        with source_lock:
+                            if state['running'] == 0 and retries.empty():
+                                return
+                        # Another worker may still requeue a failed request
+                        time.sleep(0.1)
+                        continue
+                    index, request, attempt = job
+                    try:
+                        backend = self.acquire()
+                    except RuntimeError as e:
+                        results.put((index, None, e))
+                        return
+                    start = time.perf_counter()
+                    try:
+                        result = fn(backend, request)
+                    except Exception as e:
+                        # Invalid requests fail the same way on any backend, but JSON errors come from the server
+                        if isinstance(e, ValueError) and not isinstance(e, json.JSONDecodeError):
+                            self.release(backend)
+                            results.put((index, None, e))
+                            return
+                        self.release(backend, failed=True)
+                        if attempt < self.max_retries:
+                            print(f'Backend {backend} failed ({e}), requeueing request {index + 1}')
+                            retries.put((index, request, attempt + 1))
+                        else:
+                            results.put((index, None, e))
+                            return
+                        continue
+                    self.release(backend)
+                    if telemetry is not None:
+                        telemetry.record('request', time.perf_counter() - start, backend=str(backend), request=index)
+                        telemetry.record('sampling', backend.last_process_time(), backend=str(backend), request=index)
+                    with source_lock:
+                        state['running'] -= 1
+                    results.put((index, result, None))
+            except Exception as e:
+                # The source itself failed (e.g. a malformed prompt file line)
+                results.put((None, None, e))
+            finally:
+                results.put(finished)
+
+        self.closed.clear()
+        threads = [threading.Thread(target=self._health_loop, daemon=True)]
+        for _ in range(sum(backend.max_in_flight for backend in self.backends)):
+            threads.append(threading.Thread(target=worker, daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            running = len(threads) - 1
+            while running:
+                item = results.get()
+                if item is finished:
+                    running -= 1
+                    continue
+                index, result, error = item
+                if error is not None:
+                    raise error
+                yield index, result
+        finally:
+            self.closed.set()
+            with self.lock:
+                self.lock.notify_all()
+            for thread in threads[1:]:
+                thread.join()
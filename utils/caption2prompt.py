@@ -1,30 +1,26 @@
 #!/usr/bin/env python3
 
-import json
 import sys
 import os
 import random
 import argparse
-import imghdr
+from manifest import Manifest
+from sampling import reservoir_sample, stratified_sample
+from prompt_store import default_prompt_file, write_prompts
+from scanner import DEFAULT_WORKERS, clean_filename, scan, sniff_format
+from shards import ShardReader, is_shard_directory
 
 
 def is_image(file_path):
-    image_formats = ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff', 'webp']  # Add more formats if needed
-    return imghdr.what(file_path) in image_formats
+    return sniff_format(file_path) is not None
 
-def count_images_in_folder(folder_path):
+def count_images_in_folder(folder_path, trust_extensions=False, workers=DEFAULT_WORKERS):
     image_count = 0
-    for root, _, files in os.walk(folder_path):
-        for filename in files:
-            file_path = os.path.join(root, filename)
-            if is_image(file_path):
-                image_count += 1
+    for _ in scan(folder_path, captions=False, trust_extensions=trust_extensions, workers=workers):
+        image_count += 1
     return image_count
 
-def clean_filename(filename):
-    return filename.split('_')[0]
-
-def get_captions_from_filename(input_directory):
+def get_captions_from_filename(input_directory, trust_extensions=False, workers=DEFAULT_WORKERS):
     """
     Get captions from image filenames inside an input directory recursively and put them into a list. 
 
@@ -36,19 +32,12 @@ def get_captions_from_filename(input_directory):
     $ get_captions_from_filename('input')
     $ ['a man and his dog', 'a dog having a beer']
     """
-    image_formats = ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff', 'webp']  # Add more formats if needed
-    filename_list = [] 
-    for root, _, files in os.walk(input_directory):
-        for filename in files:
-            file_path = os.path.join(root, filename)
-            if imghdr.what(file_path) in image_formats:
-                filename_list.append(filename)
     caption_list = []
-    for file in filename_list:
-        caption_list.append(clean_filename(file))
+    for record in scan(input_directory, captions=False, trust_extensions=trust_extensions, workers=workers):
+        caption_list.append(clean_filename(os.path.basename(record.path)))
     return caption_list
 
-def get_captions(input_directory):
+def get_captions(input_directory, workers=DEFAULT_WORKERS):
     """
     Get captions from text files inside an input folder recursively and put them into a list.
 
@@ -61,20 +50,72 @@ def get_captions(input_directory):
     ['a man climbing a wall', 'a close up photo of a bearded man']
     """
     caption_list = []
-    for root, _, files in os.walk(input_directory):
-        for filename in files:
-            file_path = os.path.join(root, filename)
-            if filename.endswith('.txt'):
-                try:
-                    with open(file_path, 'r') as f:
-                        caption_list.append(f.readline().strip())
-                except Exception as e:
-                    print(f"An error occurred: {e}")
+    for record in scan(input_directory, images=False, workers=workers):
+        caption_list.append(record.caption)
     return caption_list
 
-def main(num_prompts, output_file, input_directory, negative_prompt,  x_axis_type, x_axis_values, y_axis_type, y_axis_values, z_axis_type, z_axis_values, filename_caption):
+def scan_captions(input_directory, filename_caption, trust_extensions=False, workers=DEFAULT_WORKERS):
+    """
+    Count images and collect captions (from caption files or image filenames) in a single traversal.
+    """
+    image_count = 0
+    caption_list = []
+    for record in scan(input_directory, captions=not filename_caption, trust_extensions=trust_extensions, workers=workers):
+        if record.kind == 'image':
+            image_count += 1
+            if filename_caption:
+                caption_list.append(clean_filename(os.path.basename(record.path)))
+        else:
+            caption_list.append(record.caption)
+    return image_count, caption_list
+
+def sample_captions(input_directory, num_prompts, filename_caption, rng, stratified=False, use_manifest=False, trust_extensions=False, workers=DEFAULT_WORKERS):
+    """
+    Count images and draw `num_prompts` captions in a single streaming pass with reservoir sampling.
+
+    Memory stays O(num_prompts), or O(num_prompts * subdirectories) with `stratified`, which draws from every
+    subdirectory so that each concept folder is covered.
     """
-    Create a XYZ grid prompt json file from captions inside an input directory. 
+    counter = {'images': 0}
+
+    def iter_captions():
+        if is_shard_directory(input_directory):
+            # Captions come from the shard index, the shards themselves are not read
+            with ShardReader(input_directory) as reader:
+                counter['images'] = len(reader)
+                yield from reader.iter_captions(filename_caption)
+            return
+        if use_manifest:
+            with Manifest(input_directory, trust_extensions=trust_extensions, workers=workers) as manifest:
+                manifest.refresh()
+                counter['images'] = manifest.count_images()
+                if filename_caption:
+                    for path, filename in manifest.iter_images():
+                        yield path, clean_filename(filename)
+                else:
+                    yield from manifest.iter_captions()
+            return
+        for record in scan(input_directory, captions=not filename_caption, trust_extensions=trust_extensions, workers=workers):
+            if record.kind == 'image':
+                counter['images'] += 1
+                if filename_caption:
+                    yield record.path, clean_filename(os.path.basename(record.path))
+            else:
+                yield record.path, record.caption
+
+    if stratified:
+        sample, _ = stratified_sample(iter_captions(), num_prompts, key=lambda item: os.path.dirname(item[0]), rng=rng)
+    else:
+        sample, _ = reservoir_sample(iter_captions(), num_prompts, rng=rng)
+    return counter['images'], [caption for _, caption in sample]
+
+def main(num_prompts, output_file, input_directory, negative_prompt,  x_axis_type, x_axis_values, y_axis_type, y_axis_values, z_axis_type, z_axis_values, filename_caption, use_manifest=False, trust_extensions=False, streaming=False, stratified=False, seed=None):
+    """
+    Create a XYZ grid prompt file from captions inside an input directory. 
+
+    Prompts are saved as JSONL (one prompt test per line) unless `output_file` ends with `.json`.
+
+    `input_directory` can also be a folder of shards packed by `shards.py`, captions are then read from its index.
 
     Other prompt parameters can be used and will be applied to all captions:
     - Negative prompt
@@ -109,26 +150,44 @@ def main(num_prompts, output_file, input_directory, negative_prompt,  x_axis_typ
     "Styles"
 
     Examples:
-    $ python caption2prompt.py -i images -o xyz_prompts_filenames.json --x_axis_type="Steps" --x_axis_values="20,30" --y_axis_type='Seed' --y_axis_values='1234' --filename_caption
+    $ python caption2prompt.py -i images -o xyz_prompts_filenames.jsonl --x_axis_type="Steps" --x_axis_values="20,30" --y_axis_type='Seed' --y_axis_values='1234' --filename_caption
     $ python caption2prompt.py -N "(low quality, worst quality), EasyNegativeV2," \
       --x_axis_type="Seed" --x_axis_values="555" -n 20 \
       --y_axis_type="Checkpoint name" --y_axis_values="checkpoint-1.ckpt,checkpoint-2.safetensors" \ 
       --z_axis_type='Prompt S/R' --z_axis_values="joe smith, man"
+    $ python caption2prompt.py -i input -o xyz_prompts.jsonl -n 15 --stratified --seed 1234 --x_axis_type="Steps" --x_axis_values="20,30"
     """
-    image_count = count_images_in_folder(input_directory)
+    rng = random.Random(seed)
+    if streaming or stratified:
+        # Count images and draw the prompts in a single pass with bounded memory
+        image_count, caption_list = sample_captions(input_directory, num_prompts, filename_caption, rng, stratified, use_manifest, trust_extensions)
+    elif is_shard_directory(input_directory):
+        # Answer counts and captions from the index of a packed dataset
+        with ShardReader(input_directory) as reader:
+            image_count = len(reader)
+            captions = [caption for _, caption in reader.iter_captions(filename_caption)]
+    else:
+        if use_manifest:
+            # Answer counts and captions from the persistent manifest, only rescanning changed directories
+            with Manifest(input_directory, trust_extensions=trust_extensions) as manifest:
+                manifest.refresh()
+                image_count = manifest.count_images()
+                if filename_caption:
+                    captions = [clean_filename(filename) for filename in manifest.image_filenames()]
+                else:
+                    captions = manifest.captions()
+        else:
+            # Count images and get captions in a single pass
+            image_count, captions = scan_captions(input_directory, filename_caption, trust_extensions)
     print(f'Creating {num_prompts} from {image_count} images files from the `{input_directory}` directory')
     if image_count < num_prompts:
         print(f'ERROR: Not enough images to generate {num_prompts} prompts')
         sys.exit(1)
 
-    # Get captions
-    if filename_caption:
-        captions = get_captions_from_filename(input_directory)
-    else:
-        captions = get_captions(input_directory)
+    if not (streaming or stratified):
+        caption_list = rng.sample(captions, num_prompts) if captions else []
 
-    if captions:
-        caption_list = random.sample(captions, num_prompts)
+    if caption_list:
         # Prepare data dict with captions as prompts
         data = []
         for prompt in caption_list:
@@ -142,9 +201,8 @@ def main(num_prompts, output_file, input_directory, negative_prompt,  x_axis_typ
     	    d['z_axis_type'] = z_axis_type
     	    d['z_axis_values'] = z_axis_values
     	    data.append(d)
-        # Save prompts to json file
-        with open(output_file, 'w') as fp:
-            json.dump(data, fp)
+        # Save prompts to the prompt file
+        write_prompts(output_file, data)
         print(f'Saved XYZ prompts to `{output_file}`') 
     else:
         print('ERROR: Could not get captions')
@@ -155,7 +213,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-n', '--num_prompts', type=int, default=15, help='Number of prompts to generate at random from the files in input directory (default: 15)')
     parser.add_argument('-i', '--input_directory', type=str, default='input', help="The folder where caption filenames are located (default: 'input')")
-    parser.add_argument('-o', '--output_file', type=str, default='xyz_prompts.json', help='The name of the JSON file (default: xyz_prompts.json)')
+    parser.add_argument('-o', '--output_file', type=str, default=None, help='The name of the prompt file, JSONL unless it ends with .json (default: xyz_prompts.jsonl, or xyz_prompts.json if only that one exists)')
     parser.add_argument('-N', '--negative_prompt', type=str, default='', help="Negative prompt (default: '')")
     parser.add_argument('-x', '--x_axis_type', type=str, default='Nothing', help="X axis type. Options: 'Nothing', 'Prompt S/R', 'Steps', 'CFG Scale', 'Sampler', 'Checkpoint name', etc. (default: 'Nothing')")
     parser.add_argument('-X', '--x_axis_values', default='', type=str, help="X axis values. (default: '')")
@@ -164,11 +222,16 @@ if __name__ == '__main__':
     parser.add_argument('-z', '--z_axis_type', type=str, default='Nothing', help="Z axis type. Options: 'Nothing', 'Prompt S/R', 'Steps', 'CFG Scale', 'Sampler', 'Checkpoint name', etc. (default: 'Nothing')")
     parser.add_argument('-Z', '--z_axis_values', default='', type=str, help="Z axis values. (default: '')")
     parser.add_argument('-f', '--filename_caption', action='store_true', default=False, help='Get captions from filenames. (default: False)')
+    parser.add_argument('-m', '--manifest', action='store_true', default=False, help='Read counts and captions from a persistent manifest in the input directory, rescanning only changed directories. (default: False)')
+    parser.add_argument('-r', '--streaming', action='store_true', default=False, help='Draw prompts in a single pass with reservoir sampling instead of loading every caption in memory. (default: False)')
+    parser.add_argument('--stratified', action='store_true', default=False, help='Draw prompts from every subdirectory so each concept folder is covered (implies --streaming). (default: False)')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the random prompt selection. (default: None)')
+    parser.add_argument('-e', '--trust_extensions', action='store_true', default=False, help='Detect images from their file extension without opening them. (default: False)')
     args = parser.parse_args()
 
     num_prompts = args.num_prompts
     input_directory = args.input_directory
-    output_file = args.output_file
+    output_file = args.output_file or default_prompt_file()
     negative_prompt = args.negative_prompt
     x_axis_type = args.x_axis_type
     x_axis_values = args.x_axis_values
@@ -177,6 +240,11 @@ if __name__ == '__main__':
     z_axis_type = args.z_axis_type
     z_axis_values = args.z_axis_values
     filename_caption = args.filename_caption
+    use_manifest = args.manifest
+    trust_extensions = args.trust_extensions
+    streaming = args.streaming
+    stratified = args.stratified
+    seed = args.seed
 
     # Run main
-    main(num_prompts, output_file, input_directory, negative_prompt,  x_axis_type, x_axis_values, y_axis_type, y_axis_values, z_axis_type, z_axis_values, filename_caption)
+    main(num_prompts, output_file, input_directory, negative_prompt,  x_axis_type, x_axis_values, y_axis_type, y_axis_values, z_axis_type, z_axis_values, filename_caption, use_manifest, trust_extensions, streaming, stratified, seed)
@@ -15,18 +15,533 @@
 """ Conversion script for the LDM checkpoints. """
 
 import argparse
+import glob
+import hashlib
 import importlib
+import inspect
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
 
+import requests
 import torch
 
 from diffusers.pipelines.stable_diffusion.convert_from_ckpt import download_from_original_stable_diffusion_ckpt
 
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+CHECKPOINT_EXTENSIONS = (".ckpt", ".safetensors")
+# Original configs `download_from_original_stable_diffusion_ckpt` fetches for every checkpoint when none is given
+ORIGINAL_CONFIG_URLS = {
+    "v1": "https://raw.githubusercontent.com/CompVis/stable-diffusion/main/configs/stable-diffusion/v1-inference.yaml",
+    "v2": "https://raw.githubusercontent.com/Stability-AI/stablediffusion/main/configs/stable-diffusion/v2-inference-v.yaml",
+    "xl": "https://raw.githubusercontent.com/Stability-AI/generative-models/main/configs/inference/sd_xl_base.yaml",
+    "xl_refiner": "https://raw.githubusercontent.com/Stability-AI/generative-models/main/configs/inference/sd_xl_refiner.yaml",
+}
+# Arguments that do not change the converted weights, left out of the manifest options
+BATCH_ONLY_ARGS = ("checkpoint_path", "dump_path", "num_workers", "force", "low_memory", "save_workers")
+SIZE_UNITS = {"": 1, "B": 1, "KB": 10**3, "MB": 10**6, "GB": 10**9, "KIB": 2**10, "MIB": 2**20, "GIB": 2**30}
+CHECKSUMS_FILENAME = "SHA256SUMS"
+WRITE_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class LazySafetensorsDict(dict):
+    """
+    State dict over a memory-mapped safetensors file that only reads a tensor when it is accessed.
+
+    Floating point tensors are cast to `dtype` as they are read. Tensors are not kept by the dict (except the last
+    one read, which the converter often slices several times in a row), so a tensor is released as soon as the
+    converted model no longer references it, and `pop` drops the key for good.
+    """
+
+    def __init__(self, safetensors_file, dtype=None):
+        super().__init__((key, None) for key in safetensors_file.keys())
+        self.safetensors_file = safetensors_file
+        self.dtype = dtype
+        self.last = (None, None)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if self.last[0] != key:
+            tensor = self.safetensors_file.get_tensor(key)
+            if self.dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(self.dtype)
+            self.last = (key, tensor)
+        return self.last[1]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key not in self and default:
+            return default[0]
+        tensor = self[key]
+        super().pop(key)
+        self.last = (None, None)
+        return tensor
+
+    def values(self):
+        return (self[key] for key in self.keys())
+
+    def items(self):
+        return ((key, self[key]) for key in self.keys())
+
+
+@contextmanager
+def default_dtype(dtype):
+    """
+    Create model skeletons in `dtype`, so weights loaded into them are not cast back to float32.
+    """
+    previous = torch.get_default_dtype()
+    torch.set_default_dtype(dtype)
+    try:
+        yield
+    finally:
+        torch.set_default_dtype(previous)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if os.uname().sysname == "Darwin" else peak / 1024
+
+
+def convert(args, checkpoint_path, dump_path, pipeline_class=None, config_files=None, from_safetensors=None):
+    """
+    Convert one checkpoint with the conversion options of `args` and save the pipeline (or controlnet) to
+    `dump_path`.
+
+    With `args.low_memory`, safetensors checkpoints are memory-mapped instead of loaded: the unet, vae and text
+    encoder are converted one after the other from tensors read on demand (and cast to float16 as they are read
+    with `args.half`), so the full float32 state dict never sits in RAM next to the converted models.
+    """
+    if from_safetensors is None:
+        from_safetensors = args.from_safetensors
+    if args.low_memory and from_safetensors:
+        from safetensors import safe_open
+
+        with safe_open(checkpoint_path, framework="pt", device="cpu") as f:
+            dtype = torch.float16 if args.half else None
+            with default_dtype(dtype) if dtype is not None else nullcontext():
+                pipe = load_pipeline(
+                    args, LazySafetensorsDict(f, dtype), pipeline_class, config_files, from_safetensors=False
+                )
+    else:
+        pipe = load_pipeline(args, checkpoint_path, pipeline_class, config_files, from_safetensors)
+        if args.half:
+            pipe.to(dtype=torch.float16)
+
+    if args.controlnet:
+        # only save the controlnet model
+        components = {"": pipe.controlnet}
+    else:
+        components = pipe.components
+    save_components(
+        components,
+        dump_path,
+        safe_serialization=args.to_safetensors,
+        max_shard_size=parse_size(args.max_shard_size),
+        checksums=args.checksums,
+        workers=args.save_workers,
+    )
+    if not args.controlnet:
+        pipe.save_config(dump_path)
+
+
+def load_pipeline(args, checkpoint_path_or_dict, pipeline_class, config_files, from_safetensors):
+    return download_from_original_stable_diffusion_ckpt(
+        checkpoint_path_or_dict=checkpoint_path_or_dict,
+        original_config_file=args.original_config_file,
+        config_files=config_files if config_files is not None else args.config_files,
+        image_size=args.image_size,
+        prediction_type=args.prediction_type,
+        model_type=args.pipeline_type,
+        extract_ema=args.extract_ema,
+        scheduler_type=args.scheduler_type,
+        num_in_channels=args.num_in_channels,
+        upcast_attention=args.upcast_attention,
+        from_safetensors=from_safetensors,
+        device=args.device,
+        stable_unclip=args.stable_unclip,
+        stable_unclip_prior=args.stable_unclip_prior,
+        clip_stats_path=args.clip_stats_path,
+        controlnet=args.controlnet,
+        vae_path=args.vae_path,
+        pipeline_class=pipeline_class,
+    )
+
+
+def parse_size(size):
+    """
+    Parse a size like "5GB", "500MB" or "2GiB" into bytes, None stays None.
+    """
+    if size is None:
+        return None
+    m = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([a-zA-Z]*)\s*", str(size))
+    if m is None or m.group(2).upper() not in SIZE_UNITS:
+        raise ValueError(f"Invalid size {size!r}, use a number of bytes or a size like 5GB or 500MB")
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2).upper()])
+
+
+def weights_name(model):
+    # Diffusers models (ConfigMixin) and transformers models use different weight file names
+    return "diffusion_pytorch_model.safetensors" if hasattr(model, "save_config") else "model.safetensors"
+
+
+def plan_shards(state_dict, max_shard_size=None):
+    """
+    Split the tensor names of a state dict into shards of at most `max_shard_size` bytes (a single tensor larger
+    than that gets a shard of its own), keeping the state dict order.
+    """
+    shards = [[]]
+    shard_size = 0
+    for name, tensor in state_dict.items():
+        size = tensor.numel() * tensor.element_size()
+        if max_shard_size and shards[-1] and shard_size + size > max_shard_size:
+            shards.append([])
+            shard_size = 0
+        shards[-1].append(name)
+        shard_size += size
+    return shards
+
+
+def write_safetensors(tensors, path, checksum=False):
+    """
+    Write tensors to a safetensors file, hashing the bytes as they are written. Returns the SHA-256 or None.
+    """
+    from safetensors.torch import save
+
+    data = memoryview(save(tensors, metadata={"format": "pt"}))
+    sha256 = hashlib.sha256() if checksum else None
+    with open(path, "wb") as f:
+        for start in range(0, len(data), WRITE_CHUNK_SIZE):
+            chunk = data[start : start + WRITE_CHUNK_SIZE]
+            f.write(chunk)
+            if sha256 is not None:
+                sha256.update(chunk)
+    return sha256.hexdigest() if sha256 is not None else None
+
+
+def save_components(components, dump_path, safe_serialization=False, max_shard_size=None, checksums=False, workers=4):
+    """
+    Save pipeline components to `<dump_path>/<name>` concurrently, like `DiffusionPipeline.save_pretrained` does
+    one after the other (a component named "" is saved to `dump_path` itself).
+
+    With `safe_serialization`, the weights of torch models are written by a pool of `workers` threads, split into
+    shards of at most `max_shard_size` bytes with a `<weights name>.index.json` index when they do not fit in one,
+    and with `checksums` their SHA-256 is computed while writing and recorded in `<dump_path>/SHA256SUMS`
+    (`sha256sum -c SHA256SUMS` checks them). Other components are saved with their own `save_pretrained`.
+    """
+    writes = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for name, component in components.items():
+            if component is None:
+                continue
+            folder = os.path.join(dump_path, name)
+            os.makedirs(folder, exist_ok=True)
+            if not (safe_serialization and isinstance(component, torch.nn.Module)):
+                save_method = component.save_pretrained
+                if "safe_serialization" in inspect.signature(save_method).parameters:
+                    futures.append(executor.submit(save_method, folder, safe_serialization=safe_serialization))
+                else:
+                    futures.append(executor.submit(save_method, folder))
+                continue
+
+            if hasattr(component, "save_config"):
+                component.save_config(folder)
+            else:
+                component.config.architectures = [component.__class__.__name__]
+                component.config.torch_dtype = str(component.dtype).split(".")[1]
+                component.config.save_pretrained(folder)
+
+            # safetensors refuses tensors sharing memory, like the q/k/v views of a converted attention projection
+            state_dict = {}
+            storages = set()
+            for key, tensor in component.state_dict().items():
+                storage = tensor.untyped_storage().data_ptr()
+                state_dict[key] = tensor.clone() if storage in storages else tensor.contiguous()
+                storages.add(storage)
+
+            shards = plan_shards(state_dict, max_shard_size)
+            filename = weights_name(component)
+            if len(shards) > 1:
+                stem, ext = os.path.splitext(filename)
+                filenames = [f"{stem}-{i:05d}-of-{len(shards):05d}{ext}" for i in range(1, len(shards) + 1)]
+                index = {
+                    "metadata": {"total_size": sum(t.numel() * t.element_size() for t in state_dict.values())},
+                    "weight_map": {key: shard_name for shard, shard_name in zip(shards, filenames) for key in shard},
+                }
+                with open(os.path.join(folder, f"{filename}.index.json"), "w") as f:
+                    json.dump(index, f, indent=2, sort_keys=True)
+            else:
+                filenames = [filename]
+            for shard, shard_name in zip(shards, filenames):
+                path = os.path.join(folder, shard_name)
+                tensors = {key: state_dict[key] for key in shard}
+                future = executor.submit(write_safetensors, tensors, path, checksums)
+                futures.append(future)
+                writes.append((os.path.relpath(path, dump_path), future))
+        for future in as_completed(futures):
+            future.result()
+
+    if checksums:
+        with open(os.path.join(dump_path, CHECKSUMS_FILENAME), "w") as f:
+            for path, future in sorted(writes):
+                f.write(f"{future.result()}  {path.replace(os.sep, '/')}\n")
+
+
+def is_batch(checkpoint_path):
+    return os.path.isdir(checkpoint_path) or glob.has_magic(checkpoint_path)
+
+
+def find_checkpoints(checkpoint_path):
+    """
+    Return the `.ckpt` and `.safetensors` files of a directory, or the files matching a glob pattern.
+    """
+    if os.path.isdir(checkpoint_path):
+        paths = [os.path.join(checkpoint_path, name) for name in os.listdir(checkpoint_path)]
+        paths = [path for path in paths if path.endswith(CHECKPOINT_EXTENSIONS)]
+    else:
+        paths = glob.glob(checkpoint_path, recursive=True)
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+def batch_root(checkpoint_path):
+    """
+    Return the directory of a batch, or the part of a glob pattern before its first wildcard.
+    """
+    if os.path.isdir(checkpoint_path):
+        return checkpoint_path
+    parts = []
+    for part in os.path.normpath(checkpoint_path).split(os.sep):
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or "."
+
+
+def dump_names(checkpoints, root):
+    """
+    Return the output folder name of every checkpoint of a batch, its path relative to `root` without the extension.
+    Checkpoints whose names clash once the extension is removed (`a.ckpt` and `a.safetensors`) keep it.
+
+    Raises a `ValueError` if two checkpoints would still be written to the same folder, or one inside the other.
+    """
+    relative_paths = [os.path.relpath(checkpoint, root) for checkpoint in checkpoints]
+    stems = [os.path.splitext(relative_path)[0] for relative_path in relative_paths]
+    names = [
+        stem if stems.count(stem) == 1 else relative_path for stem, relative_path in zip(stems, relative_paths)
+    ]
+    targets = {}
+    for checkpoint, name in zip(checkpoints, names):
+        target = os.path.normcase(os.path.normpath(name))
+        if target in targets:
+            raise ValueError(f"{checkpoint} and {targets[target]} would both be converted to {name}")
+        targets[target] = checkpoint
+    for target, checkpoint in targets.items():
+        parent = os.path.dirname(target)
+        while parent:
+            if parent in targets:
+                raise ValueError(f"{checkpoint} would be converted inside the output of {targets[parent]}")
+            parent = os.path.dirname(parent)
+    return names
+
+
+def file_sha256(path, chunk_size=16 * 1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def manifest_path(dump_path):
+    return os.path.normpath(dump_path) + ".manifest.json"
+
+
+def load_manifest(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"checkpoints": {}}
+
+
+def save_manifest(path, manifest):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+class OriginalConfigCache(dict):
+    """
+    `config_files` of `download_from_original_stable_diffusion_ckpt` that downloads the original config of a model
+    type to `cache_dir` the first time the converter asks for it, so the conversion of every checkpoint of a batch
+    reads it from disk instead of fetching it again, and configs no checkpoint needs are never fetched. A failed
+    download leaves the model type out, and the converter then fetches the config itself.
+    """
+
+    def __init__(self, cache_dir):
+        super().__init__()
+        self.cache_dir = cache_dir
+        self.failed = set()
+
+    def __contains__(self, model_type):
+        if super().__contains__(model_type):
+            return True
+        if model_type not in ORIGINAL_CONFIG_URLS or model_type in self.failed:
+            return False
+        url = ORIGINAL_CONFIG_URLS[model_type]
+        path = os.path.join(self.cache_dir, os.path.basename(url))
+        if not os.path.exists(path):
+            try:
+                response = requests.get(url, timeout=60)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                print(f"Could not download the {model_type} original config ({e}), leaving it to the converter")
+                self.failed.add(model_type)
+                return False
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(f"{path}.tmp", "wb") as f:
+                f.write(response.content)
+            os.replace(f"{path}.tmp", path)
+        self[model_type] = path
+        return True
+
+    def __getitem__(self, model_type):
+        if model_type not in self:
+            raise KeyError(model_type)
+        return super().__getitem__(model_type)
+
+    def get(self, model_type, default=None):
+        return self[model_type] if model_type in self else default
+
+
+def convert_batch(args, pipeline_class=None):
+    """
+    Convert every checkpoint of a directory or glob pattern in one process, each to `<dump_path>/<name>` where
+    `<name>` is its path relative to the directory (or the glob pattern before its first wildcard) without the
+    extension, see `dump_names`. `.safetensors` files are loaded with safetensors, other files with PyTorch.
+
+    Checkpoints are hashed by a pool of `args.num_workers` threads, then converted one at a time: the conversion
+    patches process-wide state (the default dtype, `nn.Module.register_parameter` under accelerate's
+    `init_empty_weights`) and holds a full state dict in memory. A manifest next to the dump path
+    (`<dump_path>.manifest.json`) records the SHA-256 of every converted checkpoint with its conversion options, and
+    checkpoints whose content was already converted with the same options are skipped. Hashes of files whose size
+    and mtime did not change are reused from the manifest. Returns the number of failed conversions.
+    """
+    checkpoints = find_checkpoints(args.checkpoint_path)
+    if not checkpoints:
+        print(f"No checkpoints found in {args.checkpoint_path}")
+        return 0
+    try:
+        names = dump_names(checkpoints, batch_root(args.checkpoint_path))
+    except ValueError as e:
+        print(f"Cannot convert {args.checkpoint_path}: {e}")
+        return len(checkpoints)
+
+    os.makedirs(args.dump_path, exist_ok=True)
+    path = manifest_path(args.dump_path)
+    manifest = load_manifest(path)
+    claimed = {}
+    options = {name: value for name, value in sorted(vars(args).items()) if name not in BATCH_ONLY_ARGS}
+    known_hashes = {
+        (entry["checkpoint"], entry["size"], entry["mtime_ns"]): sha256
+        for sha256, entry in manifest["checkpoints"].items()
+    }
+
+    config_files = args.config_files
+    if args.original_config_file is None and config_files is None:
+        config_files = OriginalConfigCache(os.path.join(args.dump_path, ".original_configs"))
+
+    def hash_checkpoint(checkpoint_path):
+        stat = os.stat(checkpoint_path)
+        sha256 = known_hashes.get((os.path.abspath(checkpoint_path), stat.st_size, stat.st_mtime_ns))
+        if sha256 is None:
+            sha256 = file_sha256(checkpoint_path)
+        return stat, sha256
+
+    def convert_checkpoint(checkpoint_path, name, stat, sha256):
+        dump_path = os.path.join(args.dump_path, name)
+        entry = manifest["checkpoints"].get(sha256)
+        if (
+            entry is not None
+            and not args.force
+            and entry["options"] == options
+            and entry["dump_path"] == os.path.abspath(dump_path)
+            and os.path.isdir(entry["dump_path"])
+        ):
+            return "skipped", entry["dump_path"]
+        # Copies of a checkpoint in the same batch are converted once
+        if sha256 in claimed:
+            return "duplicate", claimed[sha256]
+        claimed[sha256] = checkpoint_path
+
+        start = time.time()
+        convert(
+            args,
+            checkpoint_path,
+            dump_path,
+            pipeline_class=pipeline_class,
+            config_files=config_files,
+            from_safetensors=checkpoint_path.endswith(".safetensors"),
+        )
+        manifest["checkpoints"][sha256] = {
+            "checkpoint": os.path.abspath(checkpoint_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "dump_path": os.path.abspath(dump_path),
+            "options": options,
+            "seconds": round(time.time() - start, 1),
+        }
+        save_manifest(path, manifest)
+        return "converted", dump_path
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        futures = [executor.submit(hash_checkpoint, checkpoint) for checkpoint in checkpoints]
+        for checkpoint, name, future in zip(checkpoints, names, futures):
+            try:
+                status, dump_path = convert_checkpoint(checkpoint, name, *future.result())
+            except Exception as e:
+                failed += 1
+                print(f"Failed to convert {checkpoint}: {e}")
+                continue
+            if status == "skipped":
+                print(f"Skipped {checkpoint}, already converted to {dump_path}")
+            elif status == "duplicate":
+                print(f"Skipped {checkpoint}, same content as {dump_path}")
+            else:
+                print(f"Converted {checkpoint} to {dump_path}")
+    print(f"{len(checkpoints) - failed} of {len(checkpoints)} checkpoints converted or up to date, manifest: {path}")
+    return failed
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
 
     parser.add_argument(
-        "--checkpoint_path", default=None, type=str, required=True, help="Path to the checkpoint to convert."
+        "--checkpoint_path",
+        default=None,
+        type=str,
+        required=True,
+        help=(
+            "Path to the checkpoint to convert. A directory or a glob pattern converts every checkpoint it contains,"
+            " each to `<dump_path>/<checkpoint name>`, in one process that downloads each original YAML config once"
+            " and reuses it. The models themselves are still built and loaded again for every checkpoint."
+        ),
     )
     # !wget https://raw.githubusercontent.com/CompVis/stable-diffusion/main/configs/stable-diffusion/v1-inference.yaml
     parser.add_argument(
@@ -108,6 +623,20 @@ if __name__ == "__main__":
         help="Whether to store pipeline in safetensors format or not.",
     )
     parser.add_argument("--dump_path", default=None, type=str, required=True, help="Path to the output model.")
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of checkpoints hashed at once when converting a directory or glob pattern. Conversions always run"
+            " one at a time."
+        ),
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Convert every checkpoint of a directory or glob pattern, even those already in the manifest.",
+    )
     parser.add_argument("--device", type=str, help="Device to use (e.g. cpu, cuda:0, cuda:1, etc.)")
     parser.add_argument(
         "--stable_unclip",
@@ -133,6 +662,33 @@ if __name__ == "__main__":
         "--controlnet", action="store_true", default=None, help="Set flag if this is a controlnet checkpoint."
     )
     parser.add_argument("--half", action="store_true", help="Save weights in half precision.")
+    parser.add_argument(
+        "--max_shard_size",
+        type=str,
+        default=None,
+        help=(
+            "With `--to_safetensors`, split model weights into shards of at most this size (e.g. 2GB or 500MB),"
+            " with an index file. Defaults to one file per model. Loading sharded unet and vae weights needs"
+            " diffusers 0.28 or later."
+        ),
+    )
+    parser.add_argument(
+        "--checksums",
+        action="store_true",
+        help="With `--to_safetensors`, record the SHA-256 of the weight files, computed while writing, in SHA256SUMS.",
+    )
+    parser.add_argument(
+        "--save_workers", type=int, default=4, help="Number of components and shards written at once."
+    )
+    parser.add_argument(
+        "--low_memory",
+        action="store_true",
+        help=(
+            "Memory-map `--from_safetensors` checkpoints and convert them component by component, reading each tensor"
+            " only when it is converted (and casting it to half precision right away with `--half`). Lowers the peak"
+            " RAM to about the size of the converted pipeline. Reports the peak RSS."
+        ),
+    )
     parser.add_argument(
         "--vae_path",
         type=str,
@@ -157,33 +713,22 @@ if __name__ == "__main__":
     else:
         pipeline_class = None
 
-    pipe = download_from_original_stable_diffusion_ckpt(
-        checkpoint_path_or_dict=args.checkpoint_path,
-        original_config_file=args.original_config_file,
-        config_files=args.config_files,
-        image_size=args.image_size,
-        prediction_type=args.prediction_type,
-        model_type=args.pipeline_type,
-        extract_ema=args.extract_ema,
-        scheduler_type=args.scheduler_type,
-        num_in_channels=args.num_in_channels,
-        upcast_attention=args.upcast_attention,
-        from_safetensors=args.from_safetensors,
-        device=args.device,
-        stable_unclip=args.stable_unclip,
-        stable_unclip_prior=args.stable_unclip_prior,
-        clip_stats_path=args.clip_stats_path,
-        controlnet=args.controlnet,
-        vae_path=args.vae_path,
-        pipeline_class=pipeline_class,
-    )
-
-    if args.half:
-        pipe.to(dtype=torch.float16)
+    if (args.max_shard_size or args.checksums) and not args.to_safetensors:
+        parser.error("--max_shard_size and --checksums need `--to_safetensors`")
+    try:
+        parse_size(args.max_shard_size)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.low_memory and not args.from_safetensors and not is_batch(args.checkpoint_path):
+        parser.error("--low_memory needs a safetensors checkpoint and `--from_safetensors`")
 
-    if args.controlnet:
-        # only save the controlnet model
-        pipe.controlnet.save_pretrained(args.dump_path, safe_serialization=args.to_safetensors)
+    if is_batch(args.checkpoint_path):
+        failed = convert_batch(args, pipeline_class)
     else:
-        pipe.save_pretrained(args.dump_path, safe_serialization=args.to_safetensors)
+        failed = 0
+        convert(args, args.checkpoint_path, args.dump_path, pipeline_class=pipeline_class)
 
+    if args.low_memory and peak_rss_mb() is not None:
+        print(f"Peak RSS: {peak_rss_mb():.0f} MB")
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps
+from preflight import batched
+from scanner import scan, map_bounded
+
+
+HASH_METHODS = ['phash', 'dhash']
+DEFAULT_THRESHOLD = 4
+BATCH_SIZE = 64
+# Candidate pairs compared at once by the near duplicate search
+MAX_PAIRS = 4 * 1024 * 1024
+# DCT-II basis of the 32x32 image the pHash is computed on
+DCT_SIZE = 32
+DCT_MATRIX = np.cos(np.pi / DCT_SIZE * (np.arange(DCT_SIZE)[:, None]) * (np.arange(DCT_SIZE)[None, :] + 0.5))
+# Bits set in every byte value, for NumPy versions without np.bitwise_count
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def pack_bits(bits):
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), 'big')
+
+def image_hashes(image):
+    """
+    Return the 64-bit dHash (brightness gradients of a 9x8 thumbnail) and pHash (low frequencies of the DCT of a
+    32x32 thumbnail above their median) of an image.
+    """
+    gray = image.convert('L')
+    small = np.asarray(gray.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    dhash = pack_bits(small[:, 1:] > small[:, :-1])
+    pixels = np.asarray(gray.resize((DCT_SIZE, DCT_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:8, :8].flatten()
+    # The DC term only measures the mean brightness
+    phash = pack_bits(low > np.median(low[1:]))
+    return dhash, phash
+
+def hash_file(path):
+    """
+    Return the hashes and pixel count of an image, or the error. Runs in the worker processes.
+    """
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            # JPEGs are decoded at 1/8 scale, the hashes only need a thumbnail
+            image.draft('L', (64, 64))
+            dhash, phash = image_hashes(ImageOps.exif_transpose(image))
+        return dhash, phash, width * height, None
+    except Exception as e:
+        return None, None, None, f'{type(e).__name__}: {e}'
+
+def hash_files(paths):
+    return [hash_file(path) for path in paths]
+
+def popcount(values):
+    """
+    Return the number of set bits of every uint64 of an array.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values).astype(np.uint8)
+    return POPCOUNT_TABLE[values.view(np.uint8).reshape(-1, 8)].sum(axis=1, dtype=np.uint8)
+
+def bit_masks(bits, radius):
+    """
+    Return the masks of `bits` bits with at most `radius` bits set.
+    """
+    masks = [0]
+    for count in range(1, radius + 1):
+        masks.extend(sum(1 << bit for bit in combination) for combination in itertools.combinations(range(bits), count))
+    return masks
+
+def chunk_pairs(chunks, masks):
+    """
+    Yield arrays of the (i, j) index pairs, i < j, of the values of `chunks` that differ by one of the bit `masks`,
+    in blocks of about `MAX_PAIRS` pairs. Each value is flipped by each mask and looked up in the sorted values.
+    """
+    order = np.argsort(chunks, kind='stable')
+    ordered = chunks[order]
+    for mask in masks:
+        queries = ordered ^ np.uint64(mask)
+        lows = np.searchsorted(ordered, queries, 'left')
+        counts = np.searchsorted(ordered, queries, 'right') - lows
+        ends = np.cumsum(counts)
+        splits = np.searchsorted(ends, np.arange(MAX_PAIRS, ends[-1] if len(ends) else 0, MAX_PAIRS))
+        for block in np.split(np.arange(len(ordered)), splits):
+            block = block[counts[block] > 0]
+            if not len(block):
+                continue
+            total = counts[block].sum()
+            first = np.repeat(block, counts[block])
+            second = np.repeat(lows[block] - np.cumsum(counts[block]) + counts[block], counts[block]) + np.arange(total)
+            first, second = order[first], order[second]
+            # Every pair is found from both sides, and every value finds itself with the empty mask
+            keep = first < second
+            yield first[keep], second[keep]
+
+def near_duplicate_pairs(hashes, threshold):
+    """
+    Return the (i, j) index pairs of the hashes within `threshold` bits of each other.
+
+    Multi-index hashing: the 64 bits are split into `m` chunks of at least log2(len(hashes)) bits, and two hashes
+    within `threshold` bits have at least one chunk within `threshold // m` bits. Only the pairs with such a chunk
+    are compared, with a vectorized popcount, instead of all the pairs.
+    """
+    bits = min(max(int(np.ceil(np.log2(max(len(hashes), 2)))), 8), 32)
+    num_chunks = 64 // bits
+    radius = threshold // num_chunks
+    bounds = np.linspace(0, 64, num_chunks + 1).astype(int)
+    found = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        mask = np.uint64((1 << int(end - start)) - 1)
+        chunks = (hashes >> np.uint64(start)) & mask
+        for first, second in chunk_pairs(chunks, bit_masks(int(end - start), radius)):
+            close = popcount(hashes[first] ^ hashes[second]) <= threshold
+            found.append(first[close].astype(np.int64) * len(hashes) + second[close])
+    if not found:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # Pairs close in several chunks are found several times
+    keys = np.unique(np.concatenate(found))
+    return keys // len(hashes), keys % len(hashes)
+
+def connected_components(count, first, second):
+    """
+    Return a component label (its smallest index) for each of `count` nodes linked by the (first, second) edges,
+    with vectorized label propagation and pointer jumping.
+    """
+    labels = np.arange(count)
+    while True:
+        lowest = np.minimum(labels[first], labels[second])
+        updated = labels.copy()
+        np.minimum.at(updated, first, lowest)
+        np.minimum.at(updated, second, lowest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+class HashIndex:
+    """
+    Perceptual hashes of the images of a dataset folder, stored as packed uint64 NumPy arrays in a `.npz` file.
+
+    Images are found by the scanner and hashed in a pool of `workers` processes. Hashes of images whose path,
+    size and mtime did not change since the last run are reused from the file.
+    """
+
+    def __init__(self, root, path, workers=None, trust_extensions=False):
+        self.root = root
+        self.path = path
+        self.workers = workers or os.cpu_count() or 1
+        self.trust_extensions = trust_extensions
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with np.load(self.path) as data:
+            columns = [data[name].tolist() for name in ['paths', 'sizes', 'mtimes', 'dhash', 'phash', 'pixels']]
+        return {path: row for path, *row in zip(*columns)}
+
+    def update(self):
+        """
+        Hash the new and changed images, save the index and return its arrays.
+        """
+        known = self.load()
+        rows = []
+        todo = []
+        for record in scan(self.root, captions=False, trust_extensions=self.trust_extensions):
+            rel_path = os.path.relpath(record.path, self.root)
+            st = os.stat(record.path)
+            previous = known.get(rel_path)
+            if previous and previous[:2] == [st.st_size, st.st_mtime_ns]:
+                rows.append([rel_path] + previous)
+            else:
+                todo.append((rel_path, st))
+        hashed = 0
+        paths = (os.path.join(self.root, rel_path) for rel_path, _ in todo)
+        results = (result for results in map_bounded(hash_files, batched(paths, BATCH_SIZE), self.workers, executor_class=ProcessPoolExecutor) for result in results)
+        for (rel_path, st), (dhash, phash, pixels, error) in zip(todo, results):
+            if error:
+                print(f'Warning: skipped `{rel_path}`: {error}')
+                continue
+            rows.append([rel_path, st.st_size, st.st_mtime_ns, dhash, phash, pixels])
+            hashed += 1
+        rows.sort()
+        columns = list(zip(*rows)) or [[]] * 6
+        arrays = {
+            'paths': np.array(columns[0], dtype=str),
+            'sizes': np.array(columns[1], dtype=np.int64),
+            'mtimes': np.array(columns[2], dtype=np.int64),
+            'dhash': np.array(columns[3], dtype=np.uint64),
+            'phash': np.array(columns[4], dtype=np.uint64),
+            'pixels': np.array(columns[5], dtype=np.int64),
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f'{self.path}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, self.path)
+        return arrays, hashed
+
+
+def find_clusters(arrays, method='phash', threshold=DEFAULT_THRESHOLD):
+    """
+    Group the images into clusters of near duplicates, the image to keep first (the largest, then the heaviest
+    file). Returns lists of (path, distance in bits to the kept image).
+    """
+    hashes = arrays[method]
+    # Identical hashes are searched once
+    unique, inverse = np.unique(hashes, return_inverse=True)
+    first, second = near_duplicate_pairs(unique, threshold)
+    labels = connected_components(len(unique), first, second)[inverse.reshape(-1)]
+    members = np.flatnonzero(np.bincount(labels, minlength=len(unique))[labels] > 1)
+    # Sorted by cluster, then largest image, heaviest file and path
+    order = members[np.lexsort((arrays['paths'][members], -arrays['sizes'][members], -arrays['pixels'][members], labels[members]))]
+    clusters = []
+    for group in np.split(order, np.flatnonzero(np.diff(labels[order])) + 1) if len(order) else []:
+        distances = popcount(hashes[group] ^ hashes[group[0]])
+        clusters.append([(str(arrays['paths'][i]), int(distance)) for i, distance in zip(group, distances)])
+    clusters.sort(key=lambda cluster: (-len(cluster), cluster[0][0]))
+    return clusters
+
+def hashes_path(output_file):
+    return f'{os.path.splitext(output_file)[0]}.hashes.npz'
+
+def main(input_directory, output_file, exclude_file=None, method='phash', threshold=DEFAULT_THRESHOLD, workers=None, trust_extensions=False):
+    """
+    Find duplicate and near-duplicate images in a dataset folder.
+
+    Images are compared by perceptual hash (`method`, pHash or dHash) and images within `threshold` bits of each
+    other are grouped in clusters, saved to the JSON `output_file`. The hashes are kept next to it in
+    `<output_file>.hashes.npz`, so runs with other settings only hash new or changed images. With `exclude_file`
+    the paths of every image of a cluster but the largest one are written to it, one per line.
+
+    Examples:
+    $ python dedup.py -i input
+    $ python dedup.py -i input -o duplicates.json --exclude_file exclude.txt --threshold 6
+    $ python dedup.py -i input --method dhash -j 32
+    """
+    if not os.path.isdir(input_directory):
+        print(f'ERROR: `{input_directory}` is not a folder')
+        sys.exit(1)
+    if threshold < 0 or threshold >= 32:
+        print('ERROR: The threshold must be between 0 and 31 bits')
+        sys.exit(1)
+
+    start = time.perf_counter()
+    arrays, hashed = HashIndex(input_directory, hashes_path(output_file), workers, trust_extensions).update()
+    hash_seconds = time.perf_counter() - start
+    clusters = find_clusters(arrays, method, threshold)
+    search_seconds = time.perf_counter() - start - hash_seconds
+
+    duplicates = sum(len(cluster) - 1 for cluster in clusters)
+    with open(output_file, 'w') as f:
+        json.dump({
+            'root': input_directory,
+            'method': method,
+            'threshold': threshold,
+            'images': len(arrays['paths']),
+            'duplicates': duplicates,
+            'clusters': [[{'path': path, 'distance': distance} for path, distance in cluster] for cluster in clusters],
+        }, f, indent=2)
+    if exclude_file:
+        with open(exclude_file, 'w') as f:
+            for cluster in clusters:
+                for path, _ in cluster[1:]:
+                    f.write(f'{path}\n')
+
+    print(f'Hashed {hashed} images ({len(arrays["paths"]) - hashed} unchanged) in {hash_seconds:.1f}s, searched {len(arrays["paths"])} hashes in {search_seconds:.1f}s')
+    print(f'Found {len(clusters)} clusters of near duplicates ({method} within {threshold} bits), {duplicates} images to exclude')
+    for cluster in clusters[:5]:
+        print(f'  {cluster[0][0]}: {", ".join(f"{path} ({distance})" for path, distance in cluster[1:4])}{" ..." if len(cluster) > 4 else ""}')
+    print(f'Saved the clusters to `{output_file}`' + (f' and the paths to exclude to `{exclude_file}`' if exclude_file else ''))
+    return clusters
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='Find duplicate and near-duplicate images with perceptual hashes.')
+    parser.add_argument('-i', '--input_directory', type=str, default='input', help="The dataset folder (default: 'input')")
+    parser.add_argument('-o', '--output_file', type=str, default='duplicates.json', help="JSON file of the duplicate clusters (default: 'duplicates.json')")
+    parser.add_argument('-x', '--exclude_file', type=str, default=None, help='Text file listing the images to exclude, all but the largest of each cluster (default: None)')
+    parser.add_argument('-m', '--method', type=str, default='phash', choices=HASH_METHODS, help='Perceptual hash to compare (default: phash)')
+    parser.add_argument('-t', '--threshold', type=int, default=DEFAULT_THRESHOLD, help=f'Maximum Hamming distance in bits between near duplicates, the search gets slower as it grows (default: {DEFAULT_THRESHOLD})')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of hashing processes (default: number of CPUs)')
+    parser.add_argument('-e', '--trust_extensions', action='store_true', default=False, help='Detect images from their file extension without opening them. (default: False)')
+    args = parser.parse_args()
+
+    main(args.input_directory, args.output_file, args.exclude_file, args.method, args.threshold, args.workers, args.trust_extensions)
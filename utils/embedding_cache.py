@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import warnings
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+DEFAULT_MAX_ENTRIES = 1024
+
+
+def embedding_key(encoder_key, prompt, clip_skip=None):
+    """
+    Hash a text encoder (e.g. the hash of its weights and tokenizer), a prompt and a clip skip into a cache key.
+    """
+    data = json.dumps([encoder_key, prompt, clip_skip or None])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Cache of CLIP text embeddings in front of the tokenizer and text encoder of a `StableDiffusionPipeline`.
+
+    Embeddings are keyed by the text encoder (`encoder_key`, which must change whenever the text encoder or the
+    tokenizer does, like `PipelineCache.encoder_key`), the prompt and the clip skip, and kept in an in-memory LRU of
+    `max_entries` prompts. With `cache_dir` they are also stored on disk as `<key[:2]>/<key>.npy` NumPy arrays,
+    memory-mapped when read back (and only copied to move them to another device or dtype), so later runs do not
+    encode the same prompts again.
+
+    Example:
+
+    $ embeddings = EmbeddingCache(cache_dir='.xyz_cache/embeddings')
+    $ embeds = embeddings.prompt_embeds(pipe, pipelines.encoder_key(pipe), ['a photo of kotak'], [''])
+    $ image = pipe(**embeds, num_inference_steps=30).images[0]
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'memory': 0, 'disk': 0, 'encoded': 0}
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.npy')
+
+    def read(self, key, device, dtype=None):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats['memory'] += 1
+                return self.memory[key]
+        if not self.cache_dir:
+            return None
+        try:
+            array = np.load(self.path(key), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        with warnings.catch_warnings():
+            # The mapping is read-only and the embeddings are never written to
+            warnings.simplefilter('ignore', UserWarning)
+            embedding = torch.from_numpy(array)
+        embedding = embedding.to(device=device, dtype=dtype or embedding.dtype)
+        self.remember(key, embedding, 'disk')
+        return embedding
+
+    def remember(self, key, embedding, source):
+        with self.lock:
+            self.stats[source] += 1
+            self.memory[key] = embedding
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_entries:
+                self.memory.popitem(last=False)
+
+    def write(self, key, embedding):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # NumPy has no bfloat16
+        array = (embedding.float() if embedding.dtype == torch.bfloat16 else embedding).cpu().numpy()
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+    def encode(self, pipe, encoder_key, prompts, clip_skip=None):
+        """
+        Return the text embeddings of `prompts` as one `(len(prompts), tokens, dim)` tensor, encoding only the
+        prompts that are not cached.
+        """
+        device = pipe.device
+        dtype = pipe.text_encoder.dtype if getattr(pipe, 'text_encoder', None) is not None else None
+        keys = [embedding_key(encoder_key, prompt, clip_skip) for prompt in prompts]
+        found = {}
+        for key in keys:
+            if key not in found:
+                embedding = self.read(key, device, dtype)
+                if embedding is not None:
+                    found[key] = embedding
+        missing = OrderedDict((key, prompt) for key, prompt in zip(keys, prompts) if key not in found)
+        if missing:
+            with torch.no_grad():
+                embeddings, _ = pipe.encode_prompt(list(missing.values()), device, 1, False, clip_skip=clip_skip or None)
+            for key, embedding in zip(missing, embeddings):
+                found[key] = embedding
+                self.remember(key, embedding, 'encoded')
+                if self.cache_dir:
+                    self.write(key, embedding)
+        return torch.stack([found[key] for key in keys])
+
+    def prompt_embeds(self, pipe, encoder_key, prompts, negative_prompts, clip_skip=None):
+        """
+        Return the `prompt_embeds` and `negative_prompt_embeds` pipeline arguments for lists of prompts and
+        negative prompts. Like diffusers, negative prompts are encoded without clip skip.
+        """
+        return dict(
+            prompt_embeds=self.encode(pipe, encoder_key, prompts, clip_skip),
+            negative_prompt_embeds=self.encode(pipe, encoder_key, [negative or '' for negative in negative_prompts]),
+        )
@@ -1,121 +1,106 @@
 #!/usr/env/bin python3
 
 import os
-import glob
-import json
 import datetime
 import argparse
-import re
-import webuiapi
+import base64
+import random
+import itertools
+import threading
+from collections import OrderedDict
+from backends import BackendPool, fetch_options, parse_endpoint
+from result_cache import ResultCache, cache_key
+from writer import ImageWriter
+from scheduling import Job, count_cells, plan_checkpoint_affinity
+from telemetry import Telemetry
+from prompt_store import default_prompt_file, iter_prompts, count_prompts
+from xyz_plot import XYZPlotAvailableTxt2ImgScripts, has_random_seed_axis, expand_grid, batch_seed_cells, batch_cells, batch_images
+from planner import ORDERS, DEFAULT_SECONDS_PER_UNIT, grid_cost, request_cost, calibrate, find_telemetry, order_jobs, print_plan
 
-def main(filename, output_folder, sampler, steps, seed, cfg_scale, width, height):
+# Finished cells kept in memory for identical cells of the next grids
+RECENT_CELLS = 256
+
+
+def prompt_seed(p, seed):
     """
-    Generate XYZ grids from a XYZ prompt JSON file and save images and texts to the `output` folder.
+    Return the seed of a prompt test: its own `seed` (as written by `prompt2test.py`) unless unset or -1.
+    """
+    if p.get('seed') is not None and int(p['seed']) != -1:
+        return int(p['seed'])
+    return seed
 
-    Examples:
-    $ python generate_xyz_grids.py --input_filename 'xyz_prompt-1.json' --output_folder 'tests'
-    $ python3 generate_xyz_grids.py -W 768 -H 768
+def build_txt2img_args(p, seed, cfg_scale, width, height):
     """
-    # datetime
-    dt = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    Build the `api.txt2img` keyword arguments running the X/Y/Z Plot script for one prompt test.
+    """
+    drawLegend = "True"
+    includeLoneImages = "False"
+    includeSubGrids = "False"
+    noFixedSeeds = "False"
+    marginSize = 0
+    # Grids split per checkpoint load their model through an override that stays loaded for the next grids
+    overrides = {}
+    if p.get('checkpoint'):
+        overrides = dict(override_settings={'sd_model_checkpoint': p['checkpoint']}, override_settings_restore_afterwards=False)
+    return dict(
+        prompt=p.get('prompt'),
+        negative_prompt=p.get('negative_prompt'),
+        seed=int(seed),
+        cfg_scale=cfg_scale,
+        width=width,
+        height=height,
+        script_name="X/Y/Z Plot",
+        denoising_strength=0.7,
+        seed_resize_from_h=0,
+        seed_resize_from_w=0,
+        script_args=[
+            XYZPlotAvailableTxt2ImgScripts.index(p.get('x_axis_type') or 'Nothing'),
+            p.get('x_axis_values') or '',
+            [],
+            XYZPlotAvailableTxt2ImgScripts.index(p.get('y_axis_type') or 'Nothing'),
+            p.get('y_axis_values') or '',
+            [],
+            XYZPlotAvailableTxt2ImgScripts.index(p.get('z_axis_type') or 'Nothing'),
+            p.get('z_axis_values') or '',
+            [],
+            drawLegend,
+            includeLoneImages,
+            includeSubGrids,
+            noFixedSeeds,
+            marginSize,
+        ],
+        **overrides
+    )
 
-    # Instantiate Webuiapi
-    api = webuiapi.WebUIApi(host='127.0.0.1',
-                        port=7860,
-                        sampler=sampler,
-                        steps=steps
-                        )
-    # Load prompts
-    with open (filename, 'r') as j:
-        xyz_prompt_list = json.loads(j.read())
-        print(f'Loaded {len(xyz_prompt_list)} prompt tests')
+def build_cell_args(p, seed, cfg_scale, width, height, sampler, steps, checkpoint=None):
+    """
+    Build the `api.txt2img` keyword arguments of one grid cell before its axis values are applied.
 
-    # Create output folder
-    if not os.path.exists(output_folder):
-        os.makedirs(f'{output_folder}/{dt}')
-    else:
-        os.makedirs(f'{output_folder}/{dt}')
-
-    XYZPlotAvailableTxt2ImgScripts = [
-    "Nothing",
-    "Seed",
-    "Var. seed",
-    "Var. strength",
-    "Steps",
-    "Hires steps",
-    "CFG Scale",
-    "Prompt S/R",
-    "Prompt order",
-    "Sampler",
-    "Checkpoint name",
-    "Sigma Churn",
-    "Sigma min",
-    "Sigma max",
-    "Sigma noise",
-    "Eta",
-    "Clip skip",
-    "Denoising",
-    "Hires upscaler",
-    "VAE",
-    "Styles",
-    ]
+    Cells are pinned to a checkpoint (the prompt test's own, or the one loaded when the run started) so a
+    "Checkpoint name" axis of one grid does not leak into cells of other grids running on the same backend.
+    """
+    request = dict(
+        prompt=p.get('prompt'),
+        negative_prompt=p.get('negative_prompt') or '',
+        seed=int(seed),
+        cfg_scale=cfg_scale,
+        width=width,
+        height=height,
+        sampler_name=sampler,
+        steps=steps,
+        denoising_strength=0.7,
+        seed_resize_from_h=0,
+        seed_resize_from_w=0,
+    )
+    checkpoint = p.get('checkpoint') or checkpoint
+    if checkpoint:
+        request.update(override_settings={'sd_model_checkpoint': checkpoint}, override_settings_restore_afterwards=False)
+    return request
 
-    # Generate grid for each prompt
-    counter = 0
-    for p in xyz_prompt_list:
-        counter += 1
-        print(f'Generating xyz grid {counter} out of {len(xyz_prompt_list)} prompt tests')
-        prompt = p.get('prompt')
-        negative_prompt = p.get('negative_prompt')
-        # Prepare prompt
-        XAxisType = p.get('x_axis_type')
-        XAxisValues = p.get('x_axis_values')
-        YAxisType = p.get('y_axis_type')
-        YAxisValues = p.get('y_axis_values')
-        ZAxisType = p.get('z_axis_type')
-        ZAxisValues = p.get('z_axis_values')
-        drawLegend = "True"
-        includeLoneImages = "False"
-        includeSubGrids = "False"
-        noFixedSeeds = "False"
-        marginSize = 0
-        result = api.txt2img(
-                    prompt=prompt,
-                    negative_prompt=negative_prompt,
-                    seed=int(seed),
-                    cfg_scale=cfg_scale,
-                    width=width,
-                    height=height,
-                    script_name="X/Y/Z Plot",
-                    denoising_strength=0.7,
-                    seed_resize_from_h=0,
-                    seed_resize_from_w=0,
-                    script_args=[
-                        XYZPlotAvailableTxt2ImgScripts.index(XAxisType),
-                        XAxisValues,
-                        [],
-                        XYZPlotAvailableTxt2ImgScripts.index(YAxisType),
-                        YAxisValues,
-                        [],
-                        XYZPlotAvailableTxt2ImgScripts.index(ZAxisType),
-                        ZAxisValues,
-                        [],
-                        drawLegend,
-                        includeLoneImages,
-                        includeSubGrids,
-                        noFixedSeeds,
-                        marginSize,                        ]
-                    )
-        seq = '{0:0>4}'.format(counter)
-        truncated_prompt = prompt[:100]
-        path_filename = f'{output_folder}/{dt}/xyz_grid-{seq}-{seed}-{width}x{height}-{truncated_prompt}'
-        print(f'Saving image as "{path_filename}.png"')
-        print('')
-        result.image.save(f'{path_filename}.png')
-        # Save txt file
-        image_info =  f'''
-Prompt: {prompt}
-Negative prompt: {negative_prompt}
+def build_image_info(p, sampler, steps, seed, cfg_scale, width, height):
+    return f'''
+Prompt: {p.get('prompt')}
+Negative prompt: {p.get('negative_prompt')}
 
 Sampler: {sampler}
 Steps: {steps}
@@ -124,21 +109,347 @@ CFG scale: {cfg_scale}
 Height: {height}
 Width: {width}
 Script: X/Y/Z plot
-X Type: {XAxisType}   
-X Values: {XAxisValues}
-Y Type: {YAxisType}
-Y Values: {YAxisValues}
-Z Type: {ZAxisType}
-Z Values: {ZAxisValues}
-'''
-        with open(f"{path_filename}.txt", "w") as f:
-            f.write(image_info)
+X Type: {p.get('x_axis_type')}   
+X Values: {p.get('x_axis_values')}
+Y Type: {p.get('y_axis_type')}
+Y Values: {p.get('y_axis_values')}
+Z Type: {p.get('z_axis_type')}
+Z Values: {p.get('z_axis_values')}
+''' + (f'Checkpoint: {p["checkpoint"]}\n' if p.get('checkpoint') else '')
+
+def main(filename, output_folder, sampler, steps, seed, cfg_scale, width, height, backends=None, max_in_flight=1, use_async=False, queue_size=4, timeout=600, retries=3, resume=None, cache_dir=None, cache_size=10, image_format='png', compress_level=None, quality=90, checkpoint_affinity=False, split_checkpoints=False, prometheus_file=None, client_grid=False, max_batch_size=1, plan=False, order='file', deadline=None, local=None, device=None):
+    """
+    Generate XYZ grids from a XYZ prompt file and save images and texts to the `output` folder.
+
+    The prompt file is read as a stream, one prompt test at a time, in the JSONL format written by `prompt2test.py`
+    and `caption2xyz.py` or the older JSON array format. Axes missing from a prompt test default to "Nothing", and
+    a prompt test `seed` other than -1 overrides `seed`.
+
+    Prompt tests are fanned out across the given WebUI backends (`host:port[*weight]`, default `127.0.0.1:7860`),
+    each running up to `max_in_flight` requests at once scaled by its weight. Failed requests are requeued on
+    another backend.
+
+    With `use_async` requests go through an asyncio keep-alive connection pool instead, with per-request
+    `timeout`, `retries` with jitter, and bounded queues of `queue_size` between the request, decode and write
+    stages so the next requests are already in flight while a grid is being decoded and saved.
+
+    With `cache_dir` finished grids are stored in a content-addressed cache capped at `cache_size` GB, keyed by the
+    full request and the active checkpoint, so reruns and overlapping prompt files skip already computed grids.
+    Grids with a random seed (-1, as the seed or a "Seed"/"Var. seed" axis value) are not cached. `resume` continues an interrupted run in its existing run folder, skipping grids that were already saved.
+
+    Images and text files are encoded and written by a process pool while the next requests are in flight, as
+    `image_format` 'png' (kept as sent by the server unless a `compress_level` is given), lossless 'webp' or
+    'jpeg' previews of the given `quality`. Pending writes are flushed on exit and on Ctrl-C.
+
+    With `checkpoint_affinity` prompt tests are reordered so that all the work for one checkpoint runs back to back,
+    and with `split_checkpoints` grids with a "Checkpoint name" axis are split into one grid per checkpoint (saved
+    with the checkpoint name appended to their number). Output numbering follows the prompt file either way.
+
+    Every run logs per-stage timings (request, server-side sampling, decode, encode, write) to `telemetry.jsonl`
+    in the run folder and ends with a p50/p95/p99 summary and throughput in images/sec, also exported to the
+    `prometheus_file` textfile if given.
+
+    With `client_grid` the X/Y/Z axes are expanded here instead of by the X/Y/Z Plot script (with the same value
+    syntax: "1-5", "1-10 (+2)", "1-10 [5]", Prompt S/R...) and every cell is sent as its own txt2img request, so
+    cells of one grid run in parallel across backends and are retried (and with `cache_dir` cached) one at a time.
+    Identical cells of different grids are only generated once. Grids and legends are composited locally.
+    With a `max_batch_size` above 1, cells that only differ by consecutive seeds (e.g. a "Seed" axis of "100-107")
+    are generated as one batch of up to that many images.
+
+    With `plan` nothing is sent: the axes of every prompt test are expanded locally and the run is reported with
+    its number of images and its estimated GPU and wall time. The cost of a grid is the sum over its cells of
+    steps x width x height x a sampler factor (2 for samplers evaluating the model twice per step), converted to
+    seconds with the timings of past runs in `output_folder` when there are any. `order` runs prompt tests in file
+    order, 'shortest' first (the most grids done early) or 'largest' first (best load balance across backends),
+    and a `deadline` in minutes reports how many grids would be done by then.
+
+    With `local` (a diffusers checkpoint folder) no WebUI is needed: cells are rendered in this process by a
+    diffusers `StableDiffusionPipeline` on `device` (CUDA if available, else CPU), loaded once per checkpoint.
+    Grids are expanded client-side, with Steps, CFG Scale, Seed, Sampler (mapped to a diffusers scheduler),
+    Prompt S/R, Prompt order, Checkpoint name (folders next to `local`), Clip skip and Eta axes. With a
+    `max_batch_size` above 1, cells that only differ by seed or prompt are generated as one batch. Prompt embeddings
+    are cached per text encoder, with `cache_dir` also on disk for later runs.
+
+    Examples:
+    $ python generate_xyz_grids.py --input_filename 'xyz_prompt-1.jsonl' --output_folder 'tests'
+    $ python3 generate_xyz_grids.py -W 768 -H 768
+    $ python3 generate_xyz_grids.py -b 127.0.0.1:7860 -b 127.0.0.1:7861 -b 10.0.0.2:7860*2
+    $ python3 generate_xyz_grids.py --async -q 3 --timeout 300
+    $ python3 generate_xyz_grids.py --cache_dir .xyz_cache --resume output/20230601-120000
+    $ python3 generate_xyz_grids.py --image_format jpeg --quality 85
+    $ python3 generate_xyz_grids.py --checkpoint_affinity --split_checkpoints
+    $ python3 generate_xyz_grids.py --prometheus_file /var/lib/node_exporter/textfile/xyz_grids.prom
+    $ python3 generate_xyz_grids.py --client_grid -b 127.0.0.1:7860 -b 127.0.0.1:7861 -q 2 --cache_dir .xyz_cache
+    $ python3 generate_xyz_grids.py --client_grid --max_batch_size 8
+    $ python3 generate_xyz_grids.py --plan --order largest -b 127.0.0.1:7860 -b 127.0.0.1:7861 --deadline 120
+    $ python3 generate_xyz_grids.py --local output/sd1_kotak_ep20 --max_batch_size 4
+    """
+    # The X/Y/Z Plot script only runs in the WebUI, local grids are expanded here
+    if local:
+        client_grid = True
+        from local_options import SAMPLER_SCHEDULERS
+        if sampler not in SAMPLER_SCHEDULERS:
+            raise ValueError(f'Sampler {sampler!r} has no diffusers scheduler, use one of {", ".join(SAMPLER_SCHEDULERS)}')
+
+    # datetime
+    dt = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    run_folder = resume or f'{output_folder}/{dt}'
+
+    # Count prompts, they are read lazily below
+    total = count_prompts(filename)
+    print(f'Found {total} prompt tests')
+
+    def grid_path(job):
+        seq = '{0:0>4}'.format(job.index + 1)
+        if job.tag:
+            seq = f'{seq}-{job.tag}'
+        truncated_prompt = job.p.get('prompt')[:100]
+        return f'{run_folder}/xyz_grid-{seq}-{prompt_seed(job.p, seed)}-{width}x{height}-{truncated_prompt}'
+
+    def image_info(job):
+        return build_image_info(job.p, sampler, steps, prompt_seed(job.p, seed), cfg_scale, width, height)
+
+    def job_cost(job):
+        return grid_cost(job.p, build_cell_args(job.p, prompt_seed(job.p, seed), cfg_scale, width, height, sampler, steps))
+
+    costs = {}
+    cells = {}
+
+    def plan_costs(jobs):
+        for job in jobs:
+            if (job.index, job.tag) in costs:
+                continue
+            try:
+                cells[job.index, job.tag], costs[job.index, job.tag] = job_cost(job)
+            except ValueError as e:
+                print(f'ERROR: prompt test {job.index + 1}: {e}')
+                cells[job.index, job.tag], costs[job.index, job.tag] = count_cells(job.p), 0
+
+    checkpoint = local
+    if not local and not plan and (cache_dir or checkpoint_affinity or client_grid):
+        checkpoint = fetch_options((backends or ['127.0.0.1:7860'])[0]).get('sd_model_checkpoint')
+
+    jobs = (Job(index, p, '') for index, p in enumerate(iter_prompts(filename)))
+    if plan or order != 'file':
+        # Ordering needs every prompt test at once
+        jobs = list(jobs)
+        plan_costs(jobs)
+        jobs = order_jobs(jobs, costs, order)
+    total_cells = None
+    if checkpoint_affinity:
+        # Planning needs every prompt test at once
+        jobs, before, after = plan_checkpoint_affinity(list(jobs), current=checkpoint, split=split_checkpoints)
+        total = len(jobs)
+        total_cells = sum(count_cells(job.p) for job in jobs)
+        print(f'Planned {len(jobs)} grids with {after} model switches instead of {before} ({before - after} avoided)')
+
+    if plan:
+        # Dry run: report the plan without sending anything
+        plan_costs(jobs)
+        seconds_per_unit, calibrated_runs = calibrate(find_telemetry(output_folder))
+        speeds = [1.0] if local else [parse_endpoint(endpoint)[2] for endpoint in backends or ['127.0.0.1:7860']]
+        print_plan(jobs, cells, costs, seconds_per_unit or DEFAULT_SECONDS_PER_UNIT, calibrated_runs, speeds, order, deadline * 60 if deadline else None)
+        return
+
+    # Create output folder
+    if not os.path.exists(run_folder):
+        os.makedirs(run_folder)
+
+    writer = ImageWriter(image_format, compress_level, quality)
+    extension = writer.extension
+    cache = None
+    keys = {}
+    if cache_dir:
+        cache = ResultCache(cache_dir, max_bytes=int(cache_size * 1024 ** 3), extension=extension)
+
+    telemetry = Telemetry(run_folder, total_grids=total, total_cells=total_cells, prometheus_file=prometheus_file)
+    writer.telemetry = telemetry
+
+    # Skip grids already saved by the resumed run or found in the cache, as jobs are pulled by the backends
+    skipped = {'resumed': 0, 'cached': 0}
+    # Backends number requests in the order they are pulled
+    started = {}
+    request_index = itertools.count()
+
+    def pending_jobs():
+        for job in jobs:
+            path_filename = grid_path(job)
+            if resume and os.path.exists(f'{path_filename}.{extension}') and os.path.exists(f'{path_filename}.txt'):
+                skipped['resumed'] += 1
+                telemetry.grid_skipped(cells=count_cells(job.p), index=job.index, tag=job.tag)
+                continue
+            # Grids with a random (-1) seed differ on every run, they are neither looked up nor stored
+            if cache is not None and prompt_seed(job.p, seed) != -1 and not has_random_seed_axis(job.p):
+                # Client-side grids are composited differently from the X/Y/Z Plot script, so keep them apart
+                keys[job.index, job.tag] = cache_key(build_txt2img_args(job.p, prompt_seed(job.p, seed), cfg_scale, width, height), sampler=sampler, steps=steps, checkpoint=job.p.get('checkpoint', checkpoint),
+                                      image_format=image_format, compress_level=compress_level, quality=quality, **({'client_grid': True} if client_grid else {}))
+                if cache.fetch(keys[job.index, job.tag], f'{path_filename}.{extension}'):
+                    with open(f"{path_filename}.txt", "w") as f:
+                        f.write(image_info(job))
+                    skipped['cached'] += 1
+                    telemetry.grid_skipped(cells=count_cells(job.p), index=job.index, tag=job.tag)
+                    continue
+            yield job
+
+    def cache_callback(job):
+        if (job.index, job.tag) not in keys:
+            return None
+        def callback(image_path):
+            cache.put(keys[job.index, job.tag], image_path)
+        return callback
+
+    def progress(job, cells=None):
+        print(f'Generated xyz grid {telemetry.grids + 1} out of {telemetry.total_grids} prompt tests')
+        print(telemetry.grid_done(cells=cells or count_cells(job.p), index=job.index, tag=job.tag))
+
+    def saving(job):
+        path_filename = grid_path(job)
+        print(f'Saving image as "{path_filename}.{extension}"')
+        print('')
+        return path_filename
+
+    # Server-side grids: one X/Y/Z Plot script request per prompt test
+    def grid_requests():
+        for job in pending_jobs():
+            i = next(request_index)
+            started[i] = job
+            # Cost of every request for the calibration of `--plan`
+            if (job.index, job.tag) not in costs:
+                plan_costs([job])
+            telemetry.event('planned', request=i, cost=costs[job.index, job.tag])
+            yield build_txt2img_args(job.p, prompt_seed(job.p, seed), cfg_scale, width, height)
+
+    def on_grid_result(i, images, info):
+        job = started.pop(i)
+        progress(job)
+        writer.submit(images[0], saving(job), image_info(job), cache_callback(job))
+
+    # Client-side grids: one request per unique cell, composited once every cell of a grid is in
+    cell_cache = None
+    if client_grid and cache_dir:
+        cell_cache = ResultCache(os.path.join(cache_dir, 'cells'), max_bytes=int(cache_size * 1024 ** 3), extension='png')
+    cells_lock = threading.Lock()
+    waiting = {}
+    recent = OrderedDict()
+    cell_stats = {'cells': 0, 'requests': 0, 'shared': 0, 'cached': 0}
+    rng = random.Random()
+    if local:
+        from local_backend import LocalBackend
+        from local_options import unsupported_axes
+
+    def fill(grid, position, image_bytes):
+        grid['cells'][position] = image_bytes
+        grid['remaining'] -= 1
+        if grid['remaining'] == 0:
+            job = grid['job']
+            progress(job, cells=len(grid['cells']))
+            writer.submit_composite(grid['cells'], grid['shape'], grid['labels'], saving(job), image_info(job), cache_callback(job))
+
+    def cell_requests():
+        for job in pending_jobs():
+            job_seed = prompt_seed(job.p, seed)
+            if job_seed == -1:
+                job_seed = rng.randrange(4294967294)
+            base_request = build_cell_args(job.p, job_seed, cfg_scale, width, height, sampler, steps, checkpoint)
+            try:
+                # Checked before any cell is sent, these would fail in the backend
+                unsupported = unsupported_axes(job.p, local) if local else []
+                if unsupported:
+                    raise ValueError(f'{", ".join(unsupported)} not supported by the local backend')
+                shape, labels, cells = expand_grid(job.p, base_request, rng)
+            except ValueError as e:
+                raise ValueError(f'Prompt test {job.index + 1}: {e}')
+            grid = {'job': job, 'shape': shape, 'labels': labels, 'cells': [None] * len(cells), 'remaining': len(cells)}
+            missing = []
+            for position, request in enumerate(cells):
+                key = cache_key(request)
+                with cells_lock:
+                    cell_stats['cells'] += 1
+                    if key in waiting:
+                        # Identical cell already in flight for another grid
+                        waiting[key].append((grid, position))
+                        cell_stats['shared'] += 1
+                        continue
+                    image_bytes = recent.get(key)
+                    if image_bytes is None and cell_cache is not None:
+                        image_bytes = cell_cache.read(key)
+                        cell_stats['cached'] += image_bytes is not None
+                    else:
+                        cell_stats['shared'] += image_bytes is not None
+                    if image_bytes is not None:
+                        fill(grid, position, image_bytes)
+                        continue
+                    waiting[key] = [(grid, position)]
+                missing.append((key, request))
+            # The local backend takes a seed and prompt per image, the WebUI increments the seed along a batch
+            for cell_keys, request in (batch_cells if local else batch_seed_cells)(missing, max_batch_size):
+                with cells_lock:
+                    i = next(request_index)
+                    started[i] = cell_keys
+                    cell_stats['requests'] += 1
+                telemetry.event('planned', request=i, cost=request_cost(request))
+                yield request
+
+    def on_cell_result(i, images, info):
+        with cells_lock:
+            cell_keys = started.pop(i)
+            for key, image_bytes in zip(cell_keys, batch_images(images, info, len(cell_keys))):
+                if cell_cache is not None:
+                    cell_cache.put_bytes(key, image_bytes)
+                recent[key] = image_bytes
+                while len(recent) > RECENT_CELLS:
+                    recent.popitem(last=False)
+                for grid, position in waiting.pop(key):
+                    fill(grid, position, image_bytes)
+
+    requests, on_image = (cell_requests(), on_cell_result) if client_grid else (grid_requests(), on_grid_result)
+
+    # Generate grid for each prompt
+    local_backend = None
+    try:
+        if local:
+            # One pipeline call at a time, sampler and steps are set per request
+            local_backend = LocalBackend(local, device=device, embedding_cache_dir=os.path.join(cache_dir, 'embeddings') if cache_dir else None)
+            pool = BackendPool([local_backend], max_retries=retries)
+            payloads = (dict(dict(sampler_name=sampler, steps=steps), **request) for request in requests)
+            for i, result in pool.map(payloads, fn=LocalBackend.run, telemetry=telemetry):
+                on_image(i, result.images, result.info)
+        elif use_async:
+            from async_client import run, decode_image_bytes
+
+            def on_result(i, images, response):
+                on_image(i, images, response.get('info'))
 
+            payloads = (dict(dict(sampler_name=sampler, steps=steps), **request) for request in requests)
+            run(backends or ['127.0.0.1:7860'], payloads, on_result, in_flight=max_in_flight, queue_size=queue_size, timeout=timeout, retries=retries, decode=decode_image_bytes, telemetry=telemetry)
+        else:
+            # Instantiate the backend pool
+            pool = BackendPool.from_endpoints(backends or ['127.0.0.1:7860'],
+                                max_in_flight=max_in_flight,
+                                max_retries=retries,
+                                sampler=sampler,
+                                steps=steps
+                                )
+            for i, result in pool.map(requests, telemetry=telemetry):
+                with telemetry.time('decode', request=i):
+                    images = [base64.b64decode(image) for image in result.json['images']]
+                on_image(i, images, result.json.get('info'))
+    finally:
+        # Flush pending writes, also on Ctrl-C
+        writer.close()
+        if skipped['resumed'] or skipped['cached']:
+            print(f'Skipped {skipped["resumed"]} grids already in `{run_folder}` and {skipped["cached"]} grids found in the cache')
+        if client_grid:
+            print(f'Ran {cell_stats["requests"]} requests for {cell_stats["cells"]} grid cells ({cell_stats["shared"]} shared between grids, {cell_stats["cached"]} found in the cache)')
+        if local_backend:
+            stats = local_backend.embeddings.stats
+            print(f'Encoded {stats["encoded"]} prompts, reused {stats["memory"]} prompt embeddings from memory and {stats["disk"]} from the cache')
+        telemetry.summary()
 
 if __name__ == '__main__':
     # Parse args
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--input_filename', type=str, default='xyz_prompts.json', help="The name of the JSON file (default: 'xyz_prompts.json')")
+    parser.add_argument('-i', '--input_filename', type=str, default=None, help="The name of the JSONL or JSON prompt file (default: 'xyz_prompts.jsonl', or 'xyz_prompts.json' if only that one exists)")
     parser.add_argument('-O', '--output_folder', type=str, default='output', help='Folder where images and text files will be saved to ( default: output/ )')
     parser.add_argument('-S', '--sampler', type=str, default='Euler a', help='Sampler (default: Euler a)')
     parser.add_argument('-t', '--steps', type=int, default=20, help='Steps value (default: 20)')
@@ -146,9 +457,31 @@ if __name__ == '__main__':
     parser.add_argument('-c', '--cfg_scale', type=float, default=7.0, help='CFG value (default: 7.0)')
     parser.add_argument('-W', '--width', type=int, default=512, help='Width value (default: 512)')
     parser.add_argument('-H', '--height', type=int, default=512, help='Height value (default: 512)')
+    parser.add_argument('-b', '--backend', action='append', default=None, help="WebUI backend as host:port[*weight], repeat for several backends (default: 127.0.0.1:7860)")
+    parser.add_argument('-q', '--max_in_flight', type=int, default=1, help='Maximum number of requests in flight per backend, scaled by its *weight (default: 1)')
+    parser.add_argument('--async', dest='use_async', action='store_true', default=False, help='Use the asyncio client with a keep-alive connection pool and pipelined decode/write stages (default: False)')
+    parser.add_argument('--queue_size', type=int, default=4, help='Size of the queues between the request, decode and write stages in async mode (default: 4)')
+    parser.add_argument('--timeout', type=float, default=600, help='Per-request timeout in seconds in async mode (default: 600)')
+    parser.add_argument('--resume', type=str, default=None, help='Continue an interrupted run in this run folder, skipping grids already saved (default: None)')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Folder of the content-addressed grid cache, disabled if not set (default: None)')
+    parser.add_argument('--cache_size', type=float, default=10, help='Maximum size of the grid cache in GB (default: 10)')
+    parser.add_argument('-F', '--image_format', type=str, default='png', choices=['png', 'webp', 'jpeg'], help="Output image format, 'webp' is lossless and 'jpeg' meant for previews (default: png)")
+    parser.add_argument('--compress_level', type=int, default=None, help='PNG compression level (0-9) or WebP method (0-6), PNG images are kept as sent by the server if not set (default: None)')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality (default: 90)')
+    parser.add_argument('--checkpoint_affinity', action='store_true', default=False, help='Reorder prompt tests so the work for each checkpoint runs back to back (default: False)')
+    parser.add_argument('--split_checkpoints', action='store_true', default=False, help='With --checkpoint_affinity, split grids with a "Checkpoint name" axis into one grid per checkpoint (default: False)')
+    parser.add_argument('--prometheus_file', type=str, default=None, help='Export run metrics to this Prometheus node exporter textfile (default: None)')
+    parser.add_argument('--retries', type=int, default=3, help='Number of retries of a failed request (default: 3)')
+    parser.add_argument('--client_grid', action='store_true', default=False, help='Expand the axes into one request per grid cell and composite the grids locally (default: False)')
+    parser.add_argument('--plan', action='store_true', default=False, help='Only report the number of images and the estimated run time, without sending anything (default: False)')
+    parser.add_argument('--order', type=str, default='file', choices=ORDERS, help="Run prompt tests in file order, 'shortest' first or 'largest' first by estimated cost (default: file)")
+    parser.add_argument('--deadline', type=float, default=None, help='With --plan, report how many grids are done within this many minutes (default: None)')
+    parser.add_argument('--max_batch_size', type=int, default=1, help='With --client_grid, generate cells that only differ by consecutive seeds (by seed or prompt with --local) in batches of up to this many images (default: 1)')
+    parser.add_argument('--local', type=str, default=None, help='Render in this process with diffusers from this diffusers checkpoint folder instead of WebUI backends, implies --client_grid (default: None)')
+    parser.add_argument('--device', type=str, default=None, help="Device of --local, e.g. 'cuda' or 'cpu' (default: cuda if available)")
     args = parser.parse_args()
 
-    filename = args.input_filename
+    filename = args.input_filename or default_prompt_file()
     output_folder = args.output_folder
     sampler = args.sampler
     steps = args.steps
@@ -156,6 +489,28 @@ if __name__ == '__main__':
     cfg_scale = args.cfg_scale
     width = args.width
     height = args.height
+    backends = args.backend
+    max_in_flight = args.max_in_flight
+    use_async = args.use_async
+    queue_size = args.queue_size
+    timeout = args.timeout
+    retries = args.retries
+    resume = args.resume
+    cache_dir = args.cache_dir
+    cache_size = args.cache_size
+    image_format = args.image_format
+    compress_level = args.compress_level
+    quality = args.quality
+    checkpoint_affinity = args.checkpoint_affinity
+    split_checkpoints = args.split_checkpoints
+    prometheus_file = args.prometheus_file
+    client_grid = args.client_grid
+    max_batch_size = args.max_batch_size
+    plan = args.plan
+    order = args.order
+    deadline = args.deadline
+    local = args.local
+    device = args.device
 
     # Run main
-    main(filename, output_folder, sampler, steps, seed, cfg_scale, width, height)
+    main(filename, output_folder, sampler, steps, seed, cfg_scale, width, height, backends, max_in_flight, use_async, queue_size, timeout, retries, resume, cache_dir, cache_size, image_format, compress_level, quality, checkpoint_affinity, split_checkpoints, prometheus_file, client_grid, max_batch_size, plan, order, deadline, local, device)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import io
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+
+BACKGROUND = 255
+TEXT_COLOR = (0, 0, 0)
+
+
+def load_font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1 has a single bitmap font size
+        return ImageFont.load_default()
+
+def wrap_text(draw, text, font, max_width):
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = f'{line} {word}' if line else word
+            if line and draw.textlength(candidate, font=font) > max_width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+def line_height(font):
+    left, top, right, bottom = font.getbbox('Ag')
+    return bottom + 4
+
+def add_legends(tile, cell_size, x_labels, y_labels, font):
+    """
+    Add a white margin with the x labels above the columns and the y labels left of the rows of a tiled grid.
+    """
+    cell_height, cell_width = cell_size
+    draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    height = line_height(font)
+    pad = height // 2
+    x_lines = [wrap_text(draw, label, font, cell_width - 2 * pad) for label in x_labels]
+    top = (max(len(lines) for lines in x_lines) * height + 2 * pad) if any(x_labels) else 0
+    y_lines = [wrap_text(draw, label, font, cell_width - 2 * pad) for label in y_labels]
+    left = (max(draw.textlength(line, font=font) for lines in y_lines for line in lines) + 2 * pad) if any(y_labels) else 0
+    left = int(left)
+
+    canvas = np.full((tile.shape[0] + top, tile.shape[1] + left, 3), BACKGROUND, dtype=np.uint8)
+    canvas[top:, left:] = tile
+    image = Image.fromarray(canvas)
+    draw = ImageDraw.Draw(image)
+    if top:
+        for column, lines in enumerate(x_lines):
+            for row, line in enumerate(lines):
+                x = left + column * cell_width + (cell_width - draw.textlength(line, font=font)) / 2
+                draw.text((x, pad + row * height), line, font=font, fill=TEXT_COLOR)
+    if left:
+        for row, lines in enumerate(y_lines):
+            y = top + row * cell_height + (cell_height - len(lines) * height) / 2
+            for number, line in enumerate(lines):
+                draw.text((pad, y + number * height), line, font=font, fill=TEXT_COLOR)
+    return np.asarray(image)
+
+def compose_grid(cells, shape, labels, margin=0):
+    """
+    Tile encoded cell images into an X/Y/Z grid image with legends, like the WebUI X/Y/Z Plot script.
+
+    `cells` are encoded images in z, y, x order, `shape` is `(z, y, x)` and `labels` the x, y and z legend labels
+    (empty strings for "Nothing" axes). Every cell is resized to the size of the first one. Each z value gets one
+    x/y sub-grid, placed side by side under its z label. Returns a PIL image.
+    """
+    nz, ny, nx = shape
+    x_labels, y_labels, z_labels = labels
+    images = [Image.open(io.BytesIO(cell)).convert('RGB') for cell in cells]
+    width, height = images[0].size
+    arrays = [np.asarray(image if image.size == (width, height) else image.resize((width, height))) for image in images]
+
+    # (z, y, x, h, w, c) -> one (y * h, x * w, c) tile per z value
+    tiles = np.stack(arrays).reshape(nz, ny, nx, height, width, 3).transpose(0, 1, 3, 2, 4, 5).reshape(nz, ny * height, nx * width, 3)
+    font = load_font(max(16, min(width, height) // 20))
+    subgrids = [add_legends(tile, (height, width), x_labels, y_labels, font) for tile in tiles]
+    if nz == 1:
+        return Image.fromarray(subgrids[0])
+
+    # Sub-grids side by side with `margin` pixels between them, z labels above
+    if margin:
+        spacer = np.full((subgrids[0].shape[0], margin, 3), BACKGROUND, dtype=np.uint8)
+        subgrids = [part for subgrid in subgrids for part in (subgrid, spacer)][:-1]
+        z_labels = [part for label in z_labels for part in (label, '')][:-1]
+    row = np.concatenate(subgrids, axis=1)
+    z_widths = [subgrid.shape[1] for subgrid in subgrids]
+    if not any(z_labels):
+        return Image.fromarray(row)
+    draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    text_height = line_height(font)
+    pad = text_height // 2
+    z_lines = [wrap_text(draw, label, font, max(z_width - 2 * pad, 1)) if label else [] for label, z_width in zip(z_labels, z_widths)]
+    top = max(len(lines) for lines in z_lines) * text_height + 2 * pad
+    canvas = np.full((row.shape[0] + top, row.shape[1], 3), BACKGROUND, dtype=np.uint8)
+    canvas[top:] = row
+    image = Image.fromarray(canvas)
+    draw = ImageDraw.Draw(image)
+    offset = 0
+    for lines, z_width in zip(z_lines, z_widths):
+        for number, line in enumerate(lines):
+            x = offset + (z_width - draw.textlength(line, font=font)) / 2
+            draw.text((x, pad + number * text_height), line, font=font, fill=TEXT_COLOR)
+        offset += z_width
+    return image
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import time
+import random
+import threading
+import weakref
+from collections import namedtuple
+
+import torch
+import diffusers
+from model_cache import PipelineCache, DEFAULT_MAX_BYTES
+from embedding_cache import EmbeddingCache
+from local_options import SAMPLER_SCHEDULERS, resolve_checkpoint
+
+
+LocalResult = namedtuple('LocalResult', ['images', 'info'])
+
+
+def encode_png(image):
+    # Cells are decoded again for the grid, favor speed over size
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+class LocalBackend:
+    """
+    Render txt2img requests in this process with diffusers instead of a WebUI server.
+
+    Pipelines are loaded once per checkpoint by a `PipelineCache` (like the evaluation cell of the training
+    notebook) and requests are mapped onto pipeline calls: steps, CFG scale, size, seed (one generator per image),
+    prompt and negative prompt, the sampler through a scheduler swap, the `sd_model_checkpoint` override (a diffusers
+    checkpoint folder, or the name of one next to `checkpoint`), the `CLIP_stop_at_last_layers` override and eta.
+    Batched requests (from `batch_cells`) give one seed and prompt per image. Images are returned as PNG bytes.
+
+    Prompts go through an `EmbeddingCache` (also stored in `embedding_cache_dir` if given) and are passed to the
+    pipeline as embeddings, so a prompt shared by the cells of a grid is only encoded once per text encoder.
+
+    Has the same scheduling interface as `Backend`, so a `BackendPool` can drive it.
+
+    Example:
+
+    $ pool = BackendPool([LocalBackend('output/sd1_kotak_ep20')])
+    $ for index, result in pool.map(requests, fn=LocalBackend.run):
+    $     ...
+    """
+
+    def __init__(self, checkpoint, device=None, dtype=None, max_bytes=DEFAULT_MAX_BYTES, embedding_cache_dir=None):
+        self.checkpoint = checkpoint
+        self.checkpoints_dir = os.path.dirname(os.path.abspath(checkpoint))
+        self.pipelines = PipelineCache(max_bytes=max_bytes, device=device, dtype=dtype)
+        self.device = self.pipelines.device
+        self.embeddings = EmbeddingCache(cache_dir=embedding_cache_dir)
+        self.weight = 1.0
+        self.max_in_flight = 1
+        self.local = threading.local()
+        # Pipeline -> its own scheduler config and the schedulers made from it
+        self.schedulers = weakref.WeakKeyDictionary()
+        self.outstanding = 0
+        self.completed = 0
+        self.failures = 0
+        self.healthy = True
+
+    def __repr__(self):
+        return f'local:{self.device}'
+
+    def last_process_time(self):
+        return getattr(self.local, 'process_time', None)
+
+    def check_health(self, timeout=5):
+        self.healthy = True
+        return self.healthy
+
+    def score(self):
+        return (self.outstanding + 1) / self.weight
+
+    @staticmethod
+    def run(backend, request):
+        return backend.txt2img(**request)
+
+    def resolve(self, checkpoint):
+        """
+        Return the folder of a diffusers checkpoint given as a path or as a name of a folder next to the default one.
+        """
+        return resolve_checkpoint(checkpoint, self.checkpoints_dir)
+
+    def scheduler(self, pipe, sampler):
+        if sampler not in SAMPLER_SCHEDULERS:
+            raise ValueError(f'Sampler {sampler!r} has no diffusers scheduler, use one of {", ".join(SAMPLER_SCHEDULERS)}')
+        if pipe not in self.schedulers:
+            self.schedulers[pipe] = (pipe.scheduler.config, {})
+        config, schedulers = self.schedulers[pipe]
+        if sampler not in schedulers:
+            class_name, options = SAMPLER_SCHEDULERS[sampler]
+            schedulers[sampler] = getattr(diffusers, class_name).from_config(config, **options)
+        return schedulers[sampler]
+
+    def txt2img(self, prompt='', negative_prompt='', seed=-1, seeds=None, batch_size=1, steps=20, cfg_scale=7.0, width=512, height=512, sampler_name='Euler a', eta=None, override_settings=None, **ignored):
+        """
+        Run one txt2img request and return its images as PNG bytes with the seeds in a WebUI-like info string.
+        """
+        settings = override_settings or {}
+        pipe = self.pipelines.get(self.resolve(settings.get('sd_model_checkpoint') or self.checkpoint))
+        pipe.scheduler = self.scheduler(pipe, sampler_name)
+        pipe.set_progress_bar_config(disable=True)
+        if seeds is None:
+            seed = int(seed) if int(seed) != -1 else random.randrange(4294967294)
+            # Like the WebUI, the images of a batch get consecutive seeds
+            seeds = [seed + i for i in range(int(batch_size))]
+        prompts = prompt if isinstance(prompt, list) else [prompt] * len(seeds)
+        negative_prompts = negative_prompt if isinstance(negative_prompt, list) else [negative_prompt] * len(seeds)
+        kwargs = {}
+        if eta is not None:
+            kwargs['eta'] = eta
+        # WebUI counts the last layer as 1, diffusers counts skipped layers
+        clip_skip = int(settings.get('CLIP_stop_at_last_layers') or 1) - 1
+
+        start = time.perf_counter()
+        with torch.inference_mode(), torch.autocast(self.device.split(':')[0], enabled=self.device.startswith('cuda')):
+            embeds = self.embeddings.prompt_embeds(pipe, self.pipelines.encoder_key(pipe), prompts, negative_prompts, clip_skip)
+            images = pipe(
+                **embeds,
+                num_inference_steps=int(steps),
+                guidance_scale=float(cfg_scale),
+                width=int(width),
+                height=int(height),
+                generator=[torch.Generator(self.device).manual_seed(int(s)) for s in seeds],
+                **kwargs
+            ).images
+        self.local.process_time = time.perf_counter() - start
+        return LocalResult([encode_png(image) for image in images], json.dumps({'all_seeds': seeds, 'index_of_first_image': 0}))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import os
+import re
+from xyz_plot import parse_axis
+
+
+# Options of `local_backend.py` that are checked before a local run starts, without importing PyTorch or diffusers
+
+# File at the root of every diffusers checkpoint folder
+MODEL_INDEX_FILENAME = 'model_index.json'
+# WebUI sampler: diffusers scheduler class and options
+SAMPLER_SCHEDULERS = {
+    'Euler a': ('EulerAncestralDiscreteScheduler', {}),
+    'Euler': ('EulerDiscreteScheduler', {}),
+    'LMS': ('LMSDiscreteScheduler', {}),
+    'LMS Karras': ('LMSDiscreteScheduler', {'use_karras_sigmas': True}),
+    'Heun': ('HeunDiscreteScheduler', {}),
+    'DPM2': ('KDPM2DiscreteScheduler', {}),
+    'DPM2 Karras': ('KDPM2DiscreteScheduler', {'use_karras_sigmas': True}),
+    'DPM2 a': ('KDPM2AncestralDiscreteScheduler', {}),
+    'DPM2 a Karras': ('KDPM2AncestralDiscreteScheduler', {'use_karras_sigmas': True}),
+    'DPM++ 2M': ('DPMSolverMultistepScheduler', {}),
+    'DPM++ 2M Karras': ('DPMSolverMultistepScheduler', {'use_karras_sigmas': True}),
+    'DPM++ 2M SDE': ('DPMSolverMultistepScheduler', {'algorithm_type': 'sde-dpmsolver++'}),
+    'DPM++ 2M SDE Karras': ('DPMSolverMultistepScheduler', {'algorithm_type': 'sde-dpmsolver++', 'use_karras_sigmas': True}),
+    'DPM++ SDE': ('DPMSolverSinglestepScheduler', {}),
+    'DPM++ SDE Karras': ('DPMSolverSinglestepScheduler', {'use_karras_sigmas': True}),
+    'DDIM': ('DDIMScheduler', {}),
+    'PLMS': ('PNDMScheduler', {}),
+    'UniPC': ('UniPCMultistepScheduler', {}),
+}
+# X/Y/Z axis types that map onto pipeline calls
+LOCAL_AXIS_TYPES = ['Nothing', 'Seed', 'Steps', 'CFG Scale', 'Prompt S/R', 'Prompt order', 'Sampler', 'Checkpoint name', 'Clip skip', 'Eta']
+# WebUI checkpoint titles end with the short hash of the model
+RE_CHECKPOINT_HASH = re.compile(r'\s*\[[0-9a-fA-F]+\]$')
+
+
+def resolve_checkpoint(checkpoint, checkpoints_dir):
+    """
+    Return the folder of a diffusers checkpoint given as a path or as a name of a folder in `checkpoints_dir`.
+    """
+    name = RE_CHECKPOINT_HASH.sub('', checkpoint)
+    for candidate in [name, os.path.join(checkpoints_dir, name), os.path.join(checkpoints_dir, os.path.splitext(name)[0])]:
+        if os.path.isfile(os.path.join(candidate, MODEL_INDEX_FILENAME)):
+            return candidate
+    raise ValueError(f'Checkpoint {checkpoint!r} is not a diffusers checkpoint folder (nor one in {checkpoints_dir})')
+
+def unsupported_axes(p, checkpoint=None):
+    """
+    Return what the local backend cannot run in a prompt test: axis types it does not support, Sampler values
+    without a diffusers scheduler and, given the default `checkpoint`, Checkpoint name values that are not diffusers
+    checkpoint folders. Raises ValueError for invalid axis values.
+    """
+    unsupported = []
+    for axis in ['x', 'y', 'z']:
+        axis_type = p.get(f'{axis}_axis_type') or 'Nothing'
+        if axis_type not in LOCAL_AXIS_TYPES:
+            unsupported.append(f'axis type {axis_type!r}')
+        elif axis_type == 'Sampler':
+            unsupported.extend(f'sampler {value!r}' for value in parse_axis(axis_type, p.get(f'{axis}_axis_values')) if value not in SAMPLER_SCHEDULERS)
+        elif axis_type == 'Checkpoint name' and checkpoint:
+            for value in parse_axis(axis_type, p.get(f'{axis}_axis_values')):
+                try:
+                    resolve_checkpoint(value, os.path.dirname(os.path.abspath(checkpoint)))
+                except ValueError:
+                    unsupported.append(f'checkpoint {value!r}')
+    return unsupported
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import argparse
+from scanner import DEFAULT_WORKERS, classify, map_bounded
+
+
+MANIFEST_DIR = '.l2t'
+MANIFEST_FILENAME = 'manifest.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT,
+    name TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    format TEXT,
+    caption TEXT
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+'''
+
+
+class Manifest:
+    """
+    Persistent index of the images and caption files of a dataset directory.
+
+    The index is a SQLite database stored in `<root>/.l2t/manifest.sqlite` and records, for every image and
+    `.txt` file, its path, size, mtime, detected image format and caption text. A refresh only lists the
+    directories whose mtime changed since the last run and only sniffs the files whose size or mtime changed,
+    so the image headers of an unchanged dataset are never read twice. Changed files are sniffed in a bounded
+    thread pool, or classified by extension only with `trust_extensions`.
+
+    Editing a caption in place does not always touch the mtime of its directory, use `refresh(full=True)`
+    (`--rebuild` on the command line) after such edits.
+
+    Example:
+
+    $ with Manifest('input') as manifest:
+    $     manifest.refresh()
+    $     manifest.count_images()
+    $ 109
+    """
+
+    def __init__(self, root, trust_extensions=False, workers=DEFAULT_WORKERS):
+        self.root = root
+        self.trust_extensions = trust_extensions
+        self.workers = workers
+        manifest_dir = os.path.join(root, MANIFEST_DIR)
+        os.makedirs(manifest_dir, exist_ok=True)
+        self.path = os.path.join(manifest_dir, MANIFEST_FILENAME)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def refresh(self, full=False):
+        """
+        Bring the index up to date with the directory tree and return the number of rescanned directories.
+        """
+        known = {}
+        children = {}
+        for path, parent, mtime_ns in self.db.execute('SELECT path, parent, mtime_ns FROM dirs'):
+            known[path] = mtime_ns
+            children.setdefault(parent, []).append(path)
+
+        rescanned = 0
+        seen = set()
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                mtime_ns = os.stat(os.path.join(self.root, rel_dir)).st_mtime_ns
+            except OSError:
+                continue
+            seen.add(rel_dir)
+            if not full and known.get(rel_dir) == mtime_ns:
+                stack.extend(children.get(rel_dir, []))
+            else:
+                stack.extend(self._rescan_dir(rel_dir, mtime_ns))
+                rescanned += 1
+
+        for rel_dir in known.keys() - seen:
+            self.db.execute('DELETE FROM dirs WHERE path = ?', (rel_dir,))
+            self.db.execute('DELETE FROM files WHERE dir = ?', (rel_dir,))
+        self.db.commit()
+        return rescanned
+
+    def _rescan_dir(self, rel_dir, mtime_ns):
+        existing = {}
+        for name, size, file_mtime_ns in self.db.execute('SELECT name, size, mtime_ns FROM files WHERE dir = ?', (rel_dir,)):
+            existing[name] = (size, file_mtime_ns)
+
+        subdirs = []
+        current = set()
+        changed = []
+        with os.scandir(os.path.join(self.root, rel_dir)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink() and not (rel_dir == '' and entry.name == MANIFEST_DIR):
+                        subdirs.append(os.path.join(rel_dir, entry.name))
+                    continue
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                if existing.get(entry.name) == (st.st_size, st.st_mtime_ns):
+                    current.add(entry.name)
+                else:
+                    changed.append((entry.name, entry.path, st))
+
+        def classify_changed(item):
+            return classify(item[1], self.trust_extensions)
+
+        for (name, _, st), record in zip(changed, map_bounded(classify_changed, changed, self.workers)):
+            if record is None:
+                continue
+            self.db.execute(
+                'INSERT OR REPLACE INTO files (path, dir, name, size, mtime_ns, format, caption) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (os.path.join(rel_dir, name), rel_dir, name, st.st_size, st.st_mtime_ns, record.format, record.caption)
+            )
+            current.add(name)
+
+        for name in existing.keys() - current:
+            self.db.execute('DELETE FROM files WHERE path = ?', (os.path.join(rel_dir, name),))
+        parent = os.path.dirname(rel_dir) if rel_dir else None
+        self.db.execute('INSERT OR REPLACE INTO dirs (path, parent, mtime_ns) VALUES (?, ?, ?)', (rel_dir, parent, mtime_ns))
+        return subdirs
+
+    def count_images(self):
+        return self.db.execute('SELECT COUNT(*) FROM files WHERE format IS NOT NULL').fetchone()[0]
+
+    def image_filenames(self):
+        return [name for (name,) in self.db.execute('SELECT name FROM files WHERE format IS NOT NULL ORDER BY path')]
+
+    def captions(self):
+        return [caption for (caption,) in self.db.execute('SELECT caption FROM files WHERE caption IS NOT NULL ORDER BY path')]
+
+    def iter_images(self):
+        """
+        Stream (path, filename) for every image without loading the whole index in memory.
+        """
+        for path, name in self.db.execute('SELECT path, name FROM files WHERE format IS NOT NULL'):
+            yield os.path.join(self.root, path), name
+
+    def iter_captions(self):
+        """
+        Stream (path, caption) for every caption file without loading the whole index in memory.
+        """
+        for path, caption in self.db.execute('SELECT path, caption FROM files WHERE caption IS NOT NULL'):
+            yield os.path.join(self.root, path), caption
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='Build or update the scan manifest of a dataset directory.')
+    parser.add_argument('-i', '--input_directory', type=str, default='input', help="The dataset folder (default: 'input')")
+    parser.add_argument('-e', '--trust_extensions', action='store_true', default=False, help='Detect images from their file extension without opening them. (default: False)')
+    parser.add_argument('--rebuild', action='store_true', default=False, help='Rescan every directory instead of only the changed ones. (default: False)')
+    args = parser.parse_args()
+
+    with Manifest(args.input_directory, trust_extensions=args.trust_extensions) as manifest:
+        rescanned = manifest.refresh(full=args.rebuild)
+        print(f'Rescanned {rescanned} directories, {manifest.count_images()} images and {len(manifest.captions())} captions in `{manifest.path}`')
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import os
+import gc
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+
+import torch
+from diffusers import StableDiffusionPipeline, AutoencoderKL, UNet2DConditionModel, DDIMScheduler, EulerAncestralDiscreteScheduler
+from transformers import CLIPTextModel, CLIPTokenizer
+
+
+DEFAULT_MAX_BYTES = 8 * 1024 ** 3
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+MODEL_INDEX_FILENAME = 'model_index.json'
+
+# Components loaded from the subfolders of a diffusers checkpoint, shared by checkpoints whose files hash the same
+COMPONENTS = {
+    'text_encoder': lambda path: CLIPTextModel.from_pretrained(path, subfolder='text_encoder'),
+    'vae': lambda path: AutoencoderKL.from_pretrained(path, subfolder='vae'),
+    'unet': lambda path: UNet2DConditionModel.from_pretrained(path, subfolder='unet'),
+    'tokenizer': lambda path: CLIPTokenizer.from_pretrained(path, subfolder='tokenizer', use_fast=False),
+}
+
+
+def default_device():
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def checkpoint_mtime(path):
+    return os.stat(os.path.join(path, MODEL_INDEX_FILENAME)).st_mtime_ns
+
+def file_hash(path, known=None):
+    """
+    Return the SHA-256 of a file. `known` is a dict caching hashes by path, size and mtime.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if known is not None and key in known:
+        return known[key]
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    if known is not None:
+        known[key] = sha256.hexdigest()
+    return sha256.hexdigest()
+
+def folder_hash(folder, known=None):
+    """
+    Return the SHA-256 of the names and contents of the files of a folder.
+    """
+    sha256 = hashlib.sha256()
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            sha256.update(os.path.relpath(path, folder).encode('utf-8') + b'\0')
+            sha256.update(file_hash(path, known).encode('utf-8'))
+    return sha256.hexdigest()
+
+def folder_size(folder):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(folder) for name in files)
+
+def module_bytes(component):
+    if not isinstance(component, torch.nn.Module):
+        return 0
+    return sum(tensor.numel() * tensor.element_size() for tensor in itertools.chain(component.parameters(), component.buffers()))
+
+
+class PipelineCache:
+    """
+    LRU cache of `StableDiffusionPipeline`s loaded from diffusers checkpoint folders, with a memory budget.
+
+    Pipelines are keyed by checkpoint path and the mtime of its `model_index.json`, so a checkpoint saved again at
+    the same path is reloaded. Components (text encoder, vae, unet, tokenizer) are identified by the hash of their
+    files and loaded once: checkpoints of a training run that share a VAE or a tokenizer share the same object.
+    When the loaded components go over `max_bytes`, the least recently used pipelines are evicted (the pipeline
+    being loaded is always kept, even if it is larger than the budget). Each pipeline gets its own scheduler,
+    Euler a like the evaluation cell of the training notebook.
+
+    Runs on `device` (CUDA if available, else CPU), with the components cast to `dtype` if given.
+
+    Example:
+
+    $ pipelines = PipelineCache(max_bytes=12 * 1024 ** 3)
+    $ pipe = pipelines.get('output/sd1_kotak_ep20')
+    $ image = pipe('a photo of kotak', num_inference_steps=30).images[0]
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, device=None, dtype=None):
+        self.max_bytes = max_bytes
+        self.device = device or default_device()
+        self.dtype = dtype
+        # (path, mtime) -> (pipeline, {component name: component hash})
+        self.pipelines = OrderedDict()
+        # component hash -> [component, number of pipelines using it, bytes]
+        self.components = {}
+        self.file_hashes = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.pipelines)
+
+    @property
+    def total_bytes(self):
+        return sum(nbytes for _, _, nbytes in self.components.values())
+
+    def get(self, path):
+        """
+        Return the pipeline of a diffusers checkpoint folder, loading it (and evicting others) on a cache miss.
+        """
+        path = os.path.abspath(path)
+        key = (path, checkpoint_mtime(path))
+        with self.lock:
+            if key in self.pipelines:
+                self.pipelines.move_to_end(key)
+                return self.pipelines[key][0]
+            hashes = {name: f'{name}:{folder_hash(os.path.join(path, name), self.file_hashes)}' for name in COMPONENTS}
+            missing = [name for name in COMPONENTS if hashes[name] not in self.components]
+            # Make room before loading, estimating the new components by their size on disk
+            self.evict(sum(folder_size(os.path.join(path, name)) for name in missing))
+            missing = [name for name in COMPONENTS if hashes[name] not in self.components]
+
+            loaded = {}
+            for name in missing:
+                component = COMPONENTS[name](path)
+                if isinstance(component, torch.nn.Module):
+                    component.eval()
+                    component.to(device=self.device, dtype=self.dtype)
+                loaded[name] = component
+            for name in missing:
+                self.components[hashes[name]] = [loaded[name], 0, module_bytes(loaded[name])]
+            for component_hash in hashes.values():
+                self.components[component_hash][1] += 1
+            parts = {name: self.components[hashes[name]][0] for name in COMPONENTS}
+
+            scheduler = DDIMScheduler.from_pretrained(path, subfolder='scheduler')
+            pipe = StableDiffusionPipeline(
+                vae=parts['vae'],
+                text_encoder=parts['text_encoder'],
+                tokenizer=parts['tokenizer'],
+                unet=parts['unet'],
+                scheduler=EulerAncestralDiscreteScheduler.from_config(scheduler.config),
+                safety_checker=None,  # save vram
+                requires_safety_checker=None,  # avoid nag
+                feature_extractor=None,  # must be none if no safety checker
+            )
+            self.pipelines[key] = (pipe, hashes)
+            # Older versions of this checkpoint will not be used again, their unchanged components are kept
+            for old_key in [old_key for old_key in self.pipelines if old_key[0] == path and old_key != key]:
+                self.drop(old_key)
+            self.evict(keep=key)
+            return pipe
+
+    def component_hash(self, pipe, name):
+        """
+        Return the hash of a component of a cached pipeline, e.g. to key caches of text encoder outputs.
+        """
+        with self.lock:
+            for cached_pipe, hashes in self.pipelines.values():
+                if cached_pipe is pipe:
+                    return hashes[name]
+        raise KeyError('Pipeline not in the cache')
+
+    def encoder_key(self, pipe):
+        """
+        Return a key of the text encoder and tokenizer of a cached pipeline, for `EmbeddingCache`.
+        """
+        return f'{self.component_hash(pipe, "text_encoder")}|{self.component_hash(pipe, "tokenizer")}'
+
+    def evict(self, needed=0, keep=None):
+        """
+        Drop least recently used pipelines until the loaded components and `needed` bytes fit in the budget.
+        """
+        with self.lock:
+            while self.total_bytes + needed > self.max_bytes:
+                candidates = [key for key in self.pipelines if key != keep]
+                if not candidates:
+                    break
+                self.drop(candidates[0])
+
+    def drop(self, key):
+        with self.lock:
+            pipe, hashes = self.pipelines.pop(key)
+            for component_hash in hashes.values():
+                self.components[component_hash][1] -= 1
+                if self.components[component_hash][1] == 0:
+                    del self.components[component_hash]
+            del pipe
+            gc.collect()
+            if str(self.device).startswith('cuda'):
+                torch.cuda.empty_cache()
+                torch.cuda.ipc_collect()
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.pipelines):
+                self.drop(key)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import os
+import glob
+import json
+import heapq
+from telemetry import EVENTS_FILENAME, format_duration
+from xyz_plot import expand_grid
+
+
+# Model evaluations per sampling step, samplers not listed take one
+SAMPLER_FACTORS = {
+    'Heun': 2,
+    'DPM2': 2,
+    'DPM2 a': 2,
+    'DPM++ 2S a': 2,
+    'DPM++ SDE': 2,
+    'DPM adaptive': 3,
+}
+# Seconds per cost unit without past telemetry, about 2 seconds for 20 steps at 512x512
+DEFAULT_SECONDS_PER_UNIT = 2.0 / (20 * 512 * 512)
+ORDERS = ['file', 'shortest', 'largest']
+
+
+def sampler_factor(sampler):
+    name = (sampler or '').replace(' Karras', '').replace(' Exponential', '').strip()
+    return SAMPLER_FACTORS.get(name, 1)
+
+def request_cost(request):
+    """
+    Return the cost units of a txt2img request: steps x width x height x sampler factor x number of images.
+    """
+    images = int(request.get('batch_size') or 1) * int(request.get('n_iter') or 1)
+    return int(request.get('steps') or 20) * int(request.get('width') or 512) * int(request.get('height') or 512) * sampler_factor(request.get('sampler_name')) * images
+
+def grid_cost(p, base_request):
+    """
+    Return the number of cells and the cost units of a prompt test grid, expanding its axes locally.
+    """
+    _, _, cells = expand_grid(p, base_request)
+    return len(cells), sum(request_cost(cell) for cell in cells)
+
+def find_telemetry(output_folder):
+    return sorted(glob.glob(os.path.join(glob.escape(output_folder), '*', EVENTS_FILENAME)))
+
+def calibrate(telemetry_files):
+    """
+    Return the seconds per cost unit measured by past runs (None without usable telemetry) and the number of runs
+    it was measured on.
+
+    Requests are matched with their `planned` cost events; their time is the server-side sampling time, or the
+    request latency for servers that do not report it.
+    """
+    seconds = 0.0
+    units = 0
+    calibrated_runs = 0
+    for path in telemetry_files:
+        with open(path, 'r') as f:
+            runs = [[]]
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                # Resumed runs append to the same file and number their requests from 0 again
+                if event.get('event') == 'run_start':
+                    runs.append([])
+                runs[-1].append(event)
+        for events in runs:
+            costs = {}
+            timings = {'sampling': {}, 'request': {}}
+            for event in events:
+                if event.get('event') == 'planned':
+                    costs[event['request']] = event['cost']
+                elif event.get('event') == 'stage' and event.get('stage') in timings and 'request' in event:
+                    timings[event['stage']][event['request']] = event['seconds']
+            measured = timings['sampling'] or timings['request']
+            matched = [request for request in costs if request in measured]
+            for request in matched:
+                seconds += measured[request]
+                units += costs[request]
+            calibrated_runs += bool(matched)
+    return (seconds / units if units else None), calibrated_runs
+
+def order_jobs(jobs, costs, order='file'):
+    """
+    Order jobs by cost: 'shortest' first gets the most grids done early, 'largest' first (longest processing time
+    first) balances the load across backends best. 'file' keeps the prompt file order.
+    """
+    if order == 'shortest':
+        return sorted(jobs, key=lambda job: costs[job.index, job.tag])
+    if order == 'largest':
+        return sorted(jobs, key=lambda job: -costs[job.index, job.tag])
+    return list(jobs)
+
+def simulate(durations, speeds):
+    """
+    Simulate running jobs in order, each on the first free backend, and return the finish time of every job.
+    Backends are given as their relative `speeds` (their weights).
+    """
+    free = [(0.0, i) for i in range(len(speeds))]
+    heapq.heapify(free)
+    finish = []
+    for duration in durations:
+        start, i = heapq.heappop(free)
+        end = start + duration / speeds[i]
+        finish.append(end)
+        heapq.heappush(free, (end, i))
+    return finish
+
+def print_plan(jobs, cells, costs, seconds_per_unit, calibrated_runs, speeds, order, deadline=None, top=5):
+    """
+    Print the totals of a planned run: grids, cells, estimated GPU and wall time, and what fits in a deadline
+    (in seconds).
+    """
+    durations = [costs[job.index, job.tag] * seconds_per_unit for job in jobs]
+    finish = simulate(durations, speeds)
+    print(f'Plan: {len(jobs)} grids, {sum(cells[job.index, job.tag] for job in jobs)} images, order: {order}')
+    if calibrated_runs:
+        print(f'  Cost model calibrated from {calibrated_runs} past runs: {seconds_per_unit * 20 * 512 * 512:.2f}s per 20 steps at 512x512')
+    else:
+        print(f'  Cost model not calibrated (no past telemetry), assuming {seconds_per_unit * 20 * 512 * 512:.2f}s per 20 steps at 512x512')
+    print(f'  Estimated GPU time {format_duration(sum(durations))}, wall time {format_duration(max(finish, default=0))} on {len(speeds)} backends')
+    if deadline is not None:
+        in_time = sum(1 for end in finish if end <= deadline)
+        print(f'  Deadline {format_duration(deadline)}: {in_time} of {len(jobs)} grids finish in time')
+    largest = sorted(jobs, key=lambda job: -costs[job.index, job.tag])[:top]
+    if largest:
+        print('  Largest grids:')
+    for job in largest:
+        seq = '{0:0>4}'.format(job.index + 1) + (f'-{job.tag}' if job.tag else '')
+        print(f'    {seq}  {cells[job.index, job.tag]:>4} images  {format_duration(costs[job.index, job.tag] * seconds_per_unit)}  {job.p.get("prompt")[:60]}')
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import warnings
+import itertools
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+from PIL import Image
+from scanner import CAPTION_EXTENSION, clean_filename, extension_format, iter_files, map_bounded
+
+
+# Tag files of the trainer: global.yaml applies to its folder and every subfolder, local.yaml to its folder only
+GLOBAL_CONFIG = 'global.yaml'
+LOCAL_CONFIG = 'local.yaml'
+CONFIG_KEYS = ['main_prompt', 'tags', 'rating', 'max_caption_length', 'shuffle_tags', 'flip_p', 'cond_dropout', 'multiply', 'batch_id']
+# Issues that make the trainer crash or train on the wrong data, the others are warnings
+ERRORS = ['corrupt', 'bad_config', 'unreadable_caption']
+# EXIF orientations that swap width and height once the image is transposed
+TRANSPOSED_ORIENTATIONS = [5, 6, 7, 8]
+MEGAPIXEL_BINS = [0.25, 0.5, 1, 2, 4, 8]
+BATCH_SIZE = 32
+MAX_EXAMPLES = 10
+
+
+def aspect_buckets(resolution=512, step=64, max_aspect=4.0):
+    """
+    Return the (width, height) aspect ratio buckets of about `resolution` x `resolution` pixels, with sides
+    multiple of `step`, that images are resized and cropped to for training.
+    """
+    area = resolution * resolution
+    buckets = set()
+    for width in range(step, area // step + 1, step):
+        height = area // width // step * step
+        if height >= step and 1 / max_aspect <= width / height <= max_aspect:
+            buckets.add((width, height))
+    return sorted(buckets)
+
+def nearest_bucket(width, height, buckets):
+    aspect = math.log(width / height)
+    return min(buckets, key=lambda bucket: abs(math.log(bucket[0] / bucket[1]) - aspect))
+
+def megapixel_bin(width, height):
+    megapixels = width * height / 1e6
+    for upper in MEGAPIXEL_BINS:
+        if megapixels < upper:
+            return f'<{upper}MP'
+    return f'>={MEGAPIXEL_BINS[-1]}MP'
+
+def read_config(path):
+    """
+    Read a `global.yaml` or `local.yaml` tag file and return its tags and the issues found in it.
+
+    Example:
+
+    tags:
+      - tag: "in the style of Bella Kotak"
+
+    $ read_config('input/global.yaml')
+    $ (['in the style of Bella Kotak'], [])
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            config = yaml.safe_load(f) or {}
+    except (OSError, UnicodeDecodeError, yaml.YAMLError) as e:
+        return [], [('bad_config', f'Could not read: {e}')]
+    if not isinstance(config, dict):
+        return [], [('bad_config', 'Expected a mapping of settings (e.g. `tags:`)')]
+    issues = [('unknown_config_key', f'Unknown setting {key!r}, ignored by the trainer') for key in config if key not in CONFIG_KEYS]
+    entries = config.get('tags') or []
+    if not isinstance(entries, list):
+        return [], issues + [('bad_config', '`tags` must be a list of `- tag: "..."` entries')]
+    tags = []
+    for entry in entries:
+        if isinstance(entry, dict) and isinstance(entry.get('tag'), str) and entry['tag'].strip():
+            tags.append(entry['tag'].strip())
+        else:
+            issues.append(('bad_config', f'Tag entry {entry!r} is not `- tag: "..."`'))
+    return tags, issues
+
+def folder_tags(rel_dir, global_tags, local_tags):
+    """
+    Return the tags appended to the captions of a folder: those of the `global.yaml` files from the root folder
+    down to it, then those of its `local.yaml`. `global_tags` and `local_tags` map folders to the tags of their files.
+    """
+    folders = []
+    folder = rel_dir
+    while True:
+        folders.append(folder)
+        if not folder:
+            break
+        folder = os.path.dirname(folder)
+    tags = [tag for folder in reversed(folders) for tag in global_tags.get(folder, [])] + local_tags.get(rel_dir, [])
+    return list(dict.fromkeys(tags))
+
+def resolve_caption(caption, tags):
+    return ', '.join(([caption] if caption else []) + tags)
+
+def check_image(task):
+    """
+    Fully decode an image and read its caption file (None if missing). Runs in the worker processes.
+    """
+    image_path, caption_path = task
+    result = {'format': None, 'width': None, 'height': None, 'mode': None, 'caption': None, 'issues': []}
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        try:
+            with Image.open(image_path) as image:
+                image.load()
+                width, height = image.size
+                if image.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS:
+                    width, height = height, width
+                result.update(format=(image.format or '').lower(), width=width, height=height, mode=image.mode)
+        except Exception as e:
+            result['issues'].append(('corrupt', f'{type(e).__name__}: {e}'))
+    for warning in caught:
+        result['issues'].append(('decode_warning', str(warning.message)))
+    if caption_path is not None:
+        try:
+            with open(caption_path, 'r', encoding='utf-8') as f:
+                result['caption'] = f.readline().strip()
+        except (OSError, UnicodeDecodeError) as e:
+            result['issues'].append(('unreadable_caption', f'{type(e).__name__}: {e}'))
+    return result
+
+def check_images(tasks):
+    return [check_image(task) for task in tasks]
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Preflight:
+    """
+    Check a training dataset before it is handed to the trainer (`train.py --data_root`).
+
+    Every image is fully decoded in a pool of `workers` processes and paired with its caption file (same name,
+    `.txt`), falling back to the filename caption like the trainer does. The tags of the `global.yaml` files of its
+    folder and parent folders and of the `local.yaml` of its folder are appended to the caption, and the image is
+    assigned to the nearest aspect ratio bucket of `resolution`. Results are streamed in a bounded pipeline, so the
+    memory stays flat on datasets of millions of images.
+
+    Every image, caption without an image and tag file gets a line in the JSONL `output_file`, with its issues.
+    Errors (corrupt images, unreadable captions, broken tag files) crash or derail a training run; warnings (missing,
+    empty or orphan captions, tags already in the caption, images upscaled to their bucket, etc.) are worth a look.
+
+    Example:
+
+    $ with Preflight('input', 'preflight.jsonl') as preflight:
+    $     summary = preflight.run()
+    $ summary['errors']
+    $ 0
+    """
+
+    def __init__(self, root, output_file, resolution=512, workers=None):
+        self.root = root
+        self.output_file = output_file
+        self.resolution = resolution
+        self.workers = workers or os.cpu_count() or 1
+        self.buckets = aspect_buckets(resolution)
+        self.max_aspect = max(width / height for width, height in self.buckets)
+        # folder -> tags of its global.yaml and local.yaml
+        self.global_tags = {}
+        self.local_tags = {}
+        self.counts = Counter()
+        self.issues = Counter()
+        self.examples = {}
+        self.histograms = {name: Counter() for name in ['formats', 'modes', 'resolutions', 'megapixels', 'buckets', 'caption_sources']}
+        os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+        self.output = open(output_file, 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.output.close()
+
+    def tags(self, rel_dir):
+        return folder_tags(rel_dir, self.global_tags, self.local_tags)
+
+    def report(self, kind, path, issues, **fields):
+        for code, _ in issues:
+            self.issues[code] += 1
+            examples = self.examples.setdefault(code, [])
+            if len(examples) < MAX_EXAMPLES:
+                examples.append(path)
+        self.counts[kind] += 1
+        self.counts['errors' if any(code in ERRORS for code, _ in issues) else 'warnings' if issues else 'ok'] += 1
+        record = dict(kind=kind, path=path, **fields, issues=[{'code': code, 'message': message} for code, message in issues])
+        self.output.write(json.dumps(record) + '\n')
+
+    def walk(self):
+        """
+        Stream (image path, caption path) tasks folder by folder, reporting tag files and orphan captions.
+        """
+        # iter_files lists the files of a folder together, and a folder before its subfolders
+        for directory, paths in itertools.groupby(iter_files(self.root), key=os.path.dirname):
+            rel_dir = os.path.relpath(directory, self.root)
+            rel_dir = '' if rel_dir == '.' else rel_dir
+            names = [os.path.basename(path) for path in paths]
+            for name, tags_by_dir in [(GLOBAL_CONFIG, self.global_tags), (LOCAL_CONFIG, self.local_tags)]:
+                if name in names:
+                    tags, issues = read_config(os.path.join(directory, name))
+                    tags_by_dir[rel_dir] = tags
+                    self.report('config', os.path.join(rel_dir, name), issues, tags=tags)
+            captions = {os.path.splitext(name)[0]: name for name in names if name.endswith(CAPTION_EXTENSION)}
+            images = sorted(name for name in names if extension_format(name) is not None)
+            stems = {os.path.splitext(name)[0] for name in images}
+            for stem, name in sorted(captions.items()):
+                if stem not in stems:
+                    self.report('caption', os.path.join(rel_dir, name), [('orphan_caption', 'No image with the same name')])
+            for name in images:
+                caption = captions.get(os.path.splitext(name)[0])
+                yield os.path.join(directory, name), caption and os.path.join(directory, caption)
+
+    def add(self, image_path, caption_path, result):
+        """
+        Check the decoded image of a task against the trainer settings and report it.
+        """
+        rel_path = os.path.relpath(image_path, self.root)
+        name = os.path.basename(image_path)
+        issues = list(result['issues'])
+        fields = {key: result[key] for key in ['format', 'width', 'height', 'mode']}
+        if result['format']:
+            expected = extension_format(name)
+            # Camera JPEGs with a preview are reported as MPO
+            if {'mpo': 'jpeg'}.get(result['format'], result['format']) != expected:
+                issues.append(('format_mismatch', f'{result["format"].upper()} data in a .{name.rsplit(".", 1)[-1]} file'))
+            self.histograms['formats'][result['format']] += 1
+            self.histograms['modes'][result['mode']] += 1
+
+        caption = result['caption']
+        if caption_path is None:
+            issues.append(('missing_caption', 'No caption file, the filename is used as caption'))
+            caption, source = clean_filename(name), 'filename'
+        else:
+            source = 'txt'
+            if caption == '' and not any(code == 'unreadable_caption' for code, _ in issues):
+                issues.append(('empty_caption', 'The caption file is empty'))
+        tags = self.tags(os.path.dirname(rel_path))
+        for tag in tags:
+            if caption and tag.lower() in caption.lower():
+                issues.append(('duplicate_tag', f'Tag {tag!r} is already in the caption'))
+        self.histograms['caption_sources'][source] += 1
+        fields['caption'] = resolve_caption(caption, tags)
+
+        width, height = result['width'], result['height']
+        if width and height:
+            bucket = nearest_bucket(width, height, self.buckets)
+            if max(width / height, height / width) > self.max_aspect:
+                issues.append(('extreme_aspect', f'Aspect ratio {width}x{height} is beyond the widest bucket, it will be cropped'))
+            if width < bucket[0] or height < bucket[1]:
+                issues.append(('upscaled', f'{width}x{height} is upscaled to its {bucket[0]}x{bucket[1]} bucket'))
+            fields['bucket'] = list(bucket)
+            self.histograms['resolutions'][f'{width}x{height}'] += 1
+            self.histograms['megapixels'][megapixel_bin(width, height)] += 1
+            self.histograms['buckets'][f'{bucket[0]}x{bucket[1]}'] += 1
+        self.report('image', rel_path, issues, **fields)
+
+    def run(self):
+        """
+        Check the whole dataset and return the summary.
+        """
+        start = time.perf_counter()
+        batches = batched(self.walk(), BATCH_SIZE)
+        pending = deque()
+
+        def tasks():
+            # Keep the tasks of the batches in flight to match them with their results
+            for batch in batches:
+                pending.append(batch)
+                yield batch
+
+        for results in map_bounded(check_images, tasks(), self.workers, executor_class=ProcessPoolExecutor):
+            for (image_path, caption_path), result in zip(pending.popleft(), results):
+                self.add(image_path, caption_path, result)
+        self.output.flush()
+        return self.summary(time.perf_counter() - start)
+
+    def summary(self, seconds):
+        return {
+            'root': self.root,
+            'resolution': self.resolution,
+            'files': self.counts['image'] + self.counts['caption'] + self.counts['config'],
+            'images': self.counts['image'],
+            'ok': self.counts['ok'],
+            'errors': self.counts['errors'],
+            'warnings': self.counts['warnings'],
+            'issues': {code: {'count': count, 'error': code in ERRORS, 'examples': self.examples[code]} for code, count in self.issues.most_common()},
+            'tags': {folder or '.': self.tags(folder) for folder in sorted(set(self.global_tags) | set(self.local_tags))},
+            'formats': dict(self.histograms['formats'].most_common()),
+            'modes': dict(self.histograms['modes'].most_common()),
+            'caption_sources': dict(self.histograms['caption_sources'].most_common()),
+            'buckets': dict(self.histograms['buckets'].most_common()),
+            'megapixels': {label: self.histograms['megapixels'][label] for label in [f'<{upper}MP' for upper in MEGAPIXEL_BINS] + [f'>={MEGAPIXEL_BINS[-1]}MP'] if self.histograms['megapixels'][label]},
+            'top_resolutions': dict(self.histograms['resolutions'].most_common(20)),
+            'distinct_resolutions': len(self.histograms['resolutions']),
+            'seconds': round(seconds, 3),
+            'images_per_second': round(self.counts['image'] / seconds, 1) if seconds else None,
+        }
+
+
+def summary_path(output_file):
+    return f'{os.path.splitext(output_file)[0]}.summary.json'
+
+def print_histogram(title, histogram, total, top=10):
+    print(f'  {title}:')
+    for label, count in list(histogram.items())[:top]:
+        share = count / total if total else 0
+        print(f'    {label:>12} {count:>9} {share:>6.1%} {"#" * round(share * 40)}')
+
+def main(input_directory, output_file, resolution=512, workers=None):
+    """
+    Check a dataset folder before training on it: decode every image, pair it with its caption, apply the
+    `global.yaml` tags and report the resolutions and aspect ratio buckets.
+
+    Writes one JSON line per file to `output_file` and the summary to `<output_file>.summary.json`, and exits with
+    an error if any image, caption or tag file would break the training run.
+
+    Examples:
+    $ python preflight.py -i input
+    $ python preflight.py -i input -o input_preflight.jsonl --resolution 768 -j 32
+    """
+    if not os.path.isdir(input_directory):
+        print(f'ERROR: `{input_directory}` is not a folder')
+        sys.exit(1)
+
+    with Preflight(input_directory, output_file, resolution, workers) as preflight:
+        summary = preflight.run()
+    with open(summary_path(output_file), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    print(f'Checked {summary["images"]} images and {summary["files"] - summary["images"]} other files in `{input_directory}` in {summary["seconds"]:.1f}s ({summary["images_per_second"] or 0:.0f} images/s)')
+    print(f'  {summary["ok"]} files ok, {summary["errors"]} with errors, {summary["warnings"]} with warnings')
+    for folder, tags in summary['tags'].items():
+        print(f'  Tags of `{folder}`: {", ".join(tags) or "(none)"}')
+    print_histogram(f'Aspect buckets at {resolution}', summary['buckets'], summary['images'])
+    print_histogram('Megapixels', summary['megapixels'], summary['images'])
+    print_histogram('Resolutions', summary['top_resolutions'], summary['images'])
+    for code, issue in summary['issues'].items():
+        print(f'  {"ERROR" if issue["error"] else "Warning"}: {code} x{issue["count"]}, e.g. {", ".join(issue["examples"][:3])}')
+    print(f'Saved the preflight manifest to `{output_file}` and the summary to `{summary_path(output_file)}`')
+    if summary['errors']:
+        print(f'ERROR: {summary["errors"]} files would break the training run, see `{output_file}`')
+        sys.exit(1)
+    return summary
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='Check a training dataset for corrupt images, missing captions and tag file mistakes.')
+    parser.add_argument('-i', '--input_directory', type=str, default='input', help="The dataset folder (default: 'input')")
+    parser.add_argument('-o', '--output_file', type=str, default='preflight.jsonl', help="JSONL manifest of the checked files, the summary is saved next to it (default: 'preflight.jsonl')")
+    parser.add_argument('-r', '--resolution', type=int, default=512, help='Training resolution of the aspect ratio buckets (default: 512)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of decoding processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    main(args.input_directory, args.output_file, args.resolution, args.workers)
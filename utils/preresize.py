@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import math
+import time
+import shutil
+import sqlite3
+import hashlib
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+from manifest import MANIFEST_DIR
+from preflight import TRANSPOSED_ORIENTATIONS, aspect_buckets, nearest_bucket, batched
+from scanner import extension_format, iter_files, map_bounded
+
+
+INDEX_FILENAME = 'preresize.sqlite'
+BATCH_SIZE = 8
+# Pillow save format and options by image format, the other formats keep their own
+SAVE_OPTIONS = {
+    'jpeg': ('JPEG', lambda quality: {'quality': quality}),
+    'webp': ('WEBP', lambda quality: {'quality': quality}),
+    'png': ('PNG', lambda quality: {'compress_level': 6}),
+}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    settings TEXT,
+    sha256 TEXT,
+    output_size INTEGER
+);
+'''
+
+
+def target_size(width, height, buckets):
+    """
+    Return the smallest size with the aspect ratio of the image that covers its aspect ratio bucket, or None if
+    the image is not larger than that (it is never upscaled).
+    """
+    bucket = nearest_bucket(width, height, buckets)
+    scale = max(bucket[0] / width, bucket[1] / height)
+    if scale >= 1:
+        return None
+    return min(width, math.ceil(width * scale)), min(height, math.ceil(height * scale))
+
+def resize_image(data, image_format, buckets, quality):
+    """
+    Return the image bytes downscaled to cover their aspect ratio bucket, with the EXIF orientation applied, or
+    None if the image is already small enough.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        transposed = image.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS
+        size = target_size(height, width, buckets) if transposed else target_size(width, height, buckets)
+        if size is None:
+            return None
+        # JPEGs are decoded at the smallest 1/2, 1/4 or 1/8 scale still larger than the target, much faster
+        image.draft(image.mode, (size[1], size[0]) if transposed else size)
+        icc_profile = image.info.get('icc_profile')
+        image = ImageOps.exif_transpose(image)
+        image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        save_format, options = SAVE_OPTIONS.get(image_format, (image_format.upper(), lambda quality: {}))
+        if save_format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+        buffer = io.BytesIO()
+        image.save(buffer, format=save_format, icc_profile=icc_profile, **options(quality))
+        return buffer.getvalue()
+
+def process_file(task):
+    """
+    Hash a source file and write its resized image (or a copy of it) to the output path. Runs in the worker
+    processes. Returns the content hash, the output size and whether the image was resized, or the error.
+    """
+    source_path, output_path, previous_sha256, resolution, quality = task
+    try:
+        with open(source_path, 'rb') as f:
+            data = f.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        # Touched but unchanged sources keep their output
+        if sha256 == previous_sha256 and os.path.exists(output_path):
+            return sha256, os.path.getsize(output_path), None, None
+        image_format = extension_format(source_path)
+        resized = resize_image(data, image_format, aspect_buckets(resolution), quality) if image_format else None
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        tmp_path = f'{output_path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data if resized is None else resized)
+        shutil.copystat(source_path, tmp_path)
+        os.replace(tmp_path, output_path)
+        return sha256, len(data if resized is None else resized), resized is not None, None
+    except Exception as e:
+        return None, None, None, f'{type(e).__name__}: {e}'
+
+def process_files(tasks):
+    return [process_file(task) for task in tasks]
+
+
+class ResizeCache:
+    """
+    Mirror of a dataset folder with the images downscaled for training, updated incrementally.
+
+    Images larger than needed are downscaled, in a pool of `workers` processes, to the smallest size that covers
+    their aspect ratio bucket at `resolution`, keeping their aspect ratio, format, ICC profile and file name, with
+    their EXIF orientation applied. The trainer then only has to crop them. Smaller images, captions, tag files and
+    any other file are copied, so the output folder keeps the layout of the dataset and is a drop-in `--data_root`.
+
+    The sources are indexed in `<output_directory>.l2t/preresize.sqlite`, next to the output folder so that it only
+    holds the dataset, by size, mtime and SHA-256 of their content, with the settings they were resized with. An update only reads sources whose size or mtime changed,
+    only rewrites outputs whose content or settings changed, and removes the outputs of deleted sources.
+
+    Example:
+
+    $ with ResizeCache('input', 'input_512', resolution=512) as cache:
+    $     cache.update()
+    """
+
+    def __init__(self, input_directory, output_directory, resolution=512, quality=95, workers=None):
+        self.input_directory = input_directory
+        self.output_directory = output_directory
+        self.resolution = resolution
+        self.quality = quality
+        self.workers = workers or os.cpu_count() or 1
+        self.settings = f'resolution={resolution},quality={quality}'
+        index_dir = os.path.normpath(output_directory) + MANIFEST_DIR
+        os.makedirs(index_dir, exist_ok=True)
+        self.path = os.path.join(index_dir, INDEX_FILENAME)
+        # Earlier versions kept the index inside the output folder
+        legacy_dir = os.path.join(output_directory, MANIFEST_DIR)
+        if os.path.exists(os.path.join(legacy_dir, INDEX_FILENAME)) and not os.path.exists(self.path):
+            os.replace(os.path.join(legacy_dir, INDEX_FILENAME), self.path)
+            if not os.listdir(legacy_dir):
+                os.rmdir(legacy_dir)
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def output_path(self, rel_path):
+        return os.path.join(self.output_directory, rel_path)
+
+    def update(self):
+        """
+        Bring the output folder up to date with the dataset and return the counts of what was done.
+        """
+        known = {path: (size, mtime_ns, settings, sha256) for path, size, mtime_ns, settings, sha256 in self.db.execute('SELECT path, size, mtime_ns, settings, sha256 FROM files')}
+        stats = {'unchanged': 0, 'resized': 0, 'copied': 0, 'removed': 0, 'failed': 0, 'input_bytes': 0, 'output_bytes': 0}
+        pending = deque()
+
+        def tasks():
+            for source_path in iter_files(self.input_directory):
+                rel_path = os.path.relpath(source_path, self.input_directory)
+                if rel_path.split(os.sep)[0] == MANIFEST_DIR:
+                    continue
+                st = os.stat(source_path)
+                previous = known.pop(rel_path, None)
+                if previous and previous[:3] == (st.st_size, st.st_mtime_ns, self.settings) and os.path.exists(self.output_path(rel_path)):
+                    stats['unchanged'] += 1
+                    continue
+                pending.append((rel_path, st))
+                sha256 = previous[3] if previous and previous[2] == self.settings else None
+                yield source_path, self.output_path(rel_path), sha256, self.resolution, self.quality
+
+        for results in map_bounded(process_files, batched(tasks(), BATCH_SIZE), self.workers, executor_class=ProcessPoolExecutor):
+            for sha256, output_size, resized, error in results:
+                rel_path, st = pending.popleft()
+                if error:
+                    print(f'ERROR: Could not process `{rel_path}`: {error}')
+                    stats['failed'] += 1
+                    continue
+                if resized is None:
+                    stats['unchanged'] += 1
+                else:
+                    stats['resized' if resized else 'copied'] += 1
+                    stats['input_bytes'] += st.st_size
+                    stats['output_bytes'] += output_size
+                self.db.execute(
+                    'INSERT OR REPLACE INTO files (path, size, mtime_ns, settings, sha256, output_size) VALUES (?, ?, ?, ?, ?, ?)',
+                    (rel_path, st.st_size, st.st_mtime_ns, self.settings, sha256, output_size)
+                )
+
+        # Sources left in the index were deleted
+        for rel_path in known:
+            try:
+                os.remove(self.output_path(rel_path))
+            except FileNotFoundError:
+                pass
+            self.db.execute('DELETE FROM files WHERE path = ?', (rel_path,))
+            stats['removed'] += 1
+        self.db.commit()
+        return stats
+
+
+def main(input_directory, output_directory, resolution=512, quality=95, workers=None):
+    """
+    Downscale the images of a dataset folder for training at `resolution` into `output_directory`, to use as
+    `--data_root` instead of the original folder. Runs again only process the files that changed.
+
+    Examples:
+    $ python preresize.py -i input -o input_512
+    $ python preresize.py -i input -o input_768 --resolution 768 --quality 98 -j 32
+    $ python train.py --data_root input_512 --resolution 512 ...
+    """
+    if not os.path.isdir(input_directory):
+        print(f'ERROR: `{input_directory}` is not a folder')
+        sys.exit(1)
+    input_path = os.path.realpath(input_directory)
+    output_path = os.path.realpath(output_directory)
+    if os.path.commonpath([input_path, output_path]) == input_path:
+        # The next run would take the resized images for new sources
+        print('ERROR: The output folder must not be the input folder or inside it')
+        sys.exit(1)
+
+    start = time.perf_counter()
+    with ResizeCache(input_directory, output_directory, resolution, quality, workers) as cache:
+        stats = cache.update()
+    seconds = time.perf_counter() - start
+    print(f'Resized {stats["resized"]} images and copied {stats["copied"]} files in {seconds:.1f}s, {stats["unchanged"]} unchanged, {stats["removed"]} removed')
+    if stats['input_bytes']:
+        print(f'  Wrote {stats["output_bytes"] / 1024 ** 2:.1f} MB from {stats["input_bytes"] / 1024 ** 2:.1f} MB of sources')
+    print(f'Use `--data_root {output_directory}` to train on the resized dataset')
+    if stats['failed']:
+        print(f'ERROR: {stats["failed"]} files could not be processed')
+        sys.exit(1)
+    return stats
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='Downscale the images of a dataset for training into an incremental cache folder.')
+    parser.add_argument('-i', '--input_directory', type=str, default='input', help="The dataset folder (default: 'input')")
+    parser.add_argument('-o', '--output_directory', type=str, default=None, help="The resized dataset folder (default: '<input_directory>_<resolution>')")
+    parser.add_argument('-r', '--resolution', type=int, default=512, help='Training resolution of the aspect ratio buckets (default: 512)')
+    parser.add_argument('-q', '--quality', type=int, default=95, help='JPEG and WebP quality of the resized images (default: 95)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of resizing processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    output_directory = args.output_directory or f'{args.input_directory.rstrip(os.sep)}_{args.resolution}'
+    main(args.input_directory, output_directory, args.resolution, args.quality, args.workers)
@@ -1,56 +1,143 @@
 #!/usr/bin/env python3
 
 import os
+import sys
+import csv
 import json
 import argparse
+from prompt_store import append_prompts, default_prompt_file
+from xyz_plot import validate_prompt
 
 
-def main(output_file, prompt, negative_prompt, seed, z_axis_type, z_axis_values):
+FIELDS = ['prompt', 'negative_prompt', 'seed', 'x_axis_type', 'x_axis_values', 'y_axis_type', 'y_axis_values', 'z_axis_type', 'z_axis_values']
+INPUT_FORMATS = {'.txt': 'txt', '.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl'}
+
+
+def read_rows(input_file, input_format='auto'):
+    """
+    Read prompt rows from a plain text (one prompt per line), CSV (with a `prompt` header column) or JSONL file, or
+    stdin with '-'. CSV and JSONL rows may also set any of `negative_prompt`, `seed` and the x/y/z axis types and
+    values. The format is guessed from the file extension, or from the first character on stdin.
+    """
+    f = sys.stdin if input_file == '-' else open(input_file, 'r', newline='')
+    try:
+        lines = iter(f)
+        if input_format == 'auto':
+            input_format = INPUT_FORMATS.get(os.path.splitext(input_file)[1].lower())
+        if input_format is None:
+            # Peek at the first line to tell JSONL from plain text
+            first = next(lines, '')
+            input_format = 'jsonl' if first.lstrip().startswith(('{', '[')) else 'txt'
+            lines = iter([first] + list(lines)) if first else iter([])
+        if input_format == 'txt':
+            return [{'prompt': line.strip()} for line in lines if line.strip()]
+        if input_format == 'csv':
+            rows = []
+            for row in csv.DictReader(lines):
+                rows.append({key.strip(): value for key, value in row.items() if key and value not in (None, '')})
+            return rows
+        text = ''.join(lines)
+        if text.lstrip().startswith('['):
+            return json.loads(text)
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def build_prompt(row, defaults):
+    """
+    Return the prompt test of a row with the command line values as defaults, and its list of problems.
     """
-    Create or add prompts to a XYZ grid prompt json file.
+    errors = [f'unknown field {key!r}' for key in row if key not in FIELDS]
+    p = {key: row.get(key, defaults.get(key)) for key in FIELDS if key in row or key in defaults}
+    if isinstance(p.get('seed'), str):
+        try:
+            p['seed'] = int(p['seed'])
+        except ValueError:
+            pass
+    return p, errors + validate_prompt(p)
+
+def main(output_file, prompt, negative_prompt, seed, z_axis_type, z_axis_values, input_file=None, input_format='auto', allow_duplicates=False):
+    """
+    Create or add prompts to a XYZ grid prompt file.
+
+    Prompts are appended as one JSONL line under a file lock, so adding a prompt does not rewrite the file and
+    several processes can add prompts at once. Files in the older JSON array format (or new files ending with
+    `.json`) are still supported and rewritten as before.
+
+    With `input_file` (a file or '-' for stdin) prompts are added in bulk from plain text (one prompt per line), CSV
+    or JSONL rows, which can override the negative prompt, seed and axes given on the command line. All rows are
+    validated first (axis types must be known to the X/Y/Z Plot script) and written in a single append, or not at
+    all. Prompt tests already in the output file are skipped unless `allow_duplicates`.
 
     Examples:
-    $ prompt2test.py -i prompts.txt -O xyz_prompts_test.json -z "CFG Scale" -Z "4,7,11" 
+    $ prompt2test.py -i prompts.txt -O xyz_prompts_test.jsonl -z "CFG Scale" -Z "4,7,11" 
     $ prompt2test.py -p 'A photo of a cartoon' --seed 1234 --z_axis_type "Prompt S/R" --z_axis_values="cartoon, monkey, dog, cat, statue, painting, pottery, car, house, city"
     $ prompt2test.py -p 'A portrait of Morgan Freeman' -N "cartoon, 3D"
+    $ prompt2test.py -i prompts.csv -z Steps -Z "20,30"
+    $ cat prompts.jsonl | prompt2test.py -i - -F jsonl
     """
-    # Open json file (if exists)
-    try:
-        with open (output_file, 'r') as f:
-            data = json.loads(f.read())
-    except Exception:
-        data = []
-    # Add prompt to json file
-    data.extend([{
-         'prompt': prompt,
-         'negative_prompt': negative_prompt,
-         'seed': seed,
-         'z_axis_type': z_axis_type,
-         'z_axis_values': z_axis_values
-
-    }])
-    # Save prompts to JSON file
-    with open(output_file, 'w') as fp:
-        json.dump(data, fp)
+    defaults = {
+        'negative_prompt': negative_prompt,
+        'seed': seed,
+        'z_axis_type': z_axis_type,
+        'z_axis_values': z_axis_values,
+    }
+    if input_file is None:
+        # Add prompt to the prompt file
+        p, errors = build_prompt({'prompt': prompt}, defaults)
+        if errors:
+            print(f'ERROR: {", ".join(errors)}')
+            sys.exit(1)
+        append_prompts(output_file, [p])
+        return
+
+    rows = read_rows(input_file, input_format)
+    if prompt:
+        rows.append({'prompt': prompt})
+    prompts = []
+    invalid = 0
+    for number, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            row = {'prompt': row}
+        p, errors = build_prompt(row, defaults)
+        if errors:
+            print(f'ERROR: row {number}: {", ".join(errors)}')
+            invalid += 1
+        prompts.append(p)
+    if invalid:
+        print(f'ERROR: {invalid} invalid rows, nothing was added to `{output_file}`')
+        sys.exit(1)
+    added = append_prompts(output_file, prompts, dedupe=not allow_duplicates)
+    print(f'Added {added} prompts to `{output_file}` ({len(prompts) - added} duplicates skipped)')
 
 
 if __name__ == "__main__":
     # Parse args
     parser = argparse.ArgumentParser()
-    parser.add_argument('-O', '--output_file', type=str, default='xyz_prompts.json', help='The name of the JSON file (default: xyz_prompts.json)')
+    parser.add_argument('-O', '--output_file', type=str, default=None, help='The name of the prompt file, JSONL unless it ends with .json (default: xyz_prompts.jsonl, or xyz_prompts.json if only that one exists)')
     parser.add_argument('-p', '--prompt', type=str, help='Prompt')
+    parser.add_argument('-i', '--input_file', type=str, default=None, help="Add prompts in bulk from a text, CSV or JSONL file, '-' for stdin (default: None)")
+    parser.add_argument('-F', '--input_format', type=str, default='auto', choices=['auto', 'txt', 'csv', 'jsonl'], help='Format of the input file (default: auto, from the file extension)')
+    parser.add_argument('--allow_duplicates', action='store_true', default=False, help='Also add prompts already in the output file when adding in bulk (default: False)')
     parser.add_argument('-N', '--negative_prompt', type=str, default='', help="Negative prompt (default: '(low quality, worst quality)')")
     parser.add_argument('-s', '--seed', type=int, default=-1, help='Seed value (default: -1)')
     parser.add_argument('-z', '--z_axis_type', type=str, default='Nothing', help="Z axis type. Options: 'Nothing', 'Prompt S/R', 'Steps', 'CFG Scale', 'Sampler', etc. (default: 'Nothing')")
     parser.add_argument('-Z', '--z_axis_values', default='', type=str, help="Z axis values. (default: '')")
     args = parser.parse_args()
 
-    output_file = args.output_file
+    output_file = args.output_file or default_prompt_file()
     prompt = args.prompt
     negative_prompt = args.negative_prompt
     seed = args.seed
     z_axis_type = args.z_axis_type
     z_axis_values = args.z_axis_values
+    input_file = args.input_file
+    input_format = args.input_format
+    allow_duplicates = args.allow_duplicates
+
+    if not prompt and not input_file:
+        parser.error('a prompt (-p) or an input file (-i) is required')
 
-    main(output_file, prompt, negative_prompt, seed, z_axis_type, z_axis_values)
+    main(output_file, prompt, negative_prompt, seed, z_axis_type, z_axis_values, input_file, input_format, allow_duplicates)
 
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import os
+import json
+from contextlib import contextmanager
+from manifest import MANIFEST_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_PROMPT_FILE = 'xyz_prompts.jsonl'
+# Default prompt file before JSONL, still used when it exists and the JSONL one does not
+LEGACY_PROMPT_FILE = 'xyz_prompts.json'
+
+
+def default_prompt_file():
+    """
+    Return the default prompt file: `xyz_prompts.jsonl`, or the legacy `xyz_prompts.json` if only that one exists.
+    """
+    if not os.path.exists(DEFAULT_PROMPT_FILE) and os.path.exists(LEGACY_PROMPT_FILE):
+        return LEGACY_PROMPT_FILE
+    return DEFAULT_PROMPT_FILE
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive lock on `.l2t/<name>.lock` next to the prompt file so concurrent writers do not lose entries.
+    """
+    lock_dir = os.path.join(os.path.dirname(path), MANIFEST_DIR)
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f'{os.path.basename(path)}.lock'), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def is_json_array(path):
+    """
+    Return True if the prompt file uses the legacy JSON array format, False for JSONL (or a missing/empty file).
+    """
+    try:
+        with open(path, 'r') as f:
+            while True:
+                char = f.read(1)
+                if not char:
+                    return False
+                if not char.isspace():
+                    return char == '['
+    except FileNotFoundError:
+        return False
+
+def uses_jsonl(path):
+    """
+    Existing files keep their format, new files are JSONL unless their name ends with `.json`.
+    """
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        return not is_json_array(path)
+    return os.path.splitext(path)[1] != '.json'
+
+def iter_prompts(path):
+    """
+    Lazily yield the prompt tests of a prompt file, auto-detecting JSONL or the legacy JSON array format.
+
+    Example:
+
+    $ for p in iter_prompts('xyz_prompts.jsonl'):
+    $     print(p['prompt'])
+    """
+    if is_json_array(path):
+        with open(path, 'r') as f:
+            yield from json.load(f)
+        return
+    with open(path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def count_prompts(path):
+    """
+    Count the prompt tests of a prompt file without parsing JSONL lines.
+    """
+    if is_json_array(path):
+        with open(path, 'r') as f:
+            return len(json.load(f))
+    with open(path, 'r') as f:
+        return sum(1 for line in f if line.strip())
+
+def prompt_key(p):
+    return json.dumps(p, sort_keys=True)
+
+def append_prompts(path, prompts, dedupe=False):
+    """
+    Append prompt tests to a prompt file under a file lock and return the number of prompt tests added.
+
+    JSONL files get an O(1) append of one line per prompt, written with a single `write` call. Legacy JSON array
+    files are rewritten atomically. With `dedupe`, prompt tests identical to one already in the file (or earlier in
+    `prompts`) are skipped, which costs one read of the file.
+    """
+    prompts = list(prompts)
+    with locked(path):
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if dedupe:
+            seen = {prompt_key(p) for p in iter_prompts(path)} if exists else set()
+            unique = []
+            for p in prompts:
+                key = prompt_key(p)
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(p)
+            prompts = unique
+        if not prompts:
+            return 0
+        if uses_jsonl(path):
+            data = ''.join(json.dumps(p) + '\n' for p in prompts)
+            # A hand-edited file may not end with a newline, the first new line must not be glued to its last one
+            if exists and not ends_with_newline(path):
+                data = '\n' + data
+            with open(path, 'a') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            existing = list(iter_prompts(path)) if exists else []
+            replace_file(path, json.dumps(existing + prompts))
+    return len(prompts)
+
+def ends_with_newline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+def write_prompts(path, prompts):
+    """
+    Replace the content of a prompt file, as JSONL unless the file name ends with `.json`.
+    """
+    with locked(path):
+        if os.path.splitext(path)[1] == '.json':
+            replace_file(path, json.dumps(list(prompts)))
+        else:
+            replace_file(path, ''.join(json.dumps(p) + '\n' for p in prompts))
+
+def replace_file(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
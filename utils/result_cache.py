@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+
+INDEX_FILENAME = 'index.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER,
+    last_access REAL
+);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+'''
+
+
+def cache_key(request, **params):
+    """
+    Hash everything that determines a grid into a cache key: the txt2img request (prompt, negative prompt, seed,
+    CFG, size, axis types and values) plus extra parameters such as sampler, steps and the active checkpoint.
+    """
+    data = json.dumps({'request': request, **params}, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class ResultCache:
+    """
+    Content-addressed cache of finished grid images with a size cap and LRU eviction.
+
+    Files are stored as `<directory>/<key[:2]>/<key>.<extension>` and tracked in a SQLite index with their size
+    and last access time. Putting a file evicts the least recently used entries until the cache fits in `max_bytes`.
+
+    Example:
+
+    $ cache = ResultCache('.xyz_cache', max_bytes=10 * 1024 ** 3)
+    $ key = cache_key(request, sampler='Euler a', steps=20, checkpoint='model.safetensors')
+    $ if not cache.fetch(key, 'output/grid.png'):
+    $     ...
+    $     cache.put(key, 'output/grid.png')
+    """
+
+    def __init__(self, directory, max_bytes, extension='png'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extension = extension
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, INDEX_FILENAME), check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.{self.extension}')
+
+    def fetch(self, key, destination):
+        """
+        Copy the cached file for `key` to `destination` and return True, or return False on a cache miss.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return False
+            try:
+                link_or_copy(self.path(key), destination)
+            except OSError:
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.db.commit()
+                return False
+            self.db.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+            return True
+
+    def read(self, key):
+        """
+        Return the cached bytes for `key`, or None on a cache miss.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self.path(key), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.db.commit()
+                return None
+            self.db.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+            return data
+
+    def put(self, key, source):
+        """
+        Store a copy of the `source` file under `key` and evict old entries to stay under the size cap.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, path)
+        self._add(key, path)
+
+    def put_bytes(self, key, data):
+        """
+        Store `data` under `key` and evict old entries to stay under the size cap.
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._add(key, path)
+
+    def _add(self, key, path):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO entries (key, size, last_access) VALUES (?, ?, ?)', (key, os.path.getsize(path), time.time()))
+            self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.db.execute('SELECT key, size FROM entries ORDER BY last_access').fetchall():
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+            self.db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import random
+
+
+def reservoir_sample(iterable, k, rng=None):
+    """
+    Draw `k` items uniformly at random from an iterable of unknown length in a single pass.
+
+    Only the `k` sampled items are kept in memory (Algorithm R). Returns the sample and the number of items seen.
+    If the iterable has fewer than `k` items, all of them are returned.
+
+    Example:
+
+    $ reservoir_sample(range(1000000), 3, random.Random(1234))
+    $ ([<3 random items>], 1000000)
+    """
+    rng = rng or random.Random()
+    reservoir = []
+    seen = 0
+    for item in iterable:
+        seen += 1
+        if len(reservoir) < k:
+            reservoir.append(item)
+        else:
+            j = rng.randrange(seen)
+            if j < k:
+                reservoir[j] = item
+    rng.shuffle(reservoir)
+    return reservoir, seen
+
+def allocate(counts, k, rng=None):
+    """
+    Split `k` draws between strata of the given sizes.
+
+    Every stratum gets at least one draw when `k` allows it (otherwise `k` strata are picked at random), and the
+    rest is shared in proportion to the stratum sizes using the largest remainder method.
+    """
+    rng = rng or random.Random()
+    strata = sorted(counts)
+    k = min(k, sum(counts.values()))
+    if k < len(strata):
+        return {stratum: 1 for stratum in rng.sample(strata, k)}
+
+    allocation = {stratum: 1 for stratum in strata}
+    remaining = k - len(strata)
+    while remaining > 0:
+        spare = {stratum: counts[stratum] - allocation[stratum] for stratum in strata if counts[stratum] > allocation[stratum]}
+        total = sum(spare.values())
+        shares = {stratum: remaining * n / total for stratum, n in spare.items()}
+        given = 0
+        for stratum, share in shares.items():
+            extra = min(int(share), spare[stratum])
+            allocation[stratum] += extra
+            given += extra
+        leftovers = sorted(spare, key=lambda stratum: (shares[stratum] - int(shares[stratum]), rng.random()), reverse=True)
+        for stratum in leftovers[:remaining - given]:
+            if allocation[stratum] < counts[stratum]:
+                allocation[stratum] += 1
+                given += 1
+        remaining -= given
+    return allocation
+
+def stratified_sample(iterable, k, key, rng=None):
+    """
+    Draw `k` items from an iterable in a single pass, covering every stratum given by `key(item)`.
+
+    One reservoir of up to `k` items is kept per stratum, so memory is O(k * number of strata). Draws are split
+    between strata with `allocate`. Returns the sample and the number of items seen.
+
+    Example:
+
+    $ stratified_sample(records, 15, key=lambda record: os.path.dirname(record.path))
+    """
+    rng = rng or random.Random()
+    reservoirs = {}
+    counts = {}
+    seen = 0
+    for item in iterable:
+        seen += 1
+        stratum = key(item)
+        n = counts.get(stratum, 0) + 1
+        counts[stratum] = n
+        reservoir = reservoirs.setdefault(stratum, [])
+        if len(reservoir) < k:
+            reservoir.append(item)
+        else:
+            j = rng.randrange(n)
+            if j < k:
+                reservoir[j] = item
+
+    sample = []
+    for stratum, n in sorted(allocate(counts, k, rng).items()):
+        sample.extend(rng.sample(reservoirs[stratum], n))
+    rng.shuffle(sample)
+    return sample, seen
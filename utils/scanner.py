@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import os
+import imghdr
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+IMAGE_FORMATS = ['jpeg', 'jpg', 'png', 'gif', 'bmp', 'tiff', 'webp']  # Add more formats if needed
+IMAGE_EXTENSIONS = {
+    '.jpeg': 'jpeg',
+    '.jpg': 'jpeg',
+    '.png': 'png',
+    '.gif': 'gif',
+    '.bmp': 'bmp',
+    '.tif': 'tiff',
+    '.tiff': 'tiff',
+    '.webp': 'webp',
+}
+CAPTION_EXTENSION = '.txt'
+DEFAULT_WORKERS = 16
+
+# kind is 'image' (format set) or 'caption' (caption set)
+Record = namedtuple('Record', ['path', 'kind', 'format', 'caption'])
+
+
+def sniff_format(file_path):
+    """
+    Read the header of a file and return its image format, or None if it is not a supported image.
+    """
+    image_format = imghdr.what(file_path)
+    return image_format if image_format in IMAGE_FORMATS else None
+
+def extension_format(file_path):
+    """
+    Return the image format implied by the file extension, without opening the file.
+    """
+    return IMAGE_EXTENSIONS.get(os.path.splitext(file_path)[1].lower())
+
+def read_caption(file_path):
+    try:
+        with open(file_path, 'r') as f:
+            return f.readline().strip()
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        return None
+
+def clean_filename(filename):
+    return filename.split('_')[0]
+
+def classify(file_path, trust_extensions=False):
+    """
+    Return a Record for an image or caption file, or None for any other file.
+    """
+    if file_path.endswith(CAPTION_EXTENSION):
+        caption = read_caption(file_path)
+        return None if caption is None else Record(file_path, 'caption', None, caption)
+    if trust_extensions:
+        image_format = extension_format(file_path)
+    else:
+        image_format = sniff_format(file_path)
+    return None if image_format is None else Record(file_path, 'image', image_format, None)
+
+def map_bounded(fn, iterable, workers=DEFAULT_WORKERS, executor_class=ThreadPoolExecutor):
+    """
+    Like `map`, but runs `fn` in a thread pool keeping at most a few items per worker in flight.
+
+    Results are yielded in input order, so memory stays flat no matter how long `iterable` is. CPU-bound work can
+    use a `ProcessPoolExecutor` as `executor_class` (`fn` and the items must then be picklable).
+    """
+    max_in_flight = workers * 4
+    with executor_class(max_workers=workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def iter_files(root):
+    """
+    Walk `root` recursively with `os.scandir` and yield the path of every regular file.
+
+    Like `os.walk`, symlinked directories are not followed.
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            print(f"An error occurred: {e}")
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+
+def scan(root, images=True, captions=True, trust_extensions=False, workers=DEFAULT_WORKERS):
+    """
+    Stream image and caption Records found inside `root` recursively in a single traversal.
+
+    Image headers and caption files are read in a bounded thread pool, which keeps the I/O queue busy on
+    network filesystems where per-file open latency dominates. With `trust_extensions` images are detected
+    from their extension only and never opened.
+
+    Example:
+
+    input/001.jpg
+    input/001.txt # a man climbing a wall
+
+    $ list(scan('input'))
+    $ [Record(path='input/001.jpg', kind='image', format='jpeg', caption=None),
+       Record(path='input/001.txt', kind='caption', format=None, caption='a man climbing a wall')]
+    """
+    def wanted(file_path):
+        if file_path.endswith(CAPTION_EXTENSION):
+            return captions
+        if trust_extensions and extension_format(file_path) is None:
+            return False
+        return images
+
+    def classify_file(file_path):
+        return classify(file_path, trust_extensions)
+
+    file_paths = (file_path for file_path in iter_files(root) if wanted(file_path))
+    if trust_extensions and not captions:
+        # Nothing left to open, skip the thread pool
+        records = map(classify_file, file_paths)
+    else:
+        records = map_bounded(classify_file, file_paths, workers)
+    for record in records:
+        if record is not None:
+            yield record
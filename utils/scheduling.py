@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import os
+from collections import namedtuple
+from xyz_plot import AXES, parse_axis, split_axis_values
+
+
+CHECKPOINT_AXIS = 'Checkpoint name'
+
+# One grid to generate: `index` is the position of the prompt test in the prompt file (used for output numbering),
+# `p` the prompt test and `tag` a filename suffix for grids split per checkpoint ('' otherwise)
+Job = namedtuple('Job', ['index', 'p', 'tag'])
+
+
+def count_cells(p):
+    """
+    Return the number of images (cells) of a prompt test grid from the number of values of each axis, with
+    ranges expanded like the X/Y/Z Plot script does.
+    """
+    cells = 1
+    for axis in AXES:
+        axis_type = p.get(f'{axis}_axis_type') or 'Nothing'
+        if axis_type != 'Nothing':
+            try:
+                cells *= len(parse_axis(axis_type, p.get(f'{axis}_axis_values')))
+            except ValueError:
+                cells *= max(1, len(split_axis_values(p.get(f'{axis}_axis_values'))))
+    return cells
+
+def grid_checkpoints(p):
+    """
+    Return the checkpoints a prompt test loads, in order: the values of its "Checkpoint name" axis, or its
+    `checkpoint` override. An empty list means the grid runs on whatever model is loaded.
+    """
+    for axis in AXES:
+        if p.get(f'{axis}_axis_type') == CHECKPOINT_AXIS:
+            return split_axis_values(p.get(f'{axis}_axis_values'))
+    return [p['checkpoint']] if p.get('checkpoint') else []
+
+def split_job(job):
+    """
+    Split a grid with a "Checkpoint name" axis into one grid per checkpoint, loaded through a `checkpoint` override.
+    """
+    for axis in AXES:
+        if job.p.get(f'{axis}_axis_type') == CHECKPOINT_AXIS:
+            checkpoints = split_axis_values(job.p.get(f'{axis}_axis_values'))
+            if len(checkpoints) < 2:
+                break
+            jobs = []
+            for checkpoint in checkpoints:
+                p = dict(job.p, checkpoint=checkpoint)
+                p[f'{axis}_axis_type'] = 'Nothing'
+                p[f'{axis}_axis_values'] = ''
+                tag = os.path.splitext(os.path.basename(checkpoint))[0]
+                jobs.append(Job(job.index, p, f'{job.tag}-{tag}' if job.tag else tag))
+            return jobs
+    return [job]
+
+def count_switches(jobs, current=None):
+    """
+    Count the model loads needed to run the jobs in order, starting with the `current` checkpoint loaded.
+    """
+    switches = 0
+    for job in jobs:
+        for checkpoint in grid_checkpoints(job.p):
+            if checkpoint != current:
+                switches += 1
+                current = checkpoint
+    return switches
+
+def plan_checkpoint_affinity(jobs, current=None, split=False):
+    """
+    Reorder jobs so that all the work for one checkpoint runs back to back, and return the planned jobs with the
+    number of model switches before and after planning.
+
+    Grids that do not load a checkpoint run first on the `current` model. The other grids are grouped by the
+    checkpoint they start with, starting with the group of the last loaded checkpoint. With `split`, grids with a
+    "Checkpoint name" axis are first split into one grid per checkpoint, so that they can join each group.
+    Job indexes (and so output numbering) are left untouched.
+
+    Example:
+
+    $ jobs, before, after = plan_checkpoint_affinity([Job(i, p, '') for i, p in enumerate(xyz_prompt_list)], split=True)
+    """
+    start = current
+    before = count_switches(jobs, start)
+    if split:
+        jobs = [part for job in jobs for part in split_job(job)]
+
+    free = []
+    groups = {}
+    for job in jobs:
+        checkpoints = grid_checkpoints(job.p)
+        if checkpoints:
+            groups.setdefault(checkpoints[0], []).append(job)
+        else:
+            free.append(job)
+
+    planned = free
+    while groups:
+        checkpoint = current if current in groups else next(iter(groups))
+        group = groups.pop(checkpoint)
+        # Grids ending on the group checkpoint first, then the ones moving on to another checkpoint
+        group.sort(key=lambda job: grid_checkpoints(job.p)[-1] != checkpoint)
+        planned.extend(group)
+        current = grid_checkpoints(group[-1].p)[-1]
+    return planned, before, count_switches(planned, start)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import json
+import glob
+import time
+import sqlite3
+import tarfile
+import argparse
+import itertools
+from collections import deque, namedtuple
+
+from PIL import Image
+from manifest import MANIFEST_DIR
+from preflight import GLOBAL_CONFIG, LOCAL_CONFIG, read_config, folder_tags, resolve_caption
+from scanner import DEFAULT_WORKERS, CAPTION_EXTENSION, clean_filename, extension_format, iter_files, map_bounded
+
+
+INDEX_FILENAME = 'index.sqlite'
+SHARD_PATTERN = 'shard-{:06d}.tar'
+DEFAULT_SHARD_SIZE = 1024  # MB
+TAR_BLOCK_SIZE = 512
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE,
+    shard TEXT,
+    offset INTEGER,
+    size INTEGER,
+    path TEXT,
+    caption TEXT,
+    source_caption TEXT,
+    metadata TEXT
+);
+'''
+
+# One image with its resolved caption (the tags of the tag files applied) and metadata
+Sample = namedtuple('Sample', ['key', 'image', 'caption', 'metadata'])
+
+
+def is_shard_directory(path):
+    return os.path.isfile(os.path.join(path, INDEX_FILENAME))
+
+def read_sample(task):
+    """
+    Read an image, its header and its caption file. Runs in the reader threads.
+    """
+    image_path, caption_path = task
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            header = {'format': (image.format or '').lower(), 'width': image.width, 'height': image.height, 'mode': image.mode}
+    except Exception as e:
+        return data, None, None, f'{type(e).__name__}: {e}'
+    caption = None
+    if caption_path is not None:
+        with open(caption_path, 'r', encoding='utf-8') as f:
+            caption = f.readline().strip()
+    return data, header, caption, None
+
+
+class ShardWriter:
+    """
+    Write samples to numbered tar shards of up to `shard_size` bytes, recording where every image lands in the index.
+
+    Each sample is stored as `<key>.<ext>` (the image bytes), `<key>.txt` (the resolved caption) and `<key>.json`
+    (the metadata), next to each other, like WebDataset shards. Shards are written to a temporary file and renamed
+    once complete.
+    """
+
+    def __init__(self, output_directory, shard_size=DEFAULT_SHARD_SIZE * 1024 ** 2):
+        self.output_directory = output_directory
+        self.shard_size = shard_size
+        os.makedirs(output_directory, exist_ok=True)
+        # Shards of a previous pack would be read along with the new ones
+        for path in glob.glob(os.path.join(glob.escape(output_directory), 'shard-*.tar')):
+            os.remove(path)
+        self.db = sqlite3.connect(os.path.join(output_directory, INDEX_FILENAME))
+        self.db.executescript('DROP TABLE IF EXISTS samples;' + SCHEMA)
+        self.shards = 0
+        self.samples = 0
+        self.tar = None
+        self.tar_name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.finish_shard()
+        self.db.commit()
+        self.db.close()
+
+    def finish_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        path = os.path.join(self.output_directory, self.tar_name)
+        os.replace(f'{path}.tmp', path)
+        self.tar = None
+
+    def add_member(self, name, data, mtime):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime
+        self.tar.addfile(info, io.BytesIO(data))
+        # The data ends the member, padded to a full block
+        return self.tar.offset - (len(data) + TAR_BLOCK_SIZE - 1) // TAR_BLOCK_SIZE * TAR_BLOCK_SIZE
+
+    def write(self, key, extension, image, caption, source_caption, metadata, mtime=0):
+        caption_bytes = caption.encode('utf-8')
+        metadata_bytes = json.dumps(metadata).encode('utf-8')
+        sample_size = len(image) + len(caption_bytes) + len(metadata_bytes) + 6 * TAR_BLOCK_SIZE
+        if self.tar is not None and self.tar.offset + sample_size > self.shard_size:
+            self.finish_shard()
+        if self.tar is None:
+            self.tar_name = SHARD_PATTERN.format(self.shards)
+            self.tar = tarfile.open(os.path.join(self.output_directory, f'{self.tar_name}.tmp'), 'w', format=tarfile.PAX_FORMAT)
+            self.shards += 1
+        # Images with the same name but another extension, e.g. `001.jpg` and `001.png`, need their own key
+        if self.db.execute('SELECT 1 FROM samples WHERE key = ?', (key,)).fetchone():
+            key = f'{key}_{extension[1:]}'
+        offset = self.add_member(f'{key}{extension}', image, mtime)
+        self.add_member(f'{key}{CAPTION_EXTENSION}', caption_bytes, mtime)
+        self.add_member(f'{key}.json', metadata_bytes, mtime)
+        self.db.execute(
+            'INSERT INTO samples (id, key, shard, offset, size, path, caption, source_caption, metadata) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (self.samples, key, self.tar_name, offset, len(image), metadata['path'], caption, source_caption, json.dumps(metadata))
+        )
+        self.samples += 1
+
+
+class ShardReader:
+    """
+    Read a dataset packed by `pack`: sequentially shard by shard, or at random through the index.
+
+    Example:
+
+    $ with ShardReader('input_shards') as reader:
+    $     len(reader)
+    $ 109
+    $     reader[12].caption
+    $ 'a photo of a woman wearing a floral crown, in the style of Bella Kotak'
+    $     for sample in reader:
+    $         ...
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.db = sqlite3.connect(os.path.join(directory, INDEX_FILENAME))
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.db.close()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM samples').fetchone()[0]
+
+    def shards(self):
+        return sorted(os.path.basename(path) for path in glob.glob(os.path.join(glob.escape(self.directory), 'shard-*.tar')))
+
+    def __getitem__(self, index):
+        """
+        Return a sample by its position, reading only its image from its shard.
+        """
+        row = self.db.execute('SELECT key, shard, offset, size, caption, metadata FROM samples WHERE id = ?', (index,)).fetchone()
+        if row is None:
+            raise IndexError(index)
+        key, shard, offset, size, caption, metadata = row
+        if shard not in self.files:
+            self.files[shard] = open(os.path.join(self.directory, shard), 'rb')
+        f = self.files[shard]
+        f.seek(offset)
+        return Sample(key, f.read(size), caption, json.loads(metadata))
+
+    def __iter__(self):
+        """
+        Stream every sample, reading the shards sequentially without the index.
+        """
+        for shard in self.shards():
+            with tarfile.open(os.path.join(self.directory, shard), 'r|') as tar:
+                for key, members in itertools.groupby(tar, key=lambda member: os.path.splitext(member.name)[0]):
+                    parts = {os.path.splitext(member.name)[1]: tar.extractfile(member).read() for member in members if member.isfile()}
+                    metadata = json.loads(parts.pop('.json'))
+                    caption = parts.pop(CAPTION_EXTENSION).decode('utf-8')
+                    yield Sample(key, parts.popitem()[1], caption, metadata)
+
+    def iter_captions(self, filename_caption=False):
+        """
+        Stream (path, caption) for every image from the index, without reading the shards. Captions are those of
+        the caption files (images without one are skipped), or the filenames with `filename_caption`.
+        """
+        for path, source_caption in self.db.execute('SELECT path, source_caption FROM samples ORDER BY id'):
+            if filename_caption:
+                yield path, clean_filename(os.path.basename(path))
+            elif source_caption is not None:
+                yield path, source_caption
+
+
+def iter_samples(input_directory, workers=DEFAULT_WORKERS):
+    """
+    Stream (relative path, image bytes, header, caption, tags) for every image of a dataset folder, reading files in
+    a bounded thread pool. Images that cannot be opened are reported and skipped.
+    """
+    global_tags = {}
+    local_tags = {}
+
+    def tasks():
+        # iter_files lists the files of a folder together, and a folder before its subfolders
+        for directory, paths in itertools.groupby(iter_files(input_directory), key=os.path.dirname):
+            rel_dir = os.path.relpath(directory, input_directory)
+            rel_dir = '' if rel_dir == '.' else rel_dir
+            if rel_dir.split(os.sep)[0] == MANIFEST_DIR:
+                continue
+            names = [os.path.basename(path) for path in paths]
+            for name, tags_by_dir in [(GLOBAL_CONFIG, global_tags), (LOCAL_CONFIG, local_tags)]:
+                if name in names:
+                    tags, issues = read_config(os.path.join(directory, name))
+                    for _, message in issues:
+                        print(f'Warning: `{os.path.join(rel_dir, name)}`: {message}')
+                    tags_by_dir[rel_dir] = tags
+            captions = {os.path.splitext(name)[0] for name in names if name.endswith(CAPTION_EXTENSION)}
+            for name in sorted(name for name in names if extension_format(name) is not None):
+                stem = os.path.splitext(name)[0]
+                pending.append(os.path.join(rel_dir, name))
+                yield os.path.join(directory, name), os.path.join(directory, f'{stem}{CAPTION_EXTENSION}') if stem in captions else None
+
+    pending = deque()
+    for data, header, caption, error in map_bounded(read_sample, tasks(), workers):
+        rel_path = pending.popleft()
+        if error:
+            print(f'Warning: skipped `{rel_path}`: {error}')
+            continue
+        yield rel_path, data, header, caption, folder_tags(os.path.dirname(rel_path), global_tags, local_tags)
+
+def pack(input_directory, output_directory, shard_size=DEFAULT_SHARD_SIZE * 1024 ** 2, workers=DEFAULT_WORKERS):
+    """
+    Pack a dataset folder into tar shards and an index, and return the number of samples and shards.
+    """
+    with ShardWriter(output_directory, shard_size) as writer:
+        for rel_path, data, header, caption, tags in iter_samples(input_directory, workers):
+            name = os.path.basename(rel_path)
+            source = 'txt' if caption is not None else 'filename'
+            resolved = resolve_caption(caption if caption is not None else clean_filename(name), tags)
+            metadata = dict(path=rel_path, caption_source=source, tags=tags, **header)
+            key = os.path.splitext(rel_path)[0].replace(os.sep, '/')
+            writer.write(key, os.path.splitext(name)[1].lower(), data, resolved, caption, metadata)
+        return writer.samples, writer.shards
+
+def main(input_directory, output_directory, shard_size=DEFAULT_SHARD_SIZE, workers=DEFAULT_WORKERS):
+    """
+    Pack a dataset folder of images, caption files and `global.yaml` tag files into tar shards of about
+    `shard_size` MB, with an index of every image. Captions are stored with the tags of the tag files applied, so
+    the shards hold everything the trainer reads. Copying a few large shards to a GPU instance is much faster than
+    millions of small files, and `caption2prompt.py`/`caption2xyz.py` can sample captions from the shards folder
+    directly.
+
+    Examples:
+    $ python shards.py -i input -o input_shards
+    $ python shards.py -i input -o input_shards --shard_size 256
+    $ python caption2prompt.py -i input_shards -n 15
+    """
+    if not os.path.isdir(input_directory):
+        print(f'ERROR: `{input_directory}` is not a folder')
+        sys.exit(1)
+
+    start = time.perf_counter()
+    samples, shards = pack(input_directory, output_directory, shard_size * 1024 ** 2, workers)
+    print(f'Packed {samples} images into {shards} shards in `{output_directory}` in {time.perf_counter() - start:.1f}s')
+    return samples, shards
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='Pack a dataset folder into tar shards with an index.')
+    parser.add_argument('-i', '--input_directory', type=str, default='input', help="The dataset folder (default: 'input')")
+    parser.add_argument('-o', '--output_directory', type=str, default=None, help="The folder of the shards and index (default: '<input_directory>_shards')")
+    parser.add_argument('-s', '--shard_size', type=int, default=DEFAULT_SHARD_SIZE, help=f'Maximum size of a shard in MB (default: {DEFAULT_SHARD_SIZE})')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS, help=f'Number of reader threads (default: {DEFAULT_WORKERS})')
+    args = parser.parse_args()
+
+    output_directory = args.output_directory or f'{args.input_directory.rstrip(os.sep)}_shards'
+    main(args.input_directory, output_directory, args.shard_size, args.workers)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+STAGES = ['request', 'sampling', 'decode', 'encode', 'write']
+EVENTS_FILENAME = 'telemetry.jsonl'
+SUMMARY_FILENAME = 'telemetry-summary.json'
+PROMETHEUS_INTERVAL = 10
+
+
+def percentile(values, q):
+    """
+    Return the `q` percentile (0-100) of `values` with linear interpolation.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600:d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class Telemetry:
+    """
+    Per-run telemetry of grid generation: a JSONL event log, per-stage timings and throughput.
+
+    Stages are 'request' (client-side request latency), 'sampling' (server-side processing time, from the WebUI
+    `X-Process-Time` header), 'decode' (base64 decode), 'encode' (image encoding) and 'write' (disk write).
+    Every grid reports how many cells (images) it holds, which gives throughput in images/sec and an ETA. With
+    `prometheus_file` the metrics are also written to a Prometheus node exporter textfile.
+
+    Example:
+
+    $ telemetry = Telemetry('output/20230601-120000', total_grids=15)
+    $ with telemetry.time('request', grid=1):
+    $     result = api.txt2img(...)
+    $ telemetry.grid_done(grid=1, cells=6)
+    $ telemetry.summary()
+    """
+
+    def __init__(self, run_folder, total_grids, total_cells=None, prometheus_file=None):
+        self.run_folder = run_folder
+        self.total_grids = total_grids
+        self.total_cells = total_cells
+        self.prometheus_file = prometheus_file
+        self.lock = threading.Lock()
+        self.durations = {stage: [] for stage in STAGES}
+        self.grids = 0
+        self.cells = 0
+        self.start = time.time()
+        self.last_export = 0
+        self.events = open(os.path.join(run_folder, EVENTS_FILENAME), 'a')
+        self.event('run_start', total_grids=total_grids, total_cells=total_cells)
+
+    def event(self, name, **fields):
+        line = json.dumps({'ts': time.time(), 'event': name, **fields})
+        with self.lock:
+            self.events.write(line + '\n')
+            self.events.flush()
+
+    def record(self, stage, seconds, **fields):
+        if seconds is None:
+            return
+        with self.lock:
+            self.durations[stage].append(seconds)
+        self.event('stage', stage=stage, seconds=seconds, **fields)
+
+    @contextmanager
+    def time(self, stage, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, **fields)
+
+    def throughput(self):
+        elapsed = time.time() - self.start
+        return self.cells / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        elapsed = time.time() - self.start
+        if not self.grids:
+            return None
+        if self.total_cells and self.cells:
+            return elapsed * (self.total_cells - self.cells) / self.cells
+        return elapsed * (self.total_grids - self.grids) / self.grids
+
+    def grid_done(self, cells=1, **fields):
+        """
+        Record a finished grid and return a progress line with throughput and ETA.
+        """
+        with self.lock:
+            self.grids += 1
+            self.cells += cells
+        self.event('grid_done', cells=cells, **fields)
+        if self.prometheus_file and time.time() - self.last_export >= PROMETHEUS_INTERVAL:
+            self.export_prometheus()
+        eta = self.eta()
+        eta = format_duration(eta) if eta is not None else '?'
+        return f'{self.grids}/{self.total_grids} grids, {self.throughput():.2f} images/s, ETA {eta}'
+
+    def grid_skipped(self, cells=1, **fields):
+        """
+        Remove a grid that does not need to be generated (already saved or cached) from the totals of the ETA.
+        """
+        with self.lock:
+            self.total_grids -= 1
+            if self.total_cells is not None:
+                self.total_cells -= cells
+        self.event('grid_skipped', cells=cells, **fields)
+
+    def stage_summary(self):
+        summary = {}
+        with self.lock:
+            durations = {stage: list(values) for stage, values in self.durations.items()}
+        for stage, values in durations.items():
+            if not values:
+                continue
+            summary[stage] = {
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99),
+            }
+        return summary
+
+    def summary(self):
+        """
+        Print and save the end-of-run summary, export the Prometheus metrics and close the event log.
+        """
+        elapsed = time.time() - self.start
+        summary = {
+            'grids': self.grids,
+            'cells': self.cells,
+            'elapsed': elapsed,
+            'grids_per_second': self.grids / elapsed if elapsed > 0 else 0.0,
+            'images_per_second': self.throughput(),
+            'stages': self.stage_summary(),
+        }
+        self.event('run_end', **{key: value for key, value in summary.items() if key != 'stages'})
+        with open(os.path.join(self.run_folder, SUMMARY_FILENAME), 'w') as f:
+            json.dump(summary, f, indent=2)
+        print(f'Generated {self.grids} grids ({self.cells} images) in {format_duration(elapsed)}, {summary["images_per_second"]:.2f} images/s')
+        for stage, stats in summary['stages'].items():
+            print(f'  {stage:<9} n={stats["count"]:<5} p50={stats["p50"]:.3f}s p95={stats["p95"]:.3f}s p99={stats["p99"]:.3f}s')
+        if self.prometheus_file:
+            self.export_prometheus()
+        self.events.close()
+        return summary
+
+    def export_prometheus(self):
+        self.last_export = time.time()
+        lines = [
+            '# HELP l2t_xyz_stage_seconds Duration of grid generation stages.',
+            '# TYPE l2t_xyz_stage_seconds summary',
+        ]
+        for stage, stats in self.stage_summary().items():
+            for quantile in ['p50', 'p95', 'p99']:
+                lines.append(f'l2t_xyz_stage_seconds{{stage="{stage}",quantile="0.{quantile[1:]}"}} {stats[quantile]}')
+            lines.append(f'l2t_xyz_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+            lines.append(f'l2t_xyz_stage_seconds_sum{{stage="{stage}"}} {stats["mean"] * stats["count"]}')
+        lines += [
+            '# HELP l2t_xyz_grids_total Grids generated in the current run.',
+            '# TYPE l2t_xyz_grids_total counter',
+            f'l2t_xyz_grids_total {self.grids}',
+            '# HELP l2t_xyz_images_total Grid cells (images) generated in the current run.',
+            '# TYPE l2t_xyz_images_total counter',
+            f'l2t_xyz_images_total {self.cells}',
+            '# HELP l2t_xyz_images_per_second Grid cells generated per second in the current run.',
+            '# TYPE l2t_xyz_images_per_second gauge',
+            f'l2t_xyz_images_per_second {self.throughput()}',
+        ]
+        # The textfile collector may read at any time, so replace the file atomically
+        tmp_path = f'{self.prometheus_file}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, self.prometheus_file)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import time
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from grid_image import compose_grid
+
+
+IMAGE_EXTENSIONS = {
+    'png': 'png',
+    'webp': 'webp',
+    'jpeg': 'jpg',
+}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def image_extension(image_format):
+    return IMAGE_EXTENSIONS[image_format]
+
+def encode_image(image_bytes, image_format='png', compress_level=None, quality=90):
+    """
+    Encode server-encoded image bytes to the output format.
+
+    PNG bytes are kept as they are unless a `compress_level` is given, WebP is written lossless and JPEG (meant
+    for previews) with the given `quality`.
+    """
+    if image_format == 'png' and compress_level is None and image_bytes.startswith(PNG_SIGNATURE):
+        return image_bytes
+    return encode_pil_image(Image.open(io.BytesIO(image_bytes)), image_format, compress_level, quality)
+
+def encode_pil_image(image, image_format='png', compress_level=None, quality=90):
+    buffer = io.BytesIO()
+    if image_format == 'png':
+        image.save(buffer, 'PNG', compress_level=6 if compress_level is None else compress_level)
+    elif image_format == 'webp':
+        image.save(buffer, 'WEBP', lossless=True, method=4 if compress_level is None else min(compress_level, 6))
+    else:
+        image.convert('RGB').save(buffer, 'JPEG', quality=quality, optimize=True)
+    return buffer.getvalue()
+
+def write_file(path, data):
+    # Write to a temporary file first so an interrupted run never leaves a truncated image behind
+    tmp_path = f'{path}.tmp'
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(tmp_path, mode) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def write_grid(image_bytes, path_filename, image_info, image_format='png', compress_level=None, quality=90):
+    """
+    Encode and write a grid image and its text file, and return the image path with the encode and write times.
+    """
+    image_path = f'{path_filename}.{image_extension(image_format)}'
+    start = time.perf_counter()
+    data = encode_image(image_bytes, image_format, compress_level, quality)
+    encoded = time.perf_counter()
+    write_file(image_path, data)
+    write_file(f'{path_filename}.txt', image_info)
+    return image_path, encoded - start, time.perf_counter() - encoded
+
+def write_composite(cells, shape, labels, path_filename, image_info, image_format='png', compress_level=None, quality=90):
+    """
+    Composite cell images into a grid with legends, then encode and write it like `write_grid`. The encode time
+    includes compositing.
+    """
+    image_path = f'{path_filename}.{image_extension(image_format)}'
+    start = time.perf_counter()
+    data = encode_pil_image(compose_grid(cells, shape, labels), image_format, compress_level, quality)
+    encoded = time.perf_counter()
+    write_file(image_path, data)
+    write_file(f'{path_filename}.txt', image_info)
+    return image_path, encoded - start, time.perf_counter() - encoded
+
+def ignore_sigint():
+    # Let the parent process handle Ctrl-C and flush pending writes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class ImageWriter:
+    """
+    Encode and write grid images and their metadata files in a process pool, while the next requests are in flight.
+
+    At most `max_pending` writes are queued: `submit` blocks on the oldest one beyond that, which applies
+    backpressure instead of holding every image of the run in memory. Closing the writer (also on Ctrl-C) waits for
+    every queued write to finish. Encode and write times are recorded to `telemetry` if given.
+
+    Example:
+
+    $ with ImageWriter('webp') as writer:
+    $     writer.submit(image_bytes, 'output/xyz_grid-0001', image_info)
+    """
+
+    def __init__(self, image_format='png', compress_level=None, quality=90, workers=None, max_pending=None, telemetry=None):
+        self.image_format = image_format
+        self.telemetry = telemetry
+        self.compress_level = compress_level
+        self.quality = quality
+        workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=ignore_sigint)
+        self.max_pending = max_pending or workers * 2
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def extension(self):
+        return image_extension(self.image_format)
+
+    def submit(self, image_bytes, path_filename, image_info, callback=None):
+        """
+        Queue a write and call `callback(image_path)` once the files are on disk.
+        """
+        return self._submit(write_grid, (image_bytes, path_filename, image_info), callback)
+
+    def submit_composite(self, cells, shape, labels, path_filename, image_info, callback=None):
+        """
+        Queue the compositing of grid cells (see `grid_image.compose_grid`) and the write of the grid.
+        """
+        return self._submit(write_composite, (cells, shape, labels, path_filename, image_info), callback)
+
+    def _submit(self, fn, args, callback):
+        while self.pending and self.pending[0].done():
+            self.pending.popleft().result()
+        if len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        future = self.executor.submit(fn, *args, self.image_format, self.compress_level, self.quality)
+        def done(f):
+            if f.exception() is not None:
+                return
+            image_path, encode_time, write_time = f.result()
+            if self.telemetry is not None:
+                self.telemetry.record('encode', encode_time, path=image_path)
+                self.telemetry.record('write', write_time, path=image_path)
+            if callback is not None:
+                callback(image_path)
+        future.add_done_callback(done)
+        self.pending.append(future)
+        return future
+
+    def close(self):
+        try:
+            while self.pending:
+                self.pending.popleft().result()
+        finally:
+            self.executor.shutdown(wait=True)
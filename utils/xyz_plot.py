@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+import re
+import csv
+import random
+import itertools
+from collections import OrderedDict
+
+
+AXES = ['x', 'y', 'z']
+
+# Axis types of the WebUI X/Y/Z Plot script, in the order of their index in the script args
+XYZPlotAvailableTxt2ImgScripts = [
+    "Nothing",
+    "Seed",
+    "Var. seed",
+    "Var. strength",
+    "Steps",
+    "Hires steps",
+    "CFG Scale",
+    "Prompt S/R",
+    "Prompt order",
+    "Sampler",
+    "Checkpoint name",
+    "Sigma Churn",
+    "Sigma min",
+    "Sigma max",
+    "Sigma noise",
+    "Eta",
+    "Clip skip",
+    "Denoising",
+    "Hires upscaler",
+    "VAE",
+    "Styles",
+]
+
+
+def validate_prompt(p):
+    """
+    Return the list of problems of a prompt test: a missing prompt, unknown axis types or a seed that is not an
+    integer. An empty list means the prompt test is valid.
+    """
+    errors = []
+    if not p.get('prompt'):
+        errors.append('missing prompt')
+    for axis in AXES:
+        axis_type = p.get(f'{axis}_axis_type')
+        if axis_type and axis_type not in XYZPlotAvailableTxt2ImgScripts:
+            errors.append(f'unknown {axis}_axis_type {axis_type!r}')
+    seed = p.get('seed')
+    if seed is not None and not isinstance(seed, int):
+        errors.append(f'seed {seed!r} is not an integer')
+    return errors
+
+
+# Ranges of the X/Y/Z Plot script: "1-5", "1-10 (+2)" (with a step) and "1-10 [5]" (with a count)
+RE_RANGE = re.compile(r'\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)(?:\s*\(([+-]\d+)\s*\))?\s*')
+RE_RANGE_FLOAT = re.compile(r'\s*([+-]?\s*\d+(?:\.\d*)?)\s*-\s*([+-]?\s*\d+(?:\.\d*)?)(?:\s*\(([+-]\d+(?:\.\d*)?)\s*\))?\s*')
+RE_RANGE_COUNT = re.compile(r'\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)\s*\[(\d+)\s*\]\s*')
+RE_RANGE_COUNT_FLOAT = re.compile(r'\s*([+-]?\s*\d+(?:\.\d*)?)\s*-\s*([+-]?\s*\d+(?:\.\d*)?)\s*\[(\d+)\s*\]\s*')
+SEED_AXES = ['Seed', 'Var. seed']
+
+
+def linspace(start, end, count):
+    if count <= 1:
+        return [start]
+    return [start + (end - start) * i / (count - 1) for i in range(count)]
+
+def split_axis_values(values):
+    return [value.strip() for value in itertools.chain.from_iterable(csv.reader(io.StringIO(values or ''), skipinitialspace=True)) if value]
+
+def expand_numbers(values, number_type):
+    """
+    Expand the ranges of a numeric axis and convert its values to `number_type` (int or float).
+    """
+    re_range, re_range_count = (RE_RANGE, RE_RANGE_COUNT) if number_type is int else (RE_RANGE_FLOAT, RE_RANGE_COUNT_FLOAT)
+    expanded = []
+    for value in values:
+        m = re_range.fullmatch(value)
+        mc = re_range_count.fullmatch(value)
+        if m is not None:
+            start = number_type(m.group(1).replace(' ', ''))
+            end = number_type(m.group(2).replace(' ', ''))
+            step = number_type(m.group(3)) if m.group(3) is not None else 1
+            if step == 0:
+                raise ValueError(f'Range {value!r} has a step of 0')
+            while (step > 0 and start <= end + 1e-9) or (step < 0 and start >= end - 1e-9):
+                expanded.append(round(start, 8) if number_type is float else start)
+                start += step
+        elif mc is not None:
+            start = number_type(mc.group(1).replace(' ', ''))
+            end = number_type(mc.group(2).replace(' ', ''))
+            expanded += [number_type(x) if number_type is int else round(x, 8) for x in linspace(start, end, int(mc.group(3)))]
+        else:
+            try:
+                expanded.append(number_type(value))
+            except ValueError:
+                raise ValueError(f'Invalid {number_type.__name__} axis value {value!r}')
+    return expanded
+
+def apply_field(name):
+    def apply(request, value, values):
+        request[name] = value
+    return apply
+
+def apply_setting(name):
+    def apply(request, value, values):
+        request['override_settings'] = dict(request.get('override_settings') or {}, **{name: value})
+    return apply
+
+def apply_prompt_sr(request, value, values):
+    search = values[0]
+    if search not in request.get('prompt', '') and search not in request.get('negative_prompt', ''):
+        raise ValueError(f'Prompt S/R did not find {search!r} in prompt or negative prompt')
+    request['prompt'] = request.get('prompt', '').replace(search, value)
+    request['negative_prompt'] = request.get('negative_prompt', '').replace(search, value)
+
+def apply_prompt_order(request, value, values):
+    # Reorder the tokens where they appear in the prompt, like the X/Y/Z Plot script
+    prompt = request.get('prompt', '')
+    tokens = sorted(value, key=prompt.find)
+    parts = []
+    for token in tokens:
+        n = prompt.find(token)
+        parts.append(prompt[:n])
+        prompt = prompt[n + len(token):]
+    request['prompt'] = ''.join(part + token for part, token in zip(parts, value)) + prompt
+
+def apply_styles(request, value, values):
+    request['styles'] = list(request.get('styles') or []) + [style.strip() for style in value.split(',')]
+
+def label_with_type(axis_type, value):
+    return f'{axis_type}: {value}'
+
+def label_value(axis_type, value):
+    return str(value)
+
+# Axis type: (value type, how a value is applied to a txt2img request, how it is labeled in the grid legend)
+AXIS_OPTIONS = {
+    'Seed': (int, apply_field('seed'), label_with_type),
+    'Var. seed': (int, apply_field('subseed'), label_with_type),
+    'Var. strength': (float, apply_field('subseed_strength'), label_with_type),
+    'Steps': (int, apply_field('steps'), label_with_type),
+    'Hires steps': (int, apply_field('hr_second_pass_steps'), label_with_type),
+    'CFG Scale': (float, apply_field('cfg_scale'), label_with_type),
+    'Prompt S/R': (str, apply_prompt_sr, label_value),
+    'Prompt order': (list, apply_prompt_order, lambda axis_type, value: ', '.join(value)),
+    'Sampler': (str, apply_field('sampler_name'), label_value),
+    'Checkpoint name': (str, apply_setting('sd_model_checkpoint'), lambda axis_type, value: os.path.basename(value)),
+    'Sigma Churn': (float, apply_field('s_churn'), label_with_type),
+    'Sigma min': (float, apply_field('s_tmin'), label_with_type),
+    'Sigma max': (float, apply_field('s_tmax'), label_with_type),
+    'Sigma noise': (float, apply_field('s_noise'), label_with_type),
+    'Eta': (float, apply_field('eta'), label_with_type),
+    'Clip skip': (int, apply_setting('CLIP_stop_at_last_layers'), label_with_type),
+    'Denoising': (float, apply_field('denoising_strength'), label_with_type),
+    'Hires upscaler': (str, apply_field('hr_upscaler'), label_with_type),
+    'VAE': (str, apply_setting('sd_vae'), label_value),
+    'Styles': (str, apply_styles, label_value),
+}
+
+
+def parse_axis(axis_type, values, rng=None):
+    """
+    Return the list of values of an axis, with ranges expanded, as the X/Y/Z Plot script would run them.
+    Seeds of -1 are replaced by random seeds so every cell of a row or column shares its seed.
+
+    Example:
+
+    $ parse_axis('Steps', '10-30 (+10)')
+    $ [10, 20, 30]
+    """
+    if not axis_type or axis_type == 'Nothing':
+        return [None]
+    if axis_type not in AXIS_OPTIONS:
+        raise ValueError(f'Unknown axis type {axis_type!r}')
+    value_type = AXIS_OPTIONS[axis_type][0]
+    values = split_axis_values(values)
+    if value_type in (int, float):
+        values = expand_numbers(values, value_type)
+    elif value_type is list:
+        values = [list(permutation) for permutation in itertools.permutations(values)]
+    if axis_type in SEED_AXES:
+        rng = rng or random.Random()
+        values = [rng.randrange(4294967294) if value == -1 else value for value in values]
+    if not values:
+        raise ValueError(f'No values for axis {axis_type!r}')
+    return values
+
+def has_random_seed_axis(p):
+    """
+    Return True if a "Seed" or "Var. seed" axis of a prompt test has a -1 value, which the WebUI draws at random.
+    """
+    for axis in AXES:
+        axis_type = p.get(f'{axis}_axis_type') or 'Nothing'
+        if axis_type in SEED_AXES:
+            try:
+                if -1 in expand_numbers(split_axis_values(p.get(f'{axis}_axis_values')), int):
+                    return True
+            except ValueError:
+                pass
+    return False
+
+def expand_grid(p, base_request, rng=None):
+    """
+    Expand the X/Y/Z axes of a prompt test into one txt2img request per grid cell.
+
+    Returns the grid shape `(z, y, x)`, the legend labels of each axis (empty for "Nothing" axes) and the cell
+    requests in z, y, x order. Raises ValueError for invalid axis values.
+    """
+    axes = []
+    for axis in AXES:
+        axis_type = p.get(f'{axis}_axis_type') or 'Nothing'
+        values = parse_axis(axis_type, p.get(f'{axis}_axis_values'), rng)
+        axes.append((axis_type, values))
+    (x_type, xs), (y_type, ys), (z_type, zs) = axes
+
+    def labels(axis_type, values):
+        if axis_type == 'Nothing':
+            return ['' for _ in values]
+        return [AXIS_OPTIONS[axis_type][2](axis_type, value) for value in values]
+
+    cells = []
+    for z in zs:
+        for y in ys:
+            for x in xs:
+                request = dict(base_request)
+                for axis_type, value, values in [(x_type, x, xs), (y_type, y, ys), (z_type, z, zs)]:
+                    if axis_type != 'Nothing':
+                        AXIS_OPTIONS[axis_type][1](request, value, values)
+                cells.append(request)
+    return (len(zs), len(ys), len(xs)), (labels(x_type, xs), labels(y_type, ys), labels(z_type, zs)), cells
+
+def batch_seed_cells(cells, max_batch_size=1):
+    """
+    Coalesce cell requests that only differ in seed into batched requests and yield `(keys, request)` pairs.
+
+    `cells` are `(key, request)` pairs. The WebUI gives the images of a batch consecutive seeds, or consecutive
+    variation seeds with the same seed when the variation seed strength is not zero, so only runs of consecutive
+    seeds (or variation seeds, e.g. a "Var. seed" sweep) are batched, up to `max_batch_size` images, with
+    `batch_size` set and the seeds of the first image. Keys are listed in the order of the images of the batch.
+    """
+    groups = OrderedDict()
+    for key, request in cells:
+        field = 'subseed' if request.get('subseed_strength') else 'seed'
+        if max_batch_size > 1:
+            group = json.dumps({name: value for name, value in request.items() if name != field}, sort_keys=True, default=str)
+        else:
+            group = key
+        groups.setdefault(group, []).append((field, key, request))
+    for members in groups.values():
+        members.sort(key=lambda member: member[2].get(member[0], -1))
+        run = []
+        for field, key, request in members:
+            # Random seeds (-1) are drawn once per request and never continue a run
+            previous = run[-1][1].get(field, -1) if run else -1
+            if run and (previous < 0 or request.get(field, -1) != previous + 1 or len(run) >= max_batch_size):
+                yield batch_request(run)
+                run = []
+            run.append((key, request))
+        if run:
+            yield batch_request(run)
+
+def batch_request(run):
+    request = dict(run[0][1])
+    if len(run) > 1:
+        request.update(batch_size=len(run), n_iter=1, do_not_save_grid=True)
+    return [key for key, _ in run], request
+
+def batch_cells(cells, max_batch_size=1, fields=('seed', 'prompt', 'negative_prompt')):
+    """
+    Coalesce cell requests that only differ in the given `fields` into batches of up to `max_batch_size` images and
+    yield `(keys, request)` pairs, for backends that take one seed and prompt per image of a batch.
+
+    `cells` are `(key, request)` pairs. Batched requests get `batch_size` and the per-image values as lists, under
+    the plural of the field name for seeds (`seeds`) and under the field name itself for prompts.
+    """
+    groups = OrderedDict()
+    for key, request in cells:
+        if max_batch_size > 1:
+            group = json.dumps({name: value for name, value in request.items() if name not in fields}, sort_keys=True, default=str)
+        else:
+            group = key
+        groups.setdefault(group, []).append((key, request))
+    for members in groups.values():
+        for start in range(0, len(members), max_batch_size):
+            run = members[start:start + max_batch_size]
+            request = dict(run[0][1])
+            if len(run) > 1:
+                for name in fields:
+                    values = [member_request.get(name) for _, member_request in run]
+                    if name == 'seed':
+                        request.pop('seed', None)
+                        request['seeds'] = values
+                    else:
+                        request[name] = values
+                request.update(batch_size=len(run), n_iter=1)
+            yield [key for key, _ in run], request
+
+def batch_images(images, info, count):
+    """
+    Return the `count` images of a batched response, without the grid the WebUI may put in front of them.
+    """
+    if isinstance(info, str):
+        try:
+            info = json.loads(info)
+        except ValueError:
+            info = {}
+    first = (info or {}).get('index_of_first_image', len(images) - count)
+    images = images[first:first + count]
+    if len(images) != count:
+        raise RuntimeError(f'Expected {count} images in the batch, got {len(images)}')
+    return images